@@ -6,9 +6,15 @@ Fallback ke LBPH jika InsightFace tidak tersedia.
 
 import os
 import glob
+import hashlib
+import io
+import json
+import queue
 import sqlite3
 import threading
 import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import cv2
@@ -20,6 +26,10 @@ from flask import (
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from augmentation import augment_img
+from face_tracker import FaceTracker
+from lbph_matcher import LBPHMatcher, LBPHModelStore
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,7 +39,13 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", "database_wajah")
 MODEL_DIR = os.path.join(BASE_DIR, "model")
 DB_PATH = os.path.join(BASE_DIR, "database.db")
-MODEL_PATH = os.path.join(MODEL_DIR, "Trainer.yml")
+LBPH_MODEL_DIR = os.path.join(MODEL_DIR, "lbph")  # model LBPH biner (lihat LBPHModelStore)
+MODEL_PATH = os.path.join(LBPH_MODEL_DIR, "model.json")
+LEGACY_MODEL_PATH = os.path.join(MODEL_DIR, "Trainer.yml")  # format lama OpenCV (dimigrasi saat startup)
+LBPH_STATE_PATH = os.path.join(MODEL_DIR, "lbph_state.json")
+DATASET_PACK_DIR = os.path.join(MODEL_DIR, "dataset")  # packed crops untuk training LBPH
+SIGNATURE_PATH = os.path.join(MODEL_DIR, "last_dataset.sig")  # signature dataset yang ada di model LBPH
+LEGACY_LABELS_PATH = os.path.join(MODEL_DIR, "lbph_labels.npy")  # label int64 pendamping Trainer.yml
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(MODEL_DIR, exist_ok=True)
@@ -82,22 +98,28 @@ def get_cascade_path(fname="haarcascade_frontalface_default.xml"):
 CASCADE_FILE_MAIN = get_cascade_path("haarcascade_frontalface_default.xml")
 CASCADE_FILE_ALT2 = get_cascade_path("haarcascade_frontalface_alt2.xml")
 
-# Only check cascade if we might need LBPH fallback
-detectors = []
-if os.path.isfile(CASCADE_FILE_MAIN):
-    det_main = cv2.CascadeClassifier(CASCADE_FILE_MAIN)
-    if not det_main.empty():
-        detectors.append(det_main)
-
-if os.path.isfile(CASCADE_FILE_ALT2):
-    det_alt2 = cv2.CascadeClassifier(CASCADE_FILE_ALT2)
-    if not det_alt2.empty():
-        detectors.append(det_alt2)
-
-# LBPH recognizer (for fallback)
+# Deteksi fallback: gambar diperkecil dulu, cascade kedua hanya jika yang pertama ragu
+DETECT_MAX_WIDTH = int(os.environ.get("DETECT_MAX_WIDTH", "320"))  # Lebar maks. gambar saat deteksi Haar (0 = resolusi penuh)
+DETECT_CONFIDENT_NEIGHBORS = int(os.environ.get("DETECT_CONFIDENT_NEIGHBORS", "6"))  # Jumlah neighbor agar cascade pertama dianggap yakin
+
+# CascadeClassifier tidak thread-safe: satu set per thread, dibuat sekali
+_cascade_local = threading.local()
+
+def get_detectors():
+    dets = getattr(_cascade_local, "detectors", None)
+    if dets is None:
+        dets = []
+        for path in (CASCADE_FILE_MAIN, CASCADE_FILE_ALT2):
+            if os.path.isfile(path):
+                det = cv2.CascadeClassifier(path)
+                if not det.empty():
+                    dets.append(det)
+        _cascade_local.detectors = dets
+    return dets
+
+# LBPH recognizer (for fallback): LBPHMatcher live, diganti saat hot swap (lihat LBPHState)
 recognizer = None
-if hasattr(cv2, "face"):
-    recognizer = cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8)
+lbph_store = LBPHModelStore(LBPH_MODEL_DIR)
 
 model_loaded = False
 model_lock = threading.Lock()
@@ -109,12 +131,71 @@ MIN_VALID_FRAMES = int(os.environ.get("MIN_VALID_FRAMES", "2"))
 EARLY_VOTES_REQUIRED = int(os.environ.get("EARLY_VOTES_REQUIRED", "4"))
 EARLY_CONF_THRESHOLD = float(os.environ.get("EARLY_CONF_THRESHOLD", "80"))
 
+# LBPH training inkremental: hapus / rename dicatat sebagai tombstone,
+# lalu dipadatkan dengan full rebuild berkala.
+LBPH_COMPACT_TOMBSTONES = int(os.environ.get("LBPH_COMPACT_TOMBSTONES", "10"))  # full rebuild jika tombstone >= ini
+LBPH_COMPACT_INTERVAL = float(os.environ.get("LBPH_COMPACT_INTERVAL", "3600"))  # detik antar pengecekan rebuild berkala
+SIGNATURE_BUCKETS = 256  # jumlah bucket signature dataset (Merkle)
+DATASET_JOURNAL_MAX = int(os.environ.get("DATASET_JOURNAL_MAX", "500"))  # baris journal manifest sebelum manifest ditulis ulang penuh
+LBPH_MIN_SAMPLES = int(os.environ.get("LBPH_MIN_SAMPLES", "20"))  # NIK dengan sampel asli < ini diaugmentasi saat training
+LBPH_TRAIN_AUGMENT = os.environ.get("LBPH_TRAIN_AUGMENT", "1") == "1"  # 0 = tanpa augmentasi in-memory
+LBPH_TRAIN_CONFIG = f"augment={int(LBPH_TRAIN_AUGMENT)},min={LBPH_MIN_SAMPLES}"  # model dibangun ulang jika berubah
+LBPH_PREDICT_WORKERS = int(os.environ.get("LBPH_PREDICT_WORKERS", str(min(4, os.cpu_count() or 1))))  # thread predict per request
+
+# Pagination daftar pasien (server-side)
+PATIENTS_PAGE_SIZE = int(os.environ.get("PATIENTS_PAGE_SIZE", "50"))
+PATIENTS_PAGE_MAX = int(os.environ.get("PATIENTS_PAGE_MAX", "500"))
+
 # ====== DB ======
+FTS_AVAILABLE = False
+NIK_MAX_DIGITS = 18  # batas aman INTEGER 64-bit untuk prefix lookup
+
 def db_connect():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
+def init_patient_search_index(conn):
+    """
+    Index FTS5 (external content) untuk nama & alamat pasien.
+    Dijaga otomatis oleh trigger pada INSERT / UPDATE / DELETE di tabel patients.
+    """
+    global FTS_AVAILABLE
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='patients_fts'"
+        ).fetchone()
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+                name, address,
+                content='patients', content_rowid='nik',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+                INSERT INTO patients_fts(rowid, name, address) VALUES (new.nik, new.name, new.address);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, name, address) VALUES ('delete', old.nik, old.name, old.address);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, name, address) VALUES ('delete', old.nik, old.name, old.address);
+                INSERT INTO patients_fts(rowid, name, address) VALUES (new.nik, new.name, new.address);
+            END
+        """)
+        if not exists:
+            # Data lama (sebelum index ada) dimasukkan sekali
+            conn.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+        FTS_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        logger.warning(f"[SEARCH] FTS5 tidak tersedia, pencarian memakai LIKE: {e}")
+        FTS_AVAILABLE = False
+
 def db_init():
     with db_connect() as conn:
         conn.execute("""
@@ -133,6 +214,12 @@ def db_init():
                 next_number INTEGER NOT NULL
             )
         """)
+        # index untuk keyset pagination (created_at DESC, nik DESC)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_created_at ON patients(created_at, nik)")
+        # index untuk sort kolom di tabel admin (lihat PATIENT_SORT_COLUMNS)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name COLLATE NOCASE, nik)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_address ON patients(address COLLATE NOCASE, nik)")
+        init_patient_search_index(conn)
         c = conn.execute("SELECT COUNT(*) AS c FROM queues").fetchone()
         if c["c"] == 0:
             for poli in ["Poli Umum", "Poli Gigi", "IGD"]:
@@ -162,12 +249,250 @@ def calculate_age(dob_str: str) -> str:
         dt = parse_date_flexible(dob_str)
         if not dt:
             return "N/A"
-        today = datetime.now()
-        age = today.year - dt.year - ((today.month, today.day) < (dt.month, dt.day))
-        return f"{age} Tahun"
+        return age_on(dt, datetime.now())
     except Exception:
         return "N/A"
 
+def age_on(dt, today) -> str:
+    age = today.year - dt.year - ((today.month, today.day) < (dt.month, dt.day))
+    return f"{age} Tahun"
+
+def request_site():
+    """Site/klinik asal request (form "site" atau header X-Site-Id); None = seluruh galeri."""
+    site = request.form.get("site") or request.headers.get("X-Site-Id")
+    return site.strip() if site and site.strip() else None
+
+# ====== PATIENT DIRECTORY (cache in-memory tabel patients) ======
+class PatientDirectory:
+    """
+    Cache in-memory tabel patients dengan key NIK.
+    - DOB di-parse sekali saat data masuk (bukan per request).
+    - Umur dihitung ulang untuk semua pasien hanya saat tanggal berganti.
+    - Di-update write-through oleh register / update / delete, sehingga
+      jalur baca (recognize, detail, list) tidak perlu menyentuh SQLite.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_nik = {}
+        self._age_day = None
+        self.version = 0
+        self.epoch = os.urandom(4).hex()  # beda tiap start, dipakai untuk ETag
+
+    def _make_record(self, nik, name, dob, address, created_at):
+        dt = parse_date_flexible(dob)
+        return {
+            "nik": int(nik), "name": name, "dob": dob, "address": address,
+            "created_at": created_at,
+            "dob_date": dt.date() if dt else None,
+            "age": age_on(dt, datetime.now()) if dt else "N/A",
+        }
+
+    def _touch(self):
+        self.version += 1
+
+    def _refresh_ages(self):
+        today = datetime.now().date()
+        if self._age_day == today:
+            return
+        with self._lock:
+            for rec in self._by_nik.values():
+                if rec["dob_date"] is not None:
+                    rec["age"] = age_on(rec["dob_date"], today)
+            self._age_day = today
+
+    def load(self):
+        with db_connect() as conn:
+            rows = conn.execute("SELECT nik, name, dob, address, created_at FROM patients").fetchall()
+        records = {int(r["nik"]): self._make_record(r["nik"], r["name"], r["dob"], r["address"], r["created_at"]) for r in rows}
+        with self._lock:
+            self._by_nik = records
+            self._age_day = datetime.now().date()
+            self._touch()
+        logger.info(f"[DIRECTORY] {len(records)} pasien dimuat ke memori")
+
+    def upsert(self, nik, name, dob, address, created_at):
+        """Sama seperti INSERT ... ON CONFLICT: created_at lama dipertahankan."""
+        with self._lock:
+            old = self._by_nik.get(int(nik))
+            if old is not None:
+                created_at = old["created_at"]
+            self._by_nik[int(nik)] = self._make_record(nik, name, dob, address, created_at)
+            self._touch()
+
+    def update(self, old_nik, new_nik, dob, address):
+        with self._lock:
+            old = self._by_nik.pop(int(old_nik), None)
+            if old is None:
+                return
+            self._by_nik[int(new_nik)] = self._make_record(new_nik, old["name"], dob, address, old["created_at"])
+            self._touch()
+
+    def remove(self, nik):
+        with self._lock:
+            if self._by_nik.pop(int(nik), None) is not None:
+                self._touch()
+
+    def get(self, nik):
+        self._refresh_ages()
+        return self._by_nik.get(int(nik))
+
+    def __len__(self):
+        return len(self._by_nik)
+
+def patient_json(rec) -> dict:
+    return {
+        "nik": rec["nik"],
+        "name": rec["name"],
+        "dob": rec["dob"],
+        "address": rec["address"],
+        "created_at": rec["created_at"],
+        "age": rec["age"]
+    }
+
+patient_directory = PatientDirectory()
+patient_directory.load()
+
+# Kolom sort /api/patients -> ekspresi ORDER BY yang dilayani index (keyset pagination).
+# dob tidak bisa di-sort: formatnya bebas (lihat parse_date_flexible), urutan teks salah.
+PATIENT_SORT_COLUMNS = {
+    "created_at": "created_at",             # idx_patients_created_at
+    "nik": "nik",                           # primary key
+    "name": "name COLLATE NOCASE",          # idx_patients_name
+    "address": "address COLLATE NOCASE",    # idx_patients_address
+}
+
+def fetch_patients_page(cursor, limit: int, sort: str = "created_at", descending: bool = True):
+    """
+    Keyset pagination urut (sort, nik) lewat index kolom sort (hanya index yang dibaca).
+    cursor = (nilai kolom sort, nik) baris terakhir halaman sebelumnya, atau None.
+    Return: (records, next_cursor)
+    """
+    col = PATIENT_SORT_COLUMNS[sort]
+    direction, op = ("DESC", "<") if descending else ("ASC", ">")
+    field = col.split()[0]
+    where, params = "", ()
+    if field == "nik":
+        order = f"nik {direction}"
+        if cursor is not None:
+            where, params = f"WHERE nik {op} ?", (cursor[1],)
+    else:
+        order = f"{col} {direction}, nik {direction}"
+        if cursor is not None:
+            # kondisi pertama agar SQLite seek ke index (row value + COLLATE saja -> full scan)
+            where = f"WHERE {col} {op}= ? AND ({col}, nik) {op} (?, ?)"
+            params = (cursor[0], cursor[0], cursor[1])
+    with db_connect() as conn:
+        keys = conn.execute(
+            f"SELECT nik, {field} AS k FROM patients {where} ORDER BY {order} LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+    has_more = len(keys) > limit
+    keys = keys[:limit]
+    records = [r for r in (patient_directory.get(k["nik"]) for k in keys) if r is not None]
+    next_cursor = f"{keys[-1]['k']}|{keys[-1]['nik']}" if has_more and keys else None
+    return records, next_cursor
+
+def parse_page_cursor(raw: str):
+    if not raw:
+        return None
+    created_at, _, nik = raw.rpartition("|")
+    return created_at, int(nik)
+
+def nik_prefix_ranges(prefix: str):
+    """
+    Prefix NIK -> daftar rentang (lo, hi) integer, supaya pencarian prefix
+    tetap memakai primary key (tidak CAST ke TEXT + LIKE yang full scan).
+    """
+    base = int(prefix)
+    ranges = []
+    for extra in range(0, NIK_MAX_DIGITS - len(prefix) + 1):
+        scale = 10 ** extra
+        ranges.append((base * scale, base * scale + scale - 1))
+    return ranges
+
+def fts_match_query(text: str) -> str:
+    """Input bebas -> query FTS5: setiap kata jadi prefix term, digabung AND."""
+    terms = []
+    for token in text.split():
+        token = token.replace('"', '""')
+        terms.append(f'"{token}"*')
+    return " ".join(terms)
+
+def search_patients(query: str, limit: int, cursor=None):
+    """
+    Cari pasien: angka -> prefix NIK, selain itu -> FTS5 nama & alamat.
+    Keyset pagination seperti fetch_patients_page: cursor = (rank, nik) baris
+    terakhir untuk FTS, ("", nik) untuk prefix NIK / LIKE (urut nik), atau None.
+    Return: (records, next_cursor)
+    """
+    query = query.strip()
+    if query.isdigit() and len(query) > NIK_MAX_DIGITS:
+        return [], None  # lebih panjang dari NIK mana pun: pasti tidak ada hasil
+    last_nik = cursor[1] if cursor is not None else None
+    with db_connect() as conn:
+        if query.isdigit():
+            ranges = nik_prefix_ranges(query)
+            where = " OR ".join(["nik BETWEEN ? AND ?"] * len(ranges))
+            params = [v for r in ranges for v in r]
+            after = "" if last_nik is None else " AND nik > ?"
+            rows = conn.execute(
+                f"SELECT nik, '' AS k FROM patients WHERE ({where}){after} ORDER BY nik LIMIT ?",
+                (*params, *(() if last_nik is None else (last_nik,)), limit + 1)
+            ).fetchall()
+        elif FTS_AVAILABLE:
+            after, params = "", ()
+            if cursor is not None:
+                after, params = " AND (rank, rowid) > (?, ?)", (float(cursor[0]), last_nik)
+            rows = conn.execute(
+                "SELECT rowid AS nik, rank AS k FROM patients_fts WHERE patients_fts MATCH ?"
+                f"{after} ORDER BY rank, rowid LIMIT ?",
+                (fts_match_query(query), *params, limit + 1)
+            ).fetchall()
+        else:
+            like = f"%{query}%"
+            after = "" if last_nik is None else " AND nik > ?"
+            rows = conn.execute(
+                f"SELECT nik, '' AS k FROM patients WHERE (name LIKE ? OR address LIKE ?){after} ORDER BY nik LIMIT ?",
+                (like, like, *(() if last_nik is None else (last_nik,)), limit + 1)
+            ).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    records = [r for r in (patient_directory.get(row["nik"]) for row in rows) if r is not None]
+    next_cursor = None
+    if has_more and rows:
+        key = rows[-1]["k"]
+        next_cursor = f"{key!r}|{rows[-1]['nik']}" if isinstance(key, float) else f"|{rows[-1]['nik']}"
+    return records, next_cursor
+
+# ====== COUNTER FOTO DATASET ======
+# Dijaga lewat adjust_photo_count saat app menulis / menghapus file, sehingga
+# dashboard tidak perlu os.listdir(DATA_DIR) tiap request. File yang diubah proses
+# lain (mis. cleanup_orphan_data.py) terdeteksi dari perubahan mtime folder, lalu
+# dihitung ulang sekali.
+_photo_count = 0
+_photo_count_mtime = None
+_photo_count_lock = threading.Lock()
+
+def adjust_photo_count(delta: int):
+    global _photo_count
+    with _photo_count_lock:
+        _photo_count = max(0, _photo_count + delta)
+
+def photo_count() -> int:
+    global _photo_count, _photo_count_mtime
+    try:
+        mtime = os.stat(DATA_DIR).st_mtime_ns
+    except OSError:
+        return _photo_count
+    with _photo_count_lock:
+        if mtime != _photo_count_mtime:
+            _photo_count = sum(1 for f in os.listdir(DATA_DIR) if f.lower().endswith(".jpg"))
+            _photo_count_mtime = mtime
+        return _photo_count
+
+photo_count()
+
 def list_existing_samples(nik: int) -> int:
     # Format baru: nik.index.jpg (tanpa name di depan)
     return len(glob.glob(os.path.join(DATA_DIR, f"{nik}.*.jpg")))
@@ -180,8 +505,10 @@ def is_blurry(gray_roi, thr: float = 80.0) -> bool:
     fm = cv2.Laplacian(gray_roi, cv2.CV_64F).var()
     return fm < thr
 
+FACE_SIZE = (200, 200)
+
 def preprocess_roi(gray_roi):
-    roi = cv2.resize(gray_roi, (200, 200), interpolation=cv2.INTER_CUBIC)
+    roi = cv2.resize(gray_roi, FACE_SIZE, interpolation=cv2.INTER_CUBIC)
     roi = cv2.equalizeHist(roi)
     return roi
 
@@ -196,189 +523,923 @@ def center_fallback_crop(gray):
     x = max(0, x); y = max(0, y)
     return gray[y:y+side, x:x+side]
 
-def detect_largest_face(gray):
+def _cascade_search(gray, min_size: int = 60, max_size: int = 0):
     """
-    Multi-cascade: coba beberapa classifier, pilih wajah terbesar.
-    Return: (roi_gray, (x,y,w,h)) atau (None, None)
+    Jalankan cascade pada gambar yang diperkecil (DETECT_MAX_WIDTH), koordinat
+    dikembalikan ke skala asli. Cascade berikutnya dilewati jika cascade
+    sebelumnya sudah yakin (neighbor >= DETECT_CONFIDENT_NEIGHBORS).
+    Return: (x,y,w,h) terbesar atau None
     """
-    best_roi, best_rect, best_area = None, None, -1
-    for det in detectors:
-        faces = det.detectMultiScale(
-            gray, scaleFactor=1.1, minNeighbors=3, minSize=(60, 60)
+    h_img, w_img = gray.shape[:2]
+    scale = 1.0
+    small = gray
+    if DETECT_MAX_WIDTH > 0 and w_img > DETECT_MAX_WIDTH:
+        scale = w_img / float(DETECT_MAX_WIDTH)
+        small = cv2.resize(gray, (DETECT_MAX_WIDTH, int(round(h_img / scale))), interpolation=cv2.INTER_AREA)
+    min_small = max(20, int(round(min_size / scale)))
+    max_small = int(round(max_size / scale)) if max_size else 0
+
+    best_rect, best_area = None, -1
+    for det in get_detectors():
+        faces, neighbors = det.detectMultiScale2(
+            small, scaleFactor=1.1, minNeighbors=3, minSize=(min_small, min_small),
+            maxSize=(max_small, max_small) if max_small else (0, 0)
         )
         if len(faces) == 0:
             continue
-        (x, y, w, h) = max(faces, key=lambda r: r[2] * r[3])
-        area = w * h
-        if area > best_area:
-            best_area = area
+        i = max(range(len(faces)), key=lambda k: faces[k][2] * faces[k][3])
+        (x, y, w, h) = faces[i]
+        if w * h > best_area:
+            best_area = w * h
             best_rect = (x, y, w, h)
-            best_roi = gray[y:y+h, x:x+w]
-    if best_roi is None:
+        if neighbors[i] >= DETECT_CONFIDENT_NEIGHBORS:
+            break
+    if best_rect is None:
+        return None
+    x, y, w, h = (int(round(v * scale)) for v in best_rect)
+    x = min(max(0, x), w_img - 1)
+    y = min(max(0, y), h_img - 1)
+    return (x, y, min(w, w_img - x), min(h, h_img - y))
+
+def detect_largest_face(gray, tracker: FaceTracker = None):
+    """
+    Multi-cascade: coba beberapa classifier, pilih wajah terbesar.
+    `tracker` (satu per request multi-frame): jika wajah sedang dilacak,
+    pencarian dibatasi ke ROI prediksi; fallback ke seluruh frame jika hilang
+    atau saat deteksi ulang berkala (TRACK_REDETECT_EVERY).
+    Return: (roi_gray, (x,y,w,h)) atau (None, None)
+    """
+    rect = None
+    region = tracker.search_region(gray.shape) if tracker is not None else None
+    if region is not None:
+        x0, y0, x1, y1 = region
+        # Wajah hampir tidak bergerak: batasi juga rentang ukuran pyramid
+        side = tracker.face_size()
+        found = _cascade_search(gray[y0:y1, x0:x1], min_size=max(60, int(side * 0.6)),
+                                max_size=int(side * 1.6))
+        if found is not None:
+            rect = (found[0] + x0, found[1] + y0, found[2], found[3])
+    full_frame = rect is None
+    if rect is None:
+        rect = _cascade_search(gray)
+    if tracker is not None:
+        tracker.update(rect, full_frame)
+    if rect is None:
         return None, None
-    return best_roi, best_rect
+    x, y, w, h = rect
+    return gray[y:y+h, x:x+w], rect
 
-def save_face_images_from_frame(img_bgr, name: str, nik: int, idx: int) -> int:
+def save_face_images_from_frame(img_bgr, name: str, nik: int, idx: int):
     """
     Simpan 1 gambar dengan validasi ketat dan preprocessing konsisten:
     - Wajah HARUS terdeteksi.
     - Wajah TIDAK BOLEH buram.
     - Gambar di-preprocess dengan cara yang sama seperti saat recognize.
     - Format nama file: nik.index.jpg (tanpa name untuk konsistensi)
+    Return: path file yang disimpan, atau None. Pemanggil memasukkan semua path
+    satu registrasi ke packed_dataset sekaligus (satu tulis journal).
     """
     try:
         gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
     except Exception:
-        return 0
+        return None
 
     crop, rect = detect_largest_face(gray)
 
     # 1. Wajib ada wajah
     if crop is None:
-        return 0
+        return None
 
     # 2. Wajib tidak terlalu buram (threshold lebih rendah agar lebih banyak frame lolos)
     if is_blurry(crop, thr=40.0):  # Turunkan dari 50 ke 40
-        return 0
+        return None
 
     # 3. Preprocess dengan cara yang sama seperti saat recognize (PENTING!)
     preprocessed = preprocess_roi(crop)
 
     # 4. Format nama file baru: nik.index.jpg (tanpa name untuk menghindari inkonsistensi)
     out_path = os.path.join(DATA_DIR, f"{nik}.{idx}.jpg")
+    existed = os.path.exists(out_path)
     cv2.imwrite(out_path, preprocessed)
-    return 1
-
-def augment_img(img):
-    """Augment grayscale numpy img: flip/bright/rotate small angle."""
-    out = img.copy()
-    # Don't equalizeHist again since already preprocessed at save time
-    out = cv2.convertScaleAbs(out, alpha=1.05, beta=5)
-    h, w = out.shape[:2]
-    M = cv2.getRotationMatrix2D((w//2, h//2), 3, 1.0)
-    out = cv2.warpAffine(out, M, (w, h), borderMode=cv2.BORDER_REFLECT_101)
-    return out
-
-def ensure_min_samples(nik: int, min_count: int = 20) -> int:
-    """
-    Pastikan minimal min_count file untuk NIK tersebut.
-    Jika kurang, buat hasil augmentasi dari file yang ada.
-    Format nama file: nik.index.jpg
+    if not existed:
+        adjust_photo_count(1)
+    return out_path
+
+def training_augmentation(faces, ids, real_counts=None):
+    """
+    Augmentasi saat training (in-memory, tidak pernah disimpan ke DATA_DIR).
+    NIK dengan sampel asli < LBPH_MIN_SAMPLES mendapat satu variasi augment_img
+    per sampel (maks. sampai LBPH_MIN_SAMPLES). augment_img deterministik, jadi
+    salinan berikutnya identik dan tidak mengubah hasil nearest-neighbor.
+    `real_counts` = {nik: jumlah sampel asli}; default dihitung dari `ids`.
+    Return: (faces_tambahan, ids_tambahan)
     """
-    pattern = os.path.join(DATA_DIR, f"{nik}.*.jpg")
-    files = sorted(glob.glob(pattern), key=lambda p: int(os.path.splitext(os.path.basename(p))[0].split(".")[1]))
-    saved = len(files)
-    if saved == 0:
-        return 0
-
-    next_idx = int(os.path.splitext(os.path.basename(files[-1]))[0].split(".")[1]) + 1
-    added = 0
-    src_imgs = [cv2.imread(p, cv2.IMREAD_GRAYSCALE) for p in files if os.path.isfile(p)]
-    src_imgs = [im for im in src_imgs if im is not None and im.size > 0]
-    if not src_imgs:
-        return 0
-
-    i = 0
-    while saved + added < min_count:
-        base = src_imgs[i % len(src_imgs)]
-        aug = augment_img(base)
-        out_path = os.path.join(DATA_DIR, f"{nik}.{next_idx}.jpg")
-        cv2.imwrite(out_path, aug)
-        next_idx += 1
-        added += 1
-        i += 1
-    return added
+    if not LBPH_TRAIN_AUGMENT:
+        return [], []
+    if real_counts is None:
+        real_counts = {}
+        for nik in ids:
+            real_counts[nik] = real_counts.get(nik, 0) + 1
+    budget = {nik: LBPH_MIN_SAMPLES - n for nik, n in real_counts.items() if n < LBPH_MIN_SAMPLES}
+    extra_faces, extra_ids = [], []
+    for face, nik in zip(faces, ids):
+        if budget.get(nik, 0) > 0:
+            extra_faces.append(augment_img(face))
+            extra_ids.append(nik)
+            budget[nik] -= 1
+    return extra_faces, extra_ids
+
+# ====== PACKED DATASET (cache training LBPH) ======
+# Semua crop di DATA_DIR (sudah ter-preprocess 200x200 grayscale) disimpan juga
+# dalam satu array uint8 yang bisa di-memmap + array label + manifest per file
+# (mtime/size). Training cukup membaca satu buffer kontigu, tanpa decode JPEG
+# ribuan file. Store di-update inkremental saat file ditambah / dihapus /
+# di-rename, dan dicocokkan ulang dengan DATA_DIR (stat saja) saat startup.
+
+def _parse_face_filename(fname: str):
+    """nik.index.jpg -> nik (int) atau None jika format salah."""
+    if not fname.lower().endswith(".jpg"):
+        return None
+    parts = fname.split(".")
+    if len(parts) < 3:
+        return None
+    try:
+        return int(parts[0])
+    except ValueError:
+        return None
+
+class DatasetSignature:
+    """
+    Signature isi training set ala Merkle tree: hash per file (nama file + SHA-1
+    isi) dikelompokkan ke SIGNATURE_BUCKETS bucket berdasarkan nama file; root =
+    hash dari semua digest bucket. Perubahan satu file hanya menandai satu
+    bucket kotor, jadi root dihitung ulang tanpa me-hash ulang seluruh dataset.
+    """
+
+    def __init__(self, files=None):
+        self._buckets = [{} for _ in range(SIGNATURE_BUCKETS)]
+        self._digests = [None] * SIGNATURE_BUCKETS
+        self._root = None
+        for fname, digest in (files or {}).items():
+            self.set(fname, digest)
+
+    @staticmethod
+    def _bucket(fname: str) -> int:
+        return zlib.crc32(fname.encode()) % SIGNATURE_BUCKETS
+
+    def _dirty(self, b: int):
+        self._digests[b] = None
+        self._root = None
+
+    def set(self, fname: str, digest: str):
+        b = self._bucket(fname)
+        if self._buckets[b].get(fname) != digest:
+            self._buckets[b][fname] = digest
+            self._dirty(b)
+
+    def discard(self, fname: str):
+        b = self._bucket(fname)
+        if self._buckets[b].pop(fname, None) is not None:
+            self._dirty(b)
+
+    def files(self) -> dict:
+        return {f: d for bucket in self._buckets for f, d in bucket.items()}
+
+    def remove_nik(self, nik: int):
+        for fname in [f for f in self.files() if _parse_face_filename(f) == nik]:
+            self.discard(fname)
+
+    def rename_nik(self, old_nik: int, new_nik: int):
+        for fname, digest in self.files().items():
+            if _parse_face_filename(fname) == old_nik:
+                self.discard(fname)
+                self.set(f"{new_nik}.{fname.split('.', 1)[1]}", digest)
+
+    def root(self) -> str:
+        if self._root is None:
+            h = hashlib.sha1()
+            for b, bucket in enumerate(self._buckets):
+                if self._digests[b] is None:
+                    bh = hashlib.sha1()
+                    for fname in sorted(bucket):
+                        bh.update(f"{fname}:{bucket[fname]}\n".encode())
+                    self._digests[b] = bh.digest()
+                h.update(self._digests[b])
+            self._root = h.hexdigest()
+        return self._root
+
+    def copy(self):
+        other = DatasetSignature()
+        other._buckets = [dict(bucket) for bucket in self._buckets]
+        other._digests = list(self._digests)
+        other._root = self._root
+        return other
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+def read_dataset_signature(path: str = SIGNATURE_PATH) -> DatasetSignature:
+    try:
+        with open(path, "r") as f:
+            return DatasetSignature(json.load(f)["files"])
+    except Exception:
+        return DatasetSignature()  # belum ada / format lama -> dianggap berbeda
+
+def write_dataset_signature(sig: DatasetSignature, path: str = SIGNATURE_PATH):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"root": sig.root(), "files": sig.files()}, f)
+    os.replace(tmp_path, path)
+
+class PackedDataset:
+    """
+    Baris 0..count-1 di faces.npy / labels.npy selalu terisi (hapus = swap
+    dengan baris terakhir), jadi data training = faces[:count].
+
+    Manifest: snapshot penuh (manifest.json) + journal append-only
+    (manifest.journal, satu baris JSON berisi entry file yang berubah per
+    operasi). add/remove/rename hanya menambah satu baris journal (O(file yang
+    berubah)); manifest penuh ditulis ulang di sync() atau saat journal
+    melewati DATASET_JOURNAL_MAX baris. Baris journal membawa epoch manifest,
+    jadi journal basi dari manifest lama tidak pernah di-replay.
+    """
+
+    MANIFEST_VERSION = 2
+
+    def __init__(self, pack_dir: str, data_dir: str, shape=FACE_SIZE):
+        self.pack_dir = pack_dir
+        self.data_dir = data_dir
+        self.shape = tuple(shape)
+        self.faces_path = os.path.join(pack_dir, "faces.npy")
+        self.labels_path = os.path.join(pack_dir, "labels.npy")
+        self.manifest_path = os.path.join(pack_dir, "manifest.json")
+        self.journal_path = os.path.join(pack_dir, "manifest.journal")
+        self.lock = threading.RLock()
+        self._faces = None
+        self._labels = None
+        self._count = 0
+        self._files = {}  # fname -> {"row", "mtime", "size"}
+        self._rows = []   # row -> fname
+        self._opened = False
+        self._epoch = None  # epoch manifest penuh terakhir
+        self._journal_lines = 0
+        self._changed = set()  # fname yang berubah sejak baris journal terakhir
+        self.signature = DatasetSignature()
+
+    def __len__(self):
+        return self._count
+
+    # --- penyimpanan ---
+
+    def _allocate(self, capacity: int):
+        """Buat (atau perbesar) file array; isi lama disalin."""
+        os.makedirs(self.pack_dir, exist_ok=True)
+        faces = np.lib.format.open_memmap(self.faces_path + ".tmp", mode="w+", dtype=np.uint8,
+                                          shape=(capacity,) + self.shape)
+        labels = np.lib.format.open_memmap(self.labels_path + ".tmp", mode="w+", dtype=np.int64,
+                                           shape=(capacity,))
+        if self._count:
+            faces[:self._count] = self._faces[:self._count]
+            labels[:self._count] = self._labels[:self._count]
+        faces.flush(); labels.flush()
+        os.replace(self.faces_path + ".tmp", self.faces_path)
+        os.replace(self.labels_path + ".tmp", self.labels_path)
+        self._faces, self._labels = faces, labels
+
+    def _ensure_capacity(self, needed: int):
+        capacity = 0 if self._faces is None else len(self._faces)
+        if needed > capacity:
+            self._allocate(max(needed, capacity * 2, 256))
+
+    def _flush_arrays(self):
+        if self._faces is not None:
+            self._faces.flush()
+            self._labels.flush()
+
+    def _write_manifest(self):
+        """Snapshot penuh (O(jumlah file)); journal lama dibuang."""
+        self._flush_arrays()
+        epoch = os.urandom(8).hex()
+        data = {"version": self.MANIFEST_VERSION, "shape": list(self.shape), "epoch": epoch,
+                "count": self._count, "files": self._files}
+        os.makedirs(self.pack_dir, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.manifest_path)
+        self._epoch = epoch
+        self._changed.clear()
+        self._journal_lines = 0
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    def _append_journal(self):
+        """Catat entry yang berubah sebagai satu baris journal (atau manifest penuh jika journal panjang)."""
+        if self._epoch is None or self._journal_lines >= DATASET_JOURNAL_MAX:
+            self._write_manifest()
+            return
+        if not self._changed:
+            return
+        self._flush_arrays()
+        line = {"epoch": self._epoch, "count": self._count,
+                "files": {f: self._files.get(f) for f in self._changed}}
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+        self._changed.clear()
+        self._journal_lines += 1
+
+    def _replay_journal(self, epoch, count: int, files: dict):
+        """Terapkan journal milik manifest epoch ini; baris terakhir yang terpotong diabaikan."""
+        lines = 0
+        try:
+            with open(self.journal_path, "r") as f:
+                for raw in f:
+                    try:
+                        entry = json.loads(raw)
+                    except ValueError:
+                        break  # crash saat menulis baris terakhir
+                    if entry.get("epoch") != epoch:
+                        continue
+                    for fname, meta in entry["files"].items():
+                        if meta is None:
+                            files.pop(fname, None)
+                        else:
+                            files[fname] = meta
+                    count = int(entry["count"])
+                    lines += 1
+        except FileNotFoundError:
+            pass
+        return count, lines
+
+    def _open_existing(self) -> bool:
+        try:
+            with open(self.manifest_path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != self.MANIFEST_VERSION or tuple(data.get("shape", ())) != self.shape:
+                return False
+            faces = np.load(self.faces_path, mmap_mode="r+")
+            labels = np.load(self.labels_path, mmap_mode="r+")
+            files = data["files"]
+            count, lines = self._replay_journal(data.get("epoch"), int(data["count"]), files)
+            if count > len(faces) or len(files) != count:
+                return False
+        except Exception:
+            return False
+        rows = [None] * count
+        for fname, meta in files.items():
+            row = meta.get("row", -1)
+            if not 0 <= row < count or rows[row] is not None:
+                return False
+            rows[row] = fname
+        self._faces, self._labels, self._count = faces, labels, count
+        self._files, self._rows = files, rows
+        self._epoch, self._journal_lines = data.get("epoch"), lines
+        self.signature = DatasetSignature({f: meta["sha1"] for f, meta in files.items()})
+        return True
+
+    def _ensure_open(self):
+        if self._opened:
+            return
+        if not self._open_existing():
+            self._faces, self._labels, self._count = None, None, 0
+            self._files, self._rows = {}, []
+            self.signature = DatasetSignature()
+        self._opened = True
+
+    # --- operasi per baris ---
+
+    def _decode(self, data: bytes):
+        # Sama seperti loader lama (PIL), supaya isi training identik
+        img = np.array(Image.open(io.BytesIO(data)).convert("L"), "uint8")
+        if img.shape != self.shape:
+            raise ValueError(f"ukuran {img.shape} != {self.shape}")
+        return img
+
+    def _put(self, fname: str, nik: int, data: bytes, st):
+        digest = hashlib.sha1(data).hexdigest()
+        meta = self._files.get(fname)
+        self._changed.add(fname)
+        if meta is not None and meta.get("sha1") == digest:
+            meta["mtime"], meta["size"] = st.st_mtime_ns, st.st_size  # hanya di-touch
+            return
+        img = self._decode(data)
+        if meta is None:
+            self._ensure_capacity(self._count + 1)
+            row = self._count
+            self._count += 1
+            self._rows.append(fname)
+            meta = self._files[fname] = {"row": row}
+        row = meta["row"]
+        self._faces[row] = img
+        self._labels[row] = nik
+        meta["mtime"] = st.st_mtime_ns
+        meta["size"] = st.st_size
+        meta["sha1"] = digest
+        self.signature.set(fname, digest)
+
+    def _drop(self, fname: str):
+        meta = self._files.pop(fname, None)
+        if meta is None:
+            return
+        self._changed.add(fname)
+        self.signature.discard(fname)
+        row, last = meta["row"], self._count - 1
+        if row != last:
+            moved = self._rows[last]
+            self._faces[row] = self._faces[last]
+            self._labels[row] = self._labels[last]
+            self._rows[row] = moved
+            self._files[moved]["row"] = row
+            self._changed.add(moved)
+        self._rows.pop()
+        self._count -= 1
+
+    def _add_path(self, path: str) -> bool:
+        fname = os.path.basename(path)
+        nik = _parse_face_filename(fname)
+        if nik is None:
+            return False
+        try:
+            st = os.stat(path)
+            with open(path, "rb") as f:
+                self._put(fname, nik, f.read(), st)
+        except Exception as e:
+            logger.debug(f"[DATASET] Skip: {path} - {e}")
+            self._drop(fname)
+            return False
+        return True
+
+    # --- API publik ---
+
+    def sync(self):
+        """Cocokkan dengan isi DATA_DIR: decode hanya file baru / berubah."""
+        with self.lock:
+            self._ensure_open()
+            seen, added = set(), 0
+            for entry in os.scandir(self.data_dir):
+                if _parse_face_filename(entry.name) is None:
+                    continue
+                seen.add(entry.name)
+                meta = self._files.get(entry.name)
+                st = entry.stat()
+                if meta and meta.get("mtime") == st.st_mtime_ns and meta.get("size") == st.st_size:
+                    continue
+                added += self._add_path(entry.path)
+            stale = [f for f in self._files if f not in seen]
+            for fname in stale:
+                self._drop(fname)
+            if added or stale or self._journal_lines or not os.path.isfile(self.manifest_path):
+                self._write_manifest()  # sync = titik kompaksi journal
+            logger.info(f"[DATASET] {self._count} crop di pack ({added} baru/berubah, {len(stale)} dihapus)")
+
+    def add_files(self, paths):
+        with self.lock:
+            self._ensure_open()
+            added = sum(self._add_path(p) for p in paths)
+            self._append_journal()
+        return added
+
+    def remove_nik(self, nik: int):
+        with self.lock:
+            self._ensure_open()
+            victims = [f for f in self._files if _parse_face_filename(f) == nik]
+            for fname in victims:
+                self._drop(fname)
+            self._append_journal()
+        return len(victims)
+
+    def rename_nik(self, old_nik: int, new_nik: int):
+        """Ikuti rename file nik.index.jpg -> new_nik.index.jpg (mtime tidak berubah)."""
+        with self.lock:
+            self._ensure_open()
+            renamed = 0
+            for fname in [f for f in self._files if _parse_face_filename(f) == old_nik]:
+                new_fname = f"{new_nik}.{fname.split('.', 1)[1]}"
+                self._drop(new_fname)  # jaga-jaga jika nama baru sudah ada
+                meta = self._files[new_fname] = self._files.pop(fname)
+                self.signature.discard(fname)
+                self.signature.set(new_fname, meta["sha1"])
+                self._rows[meta["row"]] = new_fname
+                self._labels[meta["row"]] = new_nik
+                self._changed.update((fname, new_fname))
+                renamed += 1
+            self._append_journal()
+        return renamed
+
+    def get(self, paths):
+        """
+        Ambil (crop, sha1) untuk daftar path (crop berupa salinan);
+        None jika belum ada di pack.
+        """
+        with self.lock:
+            self._ensure_open()
+            out = []
+            for p in paths:
+                meta = self._files.get(os.path.basename(p))
+                out.append(None if meta is None else (np.array(self._faces[meta["row"]]), meta["sha1"]))
+            return out
+
+    def snapshot(self, with_signature: bool = False):
+        """
+        Salinan (faces[count,H,W], labels[count]) yang aman dipakai di luar lock;
+        dengan with_signature=True ditambah salinan signature dari isi yang sama.
+        """
+        with self.lock:
+            self._ensure_open()
+            if not self._count:
+                data = (np.empty((0,) + self.shape, np.uint8), np.empty((0,), np.int64))
+            else:
+                data = (np.array(self._faces[:self._count]), np.array(self._labels[:self._count]))
+            return data + (self.signature.copy(),) if with_signature else data
+
+    def count_nik(self, nik: int) -> int:
+        with self.lock:
+            self._ensure_open()
+            return sum(1 for f in self._files if _parse_face_filename(f) == nik)
+
+    def stats(self):
+        with self.lock:
+            return {"count": self._count,
+                    "capacity": 0 if self._faces is None else len(self._faces),
+                    "journal_lines": self._journal_lines,
+                    "signature": self.signature.root()}
+
+packed_dataset = PackedDataset(DATASET_PACK_DIR, DATA_DIR)
 
 def get_images_and_labels():
     """
-    Load semua gambar training dan NIK-nya.
+    Load semua gambar training dan NIK-nya dari packed dataset.
     Format nama file: nik.index.jpg
     Gambar sudah ter-preprocess saat disimpan, jadi tidak perlu preprocess lagi.
     """
-    faces, ids = [], []
-    nik_counts = {}
-    for fname in os.listdir(DATA_DIR):
-        if not fname.lower().endswith(".jpg"):
-            continue
-        fpath = os.path.join(DATA_DIR, fname)
-        try:
-            pil = Image.open(fpath).convert("L")
-            img_np = np.array(pil, "uint8")
-            parts = fname.split(".")  # Format baru: nik.index.jpg
-            if len(parts) < 3:  # Minimal: nik.index.jpg
-                logger.debug(f"Skip file dengan format salah: {fname}")
-                continue
-            
-            # Ambil NIK dari parts[0] (format baru)
-            nik = int(parts[0])
-            
-            # Gambar sudah ter-preprocess saat save, tidak perlu preprocess lagi
-            faces.append(img_np)
-            ids.append(nik)
-            nik_counts[nik] = nik_counts.get(nik, 0) + 1
-        except Exception as e:
-            logger.debug(f"Skip: {fpath} - {e}")
-    
-    if faces:
-        logger.info(f"[TRAINING] Loaded {len(faces)} images for {len(nik_counts)} unique NIKs")
-    return faces, ids
+    packed_dataset.sync()
+    faces, labels = packed_dataset.snapshot()
+    if len(faces):
+        logger.info(f"[TRAINING] Loaded {len(faces)} images for {len(np.unique(labels))} unique NIKs")
+    return list(faces), [int(n) for n in labels]
 
-def train_model_blocking():
-    faces, ids = get_images_and_labels()
-    if not faces:
+def train_model_blocking(data=None):
+    """
+    Full training dari packed dataset. Return: (matcher atau None, pesan).
+    `data` = (faces, ids) yang sudah dimuat, supaya bisa dipakai ulang.
+    """
+    faces, ids = data if data is not None else get_images_and_labels()
+    if not len(faces):
         logger.info("[TRAINING] No training data found")
-        return False, "Tidak ada data untuk training!"
+        return None, "Tidak ada data untuk training!"
     try:
         logger.info(f"[TRAINING] Starting training with {len(faces)} images...")
-        recognizer.train(faces, np.array(ids))
-        recognizer.save(MODEL_PATH)
-        logger.info(f"[TRAINING] Model saved to {MODEL_PATH}")
-        return True, "Training selesai."
+        return LBPHMatcher.from_images(faces, ids), "Training selesai."
     except Exception as e:
         logger.error(f"[TRAINING] Error: {e}")
-        return False, f"Error training: {e}"
+        return None, f"Error training: {e}"
+
+# ====== LBPH: MODEL LIVE + WORKER BACKGROUND ======
+# Request recognize hanya membaca snapshot `_lbph_live` (LBPHState) yang berisi
+# LBPHMatcher immutable (lbph_matcher.py), jadi tidak perlu lock saat predict.
+# Semua perubahan (registrasi, hapus, rename, retrain) dikirim sebagai event ke
+# satu worker background yang:
+# - menggabungkan event yang menumpuk selama training berjalan,
+# - membuat matcher baru (extended() untuk tambahan sampel, atau full rebuild),
+# - menukar referensi live secara atomik dan menaikkan nomor generasi.
+# LBPH tidak bisa menghapus sampel, jadi hapus NIK -> tombstone dan
+# rename NIK -> peta label; keduanya dipadatkan oleh full rebuild berkala.
+
+class LBPHState:
+    """Snapshot model yang dipublikasikan; selalu diganti utuh, tidak diubah."""
+
+    def __init__(self, generation: int, matcher, tombstones, label_map, signature=None,
+                 train_config: str = LBPH_TRAIN_CONFIG):
+        self.generation = generation
+        self.train_config = train_config  # LBPH_TRAIN_CONFIG saat model dilatih
+        self.matcher = matcher
+        self.tombstones = frozenset(tombstones)  # label di model yang pasiennya sudah dihapus
+        self.label_map = dict(label_map)          # label lama di model -> NIK sekarang
+        # signature dataset yang tercermin di model (setelah tombstone / rename)
+        self.signature = signature if signature is not None else DatasetSignature()
+
+    @property
+    def samples(self) -> int:
+        return 0 if self.matcher is None else len(self.matcher)
+
+    @property
+    def ready(self) -> bool:
+        return self.samples > 0
+
+    def resolve(self, label: int):
+        """Label hasil predict -> NIK sekarang, atau None jika sudah dihapus."""
+        label = int(label)
+        if label in self.tombstones:
+            return None
+        return self.label_map.get(label, label)
+
+_lbph_live = LBPHState(0, None, (), {})
+_lbph_events = queue.Queue()
+_lbph_ticket_lock = threading.Lock()
+_lbph_rebuild_requested = 0  # tiket retrain terakhir dari admin
+_lbph_rebuild_done = 0  # tiket retrain terakhir yang selesai diproses worker
+# Matcher immutable -> frame-frame dalam satu request bisa di-score paralel tanpa lock
+lbph_predict_pool = (ThreadPoolExecutor(max_workers=LBPH_PREDICT_WORKERS, thread_name_prefix="lbph-predict")
+                     if LBPH_PREDICT_WORKERS > 1 else None)
+
+def current_lbph_state() -> LBPHState:
+    return _lbph_live
+
+def publish_lbph_state(state: LBPHState):
+    """Tukar model live secara atomik (request yang sedang jalan tetap memakai snapshot lamanya)."""
+    global _lbph_live, recognizer, model_loaded
+    with model_lock:
+        _lbph_live = state
+        recognizer = state.matcher
+        model_loaded = state.ready
+    logger.info(f"[MODEL] Generasi {state.generation} aktif ({state.samples} sampel, "
+                f"{len(state.tombstones)} tombstone, {len(state.label_map)} rename)")
+
+def read_lbph_state_file():
+    if not os.path.isfile(LBPH_STATE_PATH):
+        return 0, set(), {}, None
+    try:
+        with open(LBPH_STATE_PATH, "r") as f:
+            state = json.load(f)
+        return (
+            int(state.get("generation", 0)),
+            set(int(n) for n in state.get("tombstones", [])),
+            {int(k): int(v) for k, v in state.get("label_map", {}).items()},
+            state.get("train_config"),
+        )
+    except Exception as e:
+        logger.warning(f"[MODEL] Gagal membaca {LBPH_STATE_PATH}: {e}")
+        return 0, set(), {}, None
+
+def write_lbph_state_file(state: LBPHState):
+    data = {
+        "generation": state.generation,
+        "tombstones": sorted(state.tombstones),
+        "label_map": {str(k): v for k, v in state.label_map.items()},
+        "train_config": state.train_config,
+    }
+    tmp_path = LBPH_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, LBPH_STATE_PATH)
+
+def migrate_legacy_model():
+    """
+    Migrasi Trainer.yml (YAML OpenCV) ke store biner. Label di Trainer.yml
+    adalah int32 (NIK 16 digit terpotong), jadi hanya dimigrasi jika ada
+    lbph_labels.npy yang cocok; selain itu model dibangun ulang dari dataset.
+    Return: matcher atau None.
+    """
+    if not hasattr(cv2, "face"):
+        logger.warning(f"[MODEL] cv2.face tidak tersedia, {LEGACY_MODEL_PATH} tidak bisa dimigrasi")
+        return None
+    trainer = cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8)
+    trainer.read(LEGACY_MODEL_PATH)
+    matcher = LBPHMatcher.from_recognizer(trainer)
+    labels = np.load(LEGACY_LABELS_PATH) if os.path.isfile(LEGACY_LABELS_PATH) else None
+    for path in (LEGACY_MODEL_PATH, LEGACY_LABELS_PATH):
+        if os.path.isfile(path):
+            os.replace(path, path + ".bak")
+    if labels is None or len(labels) != len(matcher):
+        logger.info("[MODEL] Label Trainer.yml tidak lengkap, model akan dibangun ulang dari dataset")
+        return None
+    matcher = LBPHMatcher(matcher.histograms, labels, **matcher.params)
+    lbph_store.save(matcher)
+    logger.info(f"[MODEL] {LEGACY_MODEL_PATH} dimigrasi ke {LBPH_MODEL_DIR} ({len(matcher)} sampel)")
+    return matcher
 
 def load_model_if_exists():
-    global model_loaded
-    if os.path.isfile(MODEL_PATH):
-        try:
-            recognizer.read(MODEL_PATH)
-            model_loaded = True
-            logger.info(f"[MODEL] Successfully loaded model from {MODEL_PATH}")
-            return True
-        except Exception as e:
-            logger.warning(f"[MODEL] Failed to load model: {e}")
-            model_loaded = False
-            return False
-    # Only log "not found" if we're actually using LBPH as the primary engine
-    if FACE_ENGINE == "lbph":
-        logger.info(f"[MODEL] No model file found at {MODEL_PATH}")
-    return False
+    generation, tombstones, label_map, train_config = read_lbph_state_file()
+    try:
+        if lbph_store.exists():
+            matcher = lbph_store.load()
+        elif os.path.isfile(LEGACY_MODEL_PATH):
+            matcher = migrate_legacy_model()
+        else:
+            matcher = None
+    except Exception as e:
+        logger.warning(f"[MODEL] Failed to load model: {e}")
+        return False
+    if matcher is None:
+        # Only log "not found" if we're actually using LBPH as the primary engine
+        if FACE_ENGINE == "lbph":
+            logger.info(f"[MODEL] No model file found at {MODEL_PATH}")
+        return False
+    signature = read_dataset_signature()
+    publish_lbph_state(LBPHState(generation, matcher, tombstones, label_map, signature, train_config))
+    logger.info(f"[MODEL] Successfully loaded model from {MODEL_PATH}")
+    return True
+
+# --- API perubahan model (dipanggil dari handler HTTP, tidak blocking) ---
+
+def lbph_add_samples(nik: int, paths):
+    _lbph_events.put(("add", int(nik), list(paths)))
+    return True, "Model diperbarui di background."
+
+def lbph_mark_deleted(nik: int):
+    _lbph_events.put(("delete", int(nik)))
+    return True, "Data dihapus dari model."
+
+def lbph_mark_renamed(old_nik: int, new_nik: int):
+    _lbph_events.put(("rename", int(old_nik), int(new_nik)))
+    return True, "Label model diperbarui."
 
 def retrain_after_change():
-    global model_loaded
-    with model_lock:
-        jpgs = [f for f in os.listdir(DATA_DIR) if f.lower().endswith(".jpg")]
-        if not jpgs:
-            if os.path.isfile(MODEL_PATH):
-                try:
-                    os.remove(MODEL_PATH)
-                except Exception as e:
-                    logger.warning(f"Gagal hapus model: {e}")
-            model_loaded = False
-            return True, "Semua data dihapus. Model direset."
-        ok, msg = train_model_blocking()
-        if ok:
+    """
+    Jadwalkan full rebuild dari DATA_DIR (juga memadatkan semua tombstone).
+    Return: (ok, msg, ticket) - rebuild selesai saat lbph_rebuild_done() >= ticket
+    (dilatih ulang, atau dilewati karena dataset tidak berubah).
+    """
+    global _lbph_rebuild_requested
+    with _lbph_ticket_lock:
+        _lbph_rebuild_requested += 1
+        ticket = _lbph_rebuild_requested
+    _lbph_events.put(("rebuild", ticket))
+    generation = current_lbph_state().generation
+    return True, f"Retrain dijadwalkan di background (model aktif: generasi {generation}).", ticket
+
+def lbph_rebuild_done() -> int:
+    """Tiket retrain terakhir yang sudah diproses worker."""
+    return _lbph_rebuild_done
+
+def lbph_wait_idle():
+    """Tunggu sampai semua event yang sudah dikirim selesai diproses worker."""
+    _lbph_events.join()
+
+# --- Worker ---
+
+def plan_lbph_batch(state: LBPHState, events):
+    """
+    Gabungkan satu batch event (sesuai urutan) menjadi satu rencana update.
+    Return: (rebuild, adds {nik: [paths]}, tombstones, label_map)
+    """
+    tombstones = set(state.tombstones)
+    label_map = dict(state.label_map)
+    adds = {}
+    rebuild = False
+    for event in events:
+        kind = event[0]
+        if kind == "rebuild":
+            rebuild = True
+        elif kind == "add":
+            nik, paths = event[1], event[2]
+            # label masih dipakai data lama di model (NIK pernah dihapus / di-rename)
+            if nik in tombstones or nik in label_map:
+                rebuild = True
+            adds.setdefault(nik, []).extend(paths)
+        elif kind == "delete":
+            nik = event[1]
+            tombstones.add(nik)
+            for old in [k for k, v in label_map.items() if v == nik]:
+                del label_map[old]
+                tombstones.add(old)
+            label_map.pop(nik, None)
+        elif kind == "rename":
+            old_nik, new_nik = event[1], event[2]
+            for k, v in list(label_map.items()):
+                if v == old_nik:
+                    label_map[k] = new_nik
+            if old_nik not in tombstones:
+                label_map[old_nik] = new_nik
+    if rebuild or len(tombstones) + len(label_map) >= LBPH_COMPACT_TOMBSTONES:
+        return True, {}, set(), {}
+    return False, adds, tombstones, label_map
+
+def save_lbph_model(state: LBPHState, changed: bool = False, appended_from=None):
+    """
+    Simpan state model. Jika isi matcher berubah (`changed`), tulis ke store biner:
+    append baris baru saja jika `appended_from` = jumlah baris model sebelumnya,
+    selain itu tulis ulang penuh. Signature dataset ditulis terakhir, jadi tidak
+    pernah mendahului model.
+    """
+    try:
+        if state.matcher is None:
+            lbph_store.clear()
+        elif changed and appended_from is not None:
+            lbph_store.append(state.matcher, appended_from)
+        elif changed:
+            lbph_store.save(state.matcher)
+        write_lbph_state_file(state)
+        write_dataset_signature(state.signature)
+        logger.info(f"[MODEL] Generasi {state.generation} disimpan ke {MODEL_PATH}")
+    except Exception as e:
+        logger.warning(f"[MODEL] Gagal menyimpan model: {e}")
+
+def _signature_after(live: LBPHState, events, added):
+    """Signature isi model setelah batch inkremental (tanpa rebuild)."""
+    sig = live.signature.copy()
+    for event in events:
+        if event[0] == "delete":
+            sig.remove_nik(event[1])
+        elif event[0] == "rename":
+            sig.rename_nik(event[1], event[2])
+        elif event[0] == "add":
+            for path in event[2]:
+                if path in added:
+                    sig.set(os.path.basename(path), added[path])
+    return sig
+
+def _run_lbph_batch(events):
+    live = _lbph_live
+    rebuild, adds, tombstones, label_map = plan_lbph_batch(live, events)
+
+    faces, ids, added = [], [], {}
+    for nik, paths in adds.items():
+        for path, entry in zip(paths, packed_dataset.get(paths)):
+            if entry is None:
+                rebuild = True  # file sudah berubah (mis. di-rename) -> baca ulang semua
+                break
+            faces.append(entry[0])
+            ids.append(nik)
+            added[path] = entry[1]
+    if rebuild:
+        packed_dataset.sync()
+        faces, labels, signature = packed_dataset.snapshot(with_signature=True)
+        compacting = bool(live.tombstones or live.label_map or any(e[0] != "rebuild" for e in events))
+        unchanged = signature.root() == live.signature.root() and live.train_config == LBPH_TRAIN_CONFIG
+        if not compacting and unchanged and live.ready == (len(faces) > 0):
+            logger.info("[TRAINING] Dataset tidak berubah (signature sama), retrain dilewati")
+            return
+        faces, ids = list(faces), [int(n) for n in labels]
+        if not faces:
+            state = LBPHState(live.generation + 1, None, (), {}, signature)
+            publish_lbph_state(state)
+            save_lbph_model(state)
+            return
+        extra_faces, extra_ids = training_augmentation(faces, ids)
+        logger.info(f"[TRAINING] Full rebuild: {len(faces)} sampel (+{len(extra_faces)} augmentasi in-memory)")
+        matcher, msg = train_model_blocking(data=(faces + extra_faces, ids + extra_ids))
+        if matcher is None:
+            return
+        state = LBPHState(live.generation + 1, matcher, (), {}, signature)
+        publish_lbph_state(state)
+        save_lbph_model(state, changed=True)
+        return
+
+    signature = _signature_after(live, events, added)
+    if not faces:
+        # Hanya hapus / rename: model sama, cukup ganti tombstone & peta label
+        state = LBPHState(live.generation + 1, live.matcher, tombstones, label_map, signature,
+                         live.train_config)
+        publish_lbph_state(state)
+        save_lbph_model(state)
+        return
+
+    extra_faces, extra_ids = training_augmentation(
+        faces, ids, {nik: packed_dataset.count_nik(nik) for nik in adds})
+    logger.info(f"[TRAINING] Incremental update: {len(faces)} sampel (+{len(extra_faces)} augmentasi) untuk {len(adds)} NIK")
+    faces, ids = faces + extra_faces, ids + extra_ids
+    if live.matcher is None:
+        matcher = LBPHMatcher.from_images(faces, ids)
+    else:
+        matcher = live.matcher.extended(faces, ids)
+    state = LBPHState(live.generation + 1, matcher, tombstones, label_map, signature, live.train_config)
+    publish_lbph_state(state)
+    save_lbph_model(state, changed=True, appended_from=live.samples if live.matcher is not None else None)
+
+def _lbph_worker_loop():
+    global _lbph_rebuild_done
+    try:
+        packed_dataset.sync()
+        # Model di disk hanya dibangun ulang jika dataset berubah sejak disimpan
+        if packed_dataset.signature.root() != _lbph_live.signature.root():
+            logger.info("[MODEL] Dataset berubah sejak model terakhir disimpan, rebuild")
+            _lbph_events.put(("rebuild",))
+        elif _lbph_live.ready and _lbph_live.train_config != LBPH_TRAIN_CONFIG:
+            logger.info("[MODEL] Konfigurasi augmentasi berubah, rebuild")
+            _lbph_events.put(("rebuild",))
+    except Exception as e:
+        logger.warning(f"[DATASET] Gagal sinkron packed dataset: {e}")
+    while True:
+        try:
+            events = [_lbph_events.get(timeout=LBPH_COMPACT_INTERVAL)]
+        except queue.Empty:
+            # rebuild berkala hanya jika ada tombstone yang perlu dipadatkan
+            live = _lbph_live
+            if live.tombstones or live.label_map:
+                _lbph_events.put(("rebuild",))
+            continue
+        while True:
             try:
-                recognizer.read(MODEL_PATH)
-                model_loaded = True
-            except Exception as e:
-                model_loaded = False
-                return False, f"Model tersimpan tetapi gagal dimuat: {e}"
-        return ok, msg
+                events.append(_lbph_events.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _run_lbph_batch(events)
+        except Exception as e:
+            logger.error(f"[TRAINING] Worker error: {e}")
+        finally:
+            tickets = [e[1] for e in events if e[0] == "rebuild" and len(e) > 1]
+            if tickets:
+                _lbph_rebuild_done = max(_lbph_rebuild_done, *tickets)
+            for _ in events:
+                _lbph_events.task_done()
 
 # Load model at startup
 load_model_if_exists()
+threading.Thread(target=_lbph_worker_loop, name="lbph-worker", daemon=True).start()
 
 # ====== ROUTES (pages tetap) ======
 @app.get("/")
@@ -417,12 +1478,17 @@ def admin_logout():
 @login_required
 def admin_dashboard():
     with db_connect() as conn:
-        rows = conn.execute("SELECT nik, name, dob, address, created_at FROM patients ORDER BY created_at DESC").fetchall()
         queues = conn.execute("SELECT poli_name, next_number FROM queues").fetchall()
     
-    # Get data counts
-    data_count = len([f for f in os.listdir(DATA_DIR) if f.lower().endswith(".jpg")])
+    # Get data counts (counter, bukan scan direktori)
+    data_count = photo_count()
     
+    # Retrain dari dashboard masih berjalan selama tiketnya belum diproses worker
+    retrain_pending = session.get("retrain_ticket") is not None
+    if retrain_pending and lbph_rebuild_done() >= session["retrain_ticket"]:
+        session.pop("retrain_ticket")
+        retrain_pending = False
+
     # Get engine status
     engine_info = {
         'name': FACE_ENGINE.upper(),
@@ -439,11 +1505,12 @@ def admin_dashboard():
     
     return render_template(
         "admin_dashboard.html",
-        patients=rows,
         model_loaded=engine_info['model_loaded'],
         model_name=engine_info['name'],
+        model_generation=current_lbph_state().generation,
+        retrain_pending=retrain_pending,
         foto_count=data_count,
-        total_patients=len(rows),
+        total_patients=len(patient_directory),
         queues=queues,
         admin_name=session.get("admin_name", "Admin"),
         face_engine=FACE_ENGINE
@@ -453,9 +1520,12 @@ def admin_dashboard():
 @app.get("/api/engine/status")
 def api_engine_status():
     """Get face recognition engine status"""
+    lbph_state = current_lbph_state()
     status = {
         'engine': FACE_ENGINE,
-        'model_loaded': model_loaded
+        'model_loaded': model_loaded,
+        'model_generation': lbph_state.generation,
+        'lbph_pending_events': _lbph_events.qsize(),
     }
     
     if FACE_ENGINE == "insightface":
@@ -469,41 +1539,77 @@ def api_engine_status():
 # ====== API: PATIENTS (READ) untuk tabel admin ======
 @app.get("/api/patients")
 def api_patients():
-    with db_connect() as conn:
-        rows = conn.execute("""
-            SELECT nik, name, dob, address, created_at
-            FROM patients
-            ORDER BY created_at DESC
-        """).fetchall()
-    out = []
-    for r in rows:
-        out.append({
-            "nik": r["nik"],
-            "name": r["name"],
-            "dob": r["dob"],
-            "address": r["address"],
-            "created_at": r["created_at"],
-            "age": calculate_age(r["dob"])
-        })
-    return jsonify(ok=True, patients=out)
+    """
+    Daftar pasien per halaman (default urut created_at DESC).
+    Query: limit (dibatasi PATIENTS_PAGE_MAX), cursor (next_cursor dari halaman sebelumnya),
+    sort (kolom di PATIENT_SORT_COLUMNS), dir (asc/desc). Sort berlaku untuk seluruh tabel.
+    Mendukung ETag / If-None-Match.
+    """
+    sort = request.args.get("sort", "created_at")
+    direction = request.args.get("dir", "desc").lower()
+    if sort not in PATIENT_SORT_COLUMNS or direction not in ("asc", "desc"):
+        return jsonify(ok=False, msg="Parameter sort/dir tidak valid."), 400
+    try:
+        limit = int(request.args.get("limit", PATIENTS_PAGE_SIZE))
+        cursor = parse_page_cursor(request.args.get("cursor", ""))
+    except ValueError:
+        return jsonify(ok=False, msg="Parameter limit/cursor tidak valid."), 400
+    limit = max(1, min(limit, PATIENTS_PAGE_MAX))
+
+    etag = (f"patients-{patient_directory.epoch}.{patient_directory.version}-{sort}.{direction}-{limit}-"
+            f"{request.args.get('cursor', '')}")
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    records, next_cursor = fetch_patients_page(cursor, limit, sort, direction == "desc")
+    resp = jsonify(
+        ok=True,
+        patients=[patient_json(r) for r in records],
+        next_cursor=next_cursor,
+        total=len(patient_directory)
+    )
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.get("/api/patients/search")
+@login_required
+def api_patients_search():
+    """
+    Pencarian pasien untuk admin: q (nama/alamat, atau prefix NIK jika angka).
+    Pagination: limit + cursor (next_cursor dari halaman sebelumnya, keyset).
+    """
+    q = request.args.get("q", "").strip()
+    if not q:
+        return jsonify(ok=False, msg="Parameter q wajib diisi."), 400
+    try:
+        limit = int(request.args.get("limit", PATIENTS_PAGE_SIZE))
+        cursor = parse_page_cursor(request.args.get("cursor", ""))
+        if cursor is not None and not q.isdigit() and FTS_AVAILABLE:
+            float(cursor[0])
+    except ValueError:
+        return jsonify(ok=False, msg="Parameter limit/cursor tidak valid."), 400
+    limit = max(1, min(limit, PATIENTS_PAGE_MAX))
+
+    try:
+        records, next_cursor = search_patients(q, limit, cursor)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"[SEARCH] Query gagal ({q!r}): {e}")
+        return jsonify(ok=False, msg="Query pencarian tidak valid."), 400
+    return jsonify(
+        ok=True,
+        patients=[patient_json(r) for r in records],
+        next_cursor=next_cursor
+    )
 
 @app.get("/api/patient/<int:nik>")
 def api_patient_detail(nik: int):
-    with db_connect() as conn:
-        r = conn.execute("""
-            SELECT nik, name, dob, address, created_at
-            FROM patients WHERE nik = ?
-        """, (nik,)).fetchone()
+    r = patient_directory.get(nik)
     if not r:
         return jsonify(ok=False, msg="Pasien tidak ditemukan."), 404
-    return jsonify(ok=True, patient={
-        "nik": r["nik"],
-        "name": r["name"],
-        "dob": r["dob"],
-        "address": r["address"],
-        "created_at": r["created_at"],
-        "age": calculate_age(r["dob"])
-    })
+    return jsonify(ok=True, patient=patient_json(r))
 
 # ====== API: REGISTER ======
 @app.post("/api/register")
@@ -538,6 +1644,7 @@ def api_register():
             ON CONFLICT(nik) DO UPDATE SET name=excluded.name, dob=excluded.dob, address=excluded.address
         """, (nik, name, dob, address, now_iso))
         conn.commit()
+    patient_directory.upsert(nik, name, dob, address, now_iso)
 
     # Convert uploaded files to BGR images
     frames = []
@@ -553,12 +1660,13 @@ def api_register():
         with db_connect() as conn:
             conn.execute("DELETE FROM patients WHERE nik = ?", (nik,))
             conn.commit()
+        patient_directory.remove(nik)
         return jsonify(ok=False, msg="Tidak ada frame yang valid."), 400
 
     # Use InsightFace engine if available
     if FACE_ENGINE == "insightface":
         try:
-            enrolled, msg = face_engine.enroll_multiple_frames(frames, nik, min_embeddings=5)
+            enrolled, msg = face_engine.enroll_multiple_frames(frames, nik, min_embeddings=5, site=request_site())
             if enrolled > 0:
                 logger.info(f"[REGISTER] InsightFace success for NIK {nik}: {enrolled} embeddings")
                 return jsonify(ok=True, msg=f"Registrasi OK (InsightFace). {enrolled} embedding berhasil disimpan.")
@@ -572,34 +1680,30 @@ def api_register():
     # LBPH fallback
     existing = list_existing_samples(nik)
     next_idx = existing + 1
-    saved_total = 0
-    
+    saved_paths = []
+
     for img in frames:
         try:
-            saved = save_face_images_from_frame(img, name, nik, next_idx + saved_total)
-            saved_total += saved
-            if saved_total >= 20:
+            path = save_face_images_from_frame(img, name, nik, next_idx + len(saved_paths))
+            if path:
+                saved_paths.append(path)
+            if len(saved_paths) >= 20:
                 break
         except Exception as e:
             logger.warning(f"Failed to save frame: {e}")
-
-    # Ensure minimum samples with augmentation
-    if saved_total > 0 and saved_total < 20:
-        try:
-            added = ensure_min_samples(nik, 20)
-            saved_total += added
-        except Exception as e:
-            logger.warning(f"Pad samples error: {e}")
+    saved_total = len(saved_paths)
 
     if saved_total == 0:
         with db_connect() as conn:
             conn.execute("DELETE FROM patients WHERE nik = ?", (nik,))
             conn.commit()
+        patient_directory.remove(nik)
         logger.warning(f"[REGISTER] LBPH failed for NIK {nik}: No valid frames")
         return jsonify(ok=False, msg="Registrasi gagal: Tidak ada frame yang lolos validasi."), 400
 
     logger.info(f"[REGISTER] LBPH success for NIK {nik}: {saved_total} frames")
-    ok, msg = retrain_after_change()
+    packed_dataset.add_files(saved_paths)
+    ok, msg = lbph_add_samples(nik, saved_paths)
     return jsonify(ok=True, msg=f"Registrasi OK (LBPH). {saved_total} frame disimpan. {msg}")
 
 
@@ -633,17 +1737,14 @@ def api_recognize():
     # Use InsightFace engine if available
     if FACE_ENGINE == "insightface":
         try:
-            result = face_engine.recognize_face_multi_frame(frames)
+            kiosk_id = request.form.get("kiosk_id") or request.headers.get("X-Kiosk-Id") or request.remote_addr
+            result = face_engine.recognize_face_multi_frame(frames, kiosk_id=kiosk_id, site=request_site())
             if result is not None:
                 nik = result['nik']
-                with db_connect() as conn:
-                    row = conn.execute(
-                        "SELECT nik, name, dob, address FROM patients WHERE nik = ?",
-                        (nik,)
-                    ).fetchone()
+                row = patient_directory.get(nik)
                 
                 if row:
-                    age = calculate_age(row["dob"])
+                    age = row["age"]
                     confidence = result.get('confidence', int(result['similarity'] * 100))
                     
                     logger.info(f"[RECOGNIZE] InsightFace success: NIK={nik}, sim={result['similarity']:.3f}")
@@ -664,43 +1765,57 @@ def api_recognize():
             # Fall through to LBPH fallback
 
     # LBPH fallback
-    if not model_loaded or not os.path.isfile(MODEL_PATH):
+    # Snapshot model live: hot swap di background tidak mengganggu request ini
+    state = current_lbph_state()
+    if not state.ready:
         return jsonify(ok=False, msg="Model belum tersedia. Silakan register dulu."), 400
 
-    if recognizer is None:
-        return jsonify(ok=False, msg="LBPH recognizer tidak tersedia."), 500
-
     from collections import defaultdict, Counter
     votes = defaultdict(list)
     processed = 0
-    best_nik, best_avg = None, 99999.0
 
+    rois = []
+    tracker = FaceTracker()
     for img in frames:
         try:
             gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            roi_raw, rect = detect_largest_face(gray)
-            
+            roi_raw, rect = detect_largest_face(gray, tracker=tracker)
+
             if roi_raw is None or is_blurry(roi_raw, 25.0):
                 continue
+            rois.append(preprocess_roi(roi_raw))
+        except Exception as e:
+            logger.warning(f"LBPH preprocess error: {e}")
+    logger.debug(f"[RECOGNIZE] Deteksi: {tracker.full_detections} full-frame, {tracker.roi_detections} ROI, {tracker.lost} hilang")
 
-            roi = preprocess_roi(roi_raw)
-            Id_pred, conf = recognizer.predict(roi)
-            votes[int(Id_pred)].append(float(conf))
-            processed += 1
-
-            # Early stop check
-            for nk, cfs in votes.items():
-                avg = sum(cfs) / len(cfs)
-                if avg < best_avg:
-                    best_avg = avg
-                    best_nik = nk
-            if best_nik is not None:
-                share = len(votes[best_nik]) / max(1, processed)
-                if share >= VOTE_MIN_SHARE and len(votes[best_nik]) >= EARLY_VOTES_REQUIRED and best_avg <= EARLY_CONF_THRESHOLD:
-                    break
-
+    # Frame di-score per chunk terhadap seluruh matriks histogram; early stop
+    # hanya dicek di antara chunk, jadi chunk berikutnya benar-benar tidak di-score
+    chunk = max(EARLY_VOTES_REQUIRED, LBPH_PREDICT_WORKERS, 1)
+    for start in range(0, len(rois), chunk):
+        try:
+            predictions = state.matcher.predict_many(rois[start:start + chunk], executor=lbph_predict_pool)
         except Exception as e:
             logger.warning(f"LBPH predict error: {e}")
+            continue
+
+        for Id_pred, conf in predictions:
+            processed += 1
+            nik_pred = state.resolve(Id_pred)
+            if nik_pred is None:
+                continue  # cocok dengan data pasien yang sudah dihapus
+            votes[nik_pred].append(float(conf))
+
+        best_nik, best_avg = None, 99999.0
+        for nk, cfs in votes.items():
+            avg = sum(cfs) / len(cfs)
+            if avg < best_avg:
+                best_avg = avg
+                best_nik = nk
+        if best_nik is not None:
+            share = len(votes[best_nik]) / max(1, processed)
+            if share >= VOTE_MIN_SHARE and len(votes[best_nik]) >= EARLY_VOTES_REQUIRED and best_avg <= EARLY_CONF_THRESHOLD:
+                logger.debug(f"[RECOGNIZE] LBPH early stop setelah {processed}/{len(rois)} frame")
+                break
 
     if processed == 0 or not votes:
         return jsonify(ok=True, found=False, msg="Tidak ada wajah terdeteksi.")
@@ -718,24 +1833,20 @@ def api_recognize():
     if vote_share < VOTE_MIN_SHARE or len(confs_for_major) < MIN_VALID_FRAMES or median_conf >= LBPH_CONF_THRESHOLD:
         return jsonify(ok=True, found=False, msg="Tidak dikenali.")
 
-    with db_connect() as conn:
-        row = conn.execute(
-            "SELECT nik, name, dob, address FROM patients WHERE nik = ?",
-            (major,)
-        ).fetchone()
+    row = patient_directory.get(major)
 
     if not row:
         return jsonify(ok=True, found=False, msg="Tidak dikenali.")
 
     confidence_percent = int(max(0, min(100, 100 - median_conf)))
-    age = calculate_age(row["dob"])
+    age = row["age"]
     
     logger.info(f"[RECOGNIZE] LBPH success: NIK={major}, conf={median_conf:.2f}")
     return jsonify(
         ok=True, found=True,
         nik=row["nik"], name=row["name"], dob=row["dob"], address=row["address"],
         age=age, confidence=confidence_percent,
-        engine="lbph"
+        engine="lbph", model_generation=state.generation
     )
 
 # ====== API: QUEUE (untuk sinkron Admin <-> User, tidak diubah) ======
@@ -777,8 +1888,10 @@ def api_queue_set():
 @app.post("/admin/retrain")
 @login_required
 def admin_retrain():
-    ok, msg = retrain_after_change()
-    flash(("Retrain sukses." if ok else f"Retrain gagal: {msg}"), "success" if ok else "danger")
+    ok, msg, ticket = retrain_after_change()
+    if ok:
+        session["retrain_ticket"] = ticket
+    flash(msg if ok else f"Retrain gagal: {msg}", "success" if ok else "danger")
     return redirect(url_for("admin_dashboard"))
 
 @app.post("/admin/patient/<int:nik>/delete")
@@ -788,6 +1901,7 @@ def admin_delete_patient(nik: int):
     with db_connect() as conn:
         conn.execute("DELETE FROM patients WHERE nik = ?", (nik,))
         conn.commit()
+    patient_directory.remove(nik)
     
     removed = 0
     # Delete image files (LBPH format)
@@ -797,6 +1911,8 @@ def admin_delete_patient(nik: int):
             removed += 1
         except Exception as e:
             logger.warning(f"Failed to delete file {path}: {e}")
+    adjust_photo_count(-removed)
+    packed_dataset.remove_nik(nik)
     
     # Delete embeddings (InsightFace format)
     if FACE_ENGINE == "insightface":
@@ -806,7 +1922,7 @@ def admin_delete_patient(nik: int):
         except Exception as e:
             logger.warning(f"Failed to delete embeddings: {e}")
     
-    ok, msg = retrain_after_change()
+    ok, msg = lbph_mark_deleted(nik)
     flash(f"Hapus NIK {nik}: {removed} file dihapus. {msg}", "success" if ok else "danger")
     return redirect(url_for("admin_dashboard"))
 
@@ -834,6 +1950,7 @@ def admin_update_patient():
                 UPDATE patients SET nik=?, dob=?, address=? WHERE nik=?
             """, (nik, dob, address, old_nik))
             conn.commit()
+        patient_directory.update(old_nik, nik, dob, address)
 
         if nik != old_nik:
             renamed_count = 0
@@ -850,6 +1967,7 @@ def admin_update_patient():
                         renamed_count += 1
                     except Exception as e:
                         logger.warning(f"Failed to rename {old_path}: {e}")
+            packed_dataset.rename_nik(old_nik, nik)
             
             # Update embeddings (InsightFace)
             if FACE_ENGINE == "insightface":
@@ -859,7 +1977,7 @@ def admin_update_patient():
                 except Exception as e:
                     logger.warning(f"Failed to update embeddings: {e}")
             
-            ok_retrain, msg_retrain = retrain_after_change()
+            ok_retrain, msg_retrain = lbph_mark_renamed(old_nik, nik)
             msg_rename = f"{renamed_count} file gambar di-rename. {msg_retrain}"
             if not ok_retrain:
                 return jsonify(ok=False, msg=f"Data diupdate tapi retrain gagal: {msg_retrain}"), 500
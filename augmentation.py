@@ -0,0 +1,23 @@
+"""
+Deterministic augmentation for preprocessed face crops
+
+The one place that defines the LBPH training augmentation. app.py applies it
+in memory when a NIK has fewer than LBPH_MIN_SAMPLES crops;
+cleanup_orphan_data.py replays it to recognise the padding files that the old
+ensure_min_samples() wrote to disk. Both must use the exact same transform,
+so neither keeps its own copy.
+"""
+
+import cv2
+import numpy as np
+
+
+def augment_img(img: np.ndarray) -> np.ndarray:
+    """Augment a grayscale crop: slight brightness/contrast + 3 degree rotation."""
+    out = img.copy()
+    # Don't equalizeHist again since already preprocessed at save time
+    out = cv2.convertScaleAbs(out, alpha=1.05, beta=5)
+    h, w = out.shape[:2]
+    M = cv2.getRotationMatrix2D((w//2, h//2), 3, 1.0)
+    out = cv2.warpAffine(out, M, (w, h), borderMode=cv2.BORDER_REFLECT_101)
+    return out
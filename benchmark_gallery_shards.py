@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark pencarian galeri: scan in-process vs ShardPool, dengan beberapa
+pemanggil (thread request) bersamaan.
+
+Mengukur throughput (query/detik) dan latensi p50/p95 untuk galeri sintetis
+N baris (512 dimensi, 5 embedding per NIK). Dipakai untuk memilih
+GALLERY_SHARDS / GALLERY_SHARD_MIN_ROWS di mesin produksi sebelum sharding
+diaktifkan; default GALLERY_SHARDS tetap 0. Tidak menyentuh model/.
+
+Pemakaian:
+    python benchmark_gallery_shards.py                      # 100000 baris, 2 shard, 1/4/8 pemanggil
+    python benchmark_gallery_shards.py 200000 --shards 4 --callers 1 8 16
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+import numpy as np
+
+from gallery import Gallery, ShardPool
+
+DIM = 512
+PER_NIK = 5
+QUERIES_PER_CALLER = 50
+
+
+def synthetic_gallery(rows: int, seed: int = 0):
+    """{nik: [embedding, ...]} ternormalisasi, ~PER_NIK embedding per NIK."""
+    rng = np.random.default_rng(seed)
+    db = {}
+    for start in range(0, rows, PER_NIK):
+        embs = rng.standard_normal((min(PER_NIK, rows - start), DIM)).astype(np.float32)
+        embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+        db[1_000_000 + start // PER_NIK] = list(embs)
+    return db
+
+
+def run_callers(search, queries, callers: int):
+    """Throughput + latensi saat `callers` thread memanggil search bersamaan."""
+    latencies = [[] for _ in range(callers)]
+
+    def caller(i):
+        for j in range(QUERIES_PER_CALLER):
+            q = queries[(i * QUERIES_PER_CALLER + j) % len(queries)]
+            t0 = time.perf_counter()
+            search(q)
+            latencies[i].append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(callers)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    lat = np.concatenate([np.array(l) for l in latencies]) * 1000
+    return callers * QUERIES_PER_CALLER / elapsed, float(np.percentile(lat, 50)), float(np.percentile(lat, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pencarian galeri in-process vs shard")
+    parser.add_argument("rows", nargs="*", type=int, default=[100000], help="jumlah baris galeri")
+    parser.add_argument("--shards", type=int, default=2, help="jumlah proses worker (default 2)")
+    parser.add_argument("--callers", nargs="+", type=int, default=[1, 4, 8], help="jumlah pemanggil bersamaan")
+    args = parser.parse_args()
+
+    print(f"CPU: {os.cpu_count()} core, {args.shards} shard")
+    print(f"{'Baris':>8} | {'Pemanggil':>9} | {'Mode':<10} | {'Query/s':>8} | {'p50':>8} | {'p95':>8}")
+    print("-" * 66)
+    for rows in args.rows:
+        gallery = Gallery(synthetic_gallery(rows))
+        snapshot = gallery.snapshot()
+        index = snapshot.index
+        rng = np.random.default_rng(1)
+        queries = rng.standard_normal((64, DIM)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        pool = ShardPool(args.shards, DIM)
+        try:
+            pool.sync(snapshot)
+            modes = {
+                "in-process": lambda q: index.exact_scores(q),
+                "shard": lambda q: pool.search(snapshot, q, 0.0, top_k=20),
+            }
+            for callers in args.callers:
+                for name, search in modes.items():
+                    qps, p50, p95 = run_callers(search, queries, callers)
+                    print(f"{rows:>8} | {callers:>9} | {name:<10} | {qps:>8.1f} | {p50:>6.1f}ms | {p95:>6.1f}ms")
+            if not pool.stats()['healthy']:
+                print("Worker shard gagal, hasil shard tidak valid", file=sys.stderr)
+        finally:
+            pool.close()
+
+
+if __name__ == "__main__":
+    main()
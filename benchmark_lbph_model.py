@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark format model LBPH: Trainer.yml (YAML OpenCV) vs store biner (.npy, uint16 + skala).
+
+Mengukur ukuran file, waktu simpan, dan waktu load untuk N sampel sintetis
+(200x200, sama seperti crop di data/database_wajah). Tidak menyentuh folder model/.
+
+Pemakaian:
+    python benchmark_lbph_model.py            # default 500 dan 2000 sampel
+    python benchmark_lbph_model.py 1000 5000
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+from lbph_matcher import LBPHMatcher, LBPHModelStore
+
+
+def synthetic_faces(n: int, seed: int = 0):
+    """Crop 200x200 mirip hasil preprocess_roi (resize + equalizeHist)."""
+    rng = np.random.default_rng(seed)
+    faces = []
+    for _ in range(n):
+        small = (rng.random((40, 40)) * 255).astype(np.uint8)
+        faces.append(cv2.equalizeHist(cv2.resize(small, (200, 200), interpolation=cv2.INTER_CUBIC)))
+    return faces
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - t0
+
+
+def run(n: int, tmp: str):
+    faces = synthetic_faces(n)
+    labels = np.arange(n) // 20  # ~20 sampel per pasien (ensure_min_samples)
+    matcher = LBPHMatcher.from_images(faces, labels)
+    row = {"n": n}
+
+    if hasattr(cv2, "face"):
+        yml_path = os.path.join(tmp, f"Trainer_{n}.yml")
+        trainer = cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8)
+        trainer.train(faces, labels.astype(np.int32))
+        _, row["yml_save"] = timed(lambda: trainer.write(yml_path))
+        row["yml_size"] = os.path.getsize(yml_path)
+
+        def load_yml():
+            rec = cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8)
+            rec.read(yml_path)
+            return rec
+        _, row["yml_load"] = timed(load_yml)
+
+    store = LBPHModelStore(os.path.join(tmp, f"lbph_{n}"))
+    _, row["bin_save"] = timed(lambda: store.save(matcher))
+    row["bin_size"] = dir_size(store.model_dir)
+    loaded, row["bin_load"] = timed(lambda: LBPHModelStore(store.model_dir).load())
+    assert np.array_equal(loaded.labels, matcher.labels)
+    assert np.array_equal(loaded.histograms, matcher.histograms)
+    return row
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [500, 2000]
+    tmp = tempfile.mkdtemp(prefix="lbph_bench_")
+    try:
+        print(f"{'Sampel':>8} | {'Format':<12} | {'Ukuran':>10} | {'Simpan':>8} | {'Load':>8}")
+        print("-" * 58)
+        for n in sizes:
+            row = run(n, tmp)
+            if "yml_size" in row:
+                print(f"{n:>8} | {'Trainer.yml':<12} | {row['yml_size'] / 1e6:>8.1f}MB | "
+                      f"{row['yml_save']:>7.2f}s | {row['yml_load']:>7.2f}s")
+            print(f"{n:>8} | {'biner (.npy)':<12} | {row['bin_size'] / 1e6:>8.1f}MB | "
+                  f"{row['bin_save']:>7.2f}s | {row['bin_load']:>7.2f}s")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,32 @@ Script untuk membersihkan data yang tidak konsisten:
 1. Pasien di database tapi tidak ada file gambar training
 2. File gambar training tanpa pasien di database
 3. Model lama yang tidak valid
+
+Opsi --purge-synthetic: hapus sampel sintetis lama (file augmentasi yang dulu
+ditulis ensure_min_samples dan embedding ber-noise dari enroll_multiple_frames).
+Augmentasi sekarang hanya dilakukan in-memory saat training / indexing.
 """
 
 import os
 import glob
 import sqlite3
+import argparse
+
+import cv2
+import numpy as np
+
+from augmentation import augment_img
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", "database_wajah")
 DB_PATH = os.path.join(BASE_DIR, "database.db")
 MODEL_PATH = os.path.join(BASE_DIR, "model", "Trainer.yml")
+EMBEDDING_DB_PATH = os.path.join(BASE_DIR, "model", "embeddings.db")
+
+LEGACY_MIN_SAMPLES = 20         # min_count ensure_min_samples lama (padding file sampai jumlah ini)
+LEGACY_MIN_EMBEDDINGS = 5       # min_embeddings enroll_multiple_frames lama
+SYNTHETIC_PIXEL_TOLERANCE = 1.0  # Selisih piksel rata-rata vs augment_img yang di-encode ulang (beda versi libjpeg)
+SYNTHETIC_MIN_SIMILARITY = 0.95  # Cosine ke embedding sumber (noise N(0, 0.01) -> ~0.97)
 
 def get_db_connection():
     conn = sqlite3.connect(DB_PATH)
@@ -122,5 +138,126 @@ def cleanup():
     print("PEMBERSIHAN SELESAI!")
     print("=" * 60)
 
+def _legacy_file_groups():
+    """{nik: [path, ...]} file nik.index.jpg, urut index (urutan yang dipakai ensure_min_samples)."""
+    groups = {}
+    for fpath in glob.glob(os.path.join(DATA_DIR, "*.jpg")):
+        parts = os.path.basename(fpath).split(".")
+        if len(parts) == 3 and parts[0].isdigit() and parts[1].isdigit():
+            groups.setdefault(int(parts[0]), []).append((int(parts[1]), fpath))
+    return {nik: [p for _, p in sorted(entries)] for nik, entries in groups.items()}
+
+def _replays_augment(fpath, src):
+    """True jika fpath adalah augment_img(src) yang ditulis cv2.imwrite (di-encode ulang dengan cara sama)."""
+    img = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
+    if img is None or src is None or img.shape != src.shape:
+        return False
+    ok, buf = cv2.imencode(".jpg", augment_img(src))
+    if not ok:
+        return False
+    expected = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    return float(np.mean(cv2.absdiff(img, expected))) < SYNTHETIC_PIXEL_TOLERANCE
+
+def find_synthetic_files():
+    """
+    File padding dari ensure_min_samples lama. File itu tidak punya penanda,
+    jadi yang dicocokkan adalah tata letak yang ditulisnya: NIK dengan
+    `saved` < LEGACY_MIN_SAMPLES file asli mendapat file berikutnya
+    (index setelah file asli terakhir) sampai total LEGACY_MIN_SAMPLES, dan
+    file padding ke-k = augment_img(file asli ke-(k % saved)).
+    Satu NIK hanya dianggap punya padding jika SELURUH ekor itu cocok.
+    """
+    synthetic = []
+    for nik, files in _legacy_file_groups().items():
+        if len(files) < LEGACY_MIN_SAMPLES:
+            continue  # Padding selalu mengisi sampai LEGACY_MIN_SAMPLES
+        head = files[:LEGACY_MIN_SAMPLES]
+        srcs = {}
+        for saved in range(1, LEGACY_MIN_SAMPLES):
+            for i in range(saved):
+                if i not in srcs:
+                    srcs[i] = cv2.imread(head[i], cv2.IMREAD_GRAYSCALE)
+            tail = head[saved:]
+            if all(_replays_augment(fpath, srcs[k % saved]) for k, fpath in enumerate(tail)):
+                synthetic.extend((nik, fpath) for fpath in tail)
+                break
+    return synthetic
+
+def find_synthetic_embeddings():
+    """
+    Embedding padding dari enroll_multiple_frames lama: jika NIK punya
+    `count` < LEGACY_MIN_EMBEDDINGS embedding, baris berikutnya (id lebih
+    besar) sampai total LEGACY_MIN_EMBEDDINGS adalah salinan ber-noise dari
+    embedding ke-(k % count). Tidak ada penanda di tabel, jadi yang dicocokkan
+    adalah pola round-robin itu pada baris-baris pertama NIK (urut id).
+    """
+    if not os.path.exists(EMBEDDING_DB_PATH):
+        return []
+    conn = sqlite3.connect(EMBEDDING_DB_PATH)
+    rows = conn.execute("SELECT id, nik, embedding FROM embeddings ORDER BY id").fetchall()
+    conn.close()
+
+    per_nik = {}
+    for row_id, nik, blob in rows:
+        per_nik.setdefault(nik, []).append((row_id, np.frombuffer(blob, dtype=np.float32)))
+
+    synthetic = []
+    for nik, entries in per_nik.items():
+        if len(entries) < LEGACY_MIN_EMBEDDINGS:
+            continue
+        head = entries[:LEGACY_MIN_EMBEDDINGS]
+        for count in range(1, LEGACY_MIN_EMBEDDINGS):
+            tail = head[count:]
+            if all(
+                emb.shape == head[k % count][1].shape
+                and float(np.dot(emb, head[k % count][1])) >= SYNTHETIC_MIN_SIMILARITY
+                for k, (_, emb) in enumerate(tail)
+            ):
+                synthetic.extend((row_id, nik) for row_id, _ in tail)
+                break
+    return synthetic
+
+def purge_synthetic():
+    print("=" * 60)
+    print("PEMBERSIHAN SAMPEL SINTETIS")
+    print("=" * 60)
+
+    files = find_synthetic_files()
+    print(f"\n1. File augmentasi di {DATA_DIR}: {len(files)}")
+    per_nik = {}
+    for nik, _ in files:
+        per_nik[nik] = per_nik.get(nik, 0) + 1
+    for nik in sorted(per_nik):
+        print(f"   - NIK {nik}: {per_nik[nik]} file")
+    if files:
+        resp = input("\nHapus file augmentasi? (y/n): ").strip().lower()
+        if resp == 'y':
+            for _, fpath in files:
+                os.remove(fpath)
+            print(f"   {len(files)} file augmentasi berhasil dihapus!")
+            print("   Model LBPH akan dibangun ulang otomatis saat app.py dijalankan.")
+
+    embeddings = find_synthetic_embeddings()
+    print(f"\n2. Embedding ber-noise di {EMBEDDING_DB_PATH}: {len(embeddings)}")
+    if embeddings:
+        resp = input("\nHapus embedding ber-noise? (y/n): ").strip().lower()
+        if resp == 'y':
+            conn = sqlite3.connect(EMBEDDING_DB_PATH)
+            conn.executemany("DELETE FROM embeddings WHERE id = ?", [(row_id,) for row_id, _ in embeddings])
+            conn.commit()
+            conn.close()
+            print(f"   {len(embeddings)} embedding berhasil dihapus!")
+
+    print("\n" + "=" * 60)
+    print("PEMBERSIHAN SELESAI!")
+    print("=" * 60)
+
 if __name__ == "__main__":
-    cleanup()
+    parser = argparse.ArgumentParser(description="Pembersihan data orphan / sintetis")
+    parser.add_argument("--purge-synthetic", action="store_true",
+                        help="hapus file augmentasi & embedding ber-noise yang dulu disimpan permanen")
+    args = parser.parse_args()
+    if args.purge_synthetic:
+        purge_synthetic()
+    else:
+        cleanup()
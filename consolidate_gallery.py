@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Konsolidasi galeri embedding InsightFace (model/embeddings.db).
+
+NIK dengan embedding lebih dari batas (GALLERY_MAX_PER_NIK) dipangkas ke
+subset representatif (k-center berdasarkan cosine distance). Opsional:
+simpan template rata-rata berbobot kualitas per NIK.
+
+Pemakaian:
+    python consolidate_gallery.py                  # batas default GALLERY_MAX_PER_NIK
+    python consolidate_gallery.py --max-per-nik 8 --keep-mean
+    python consolidate_gallery.py --dry-run        # hanya laporan, tidak menghapus
+"""
+
+import os
+import argparse
+
+os.environ.setdefault("FACE_ENGINE_INIT", "0")
+
+import face_engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Konsolidasi embedding per NIK")
+    parser.add_argument("--max-per-nik", type=int, default=face_engine.GALLERY_MAX_PER_NIK,
+                        help="jumlah maksimum embedding per NIK")
+    parser.add_argument("--keep-mean", action="store_true", default=face_engine.GALLERY_KEEP_MEAN,
+                        help="simpan template rata-rata berbobot kualitas")
+    parser.add_argument("--dry-run", action="store_true", help="tampilkan laporan tanpa menghapus")
+    args = parser.parse_args()
+
+    if not os.path.exists(face_engine.EMBEDDING_DB_PATH):
+        print(f"Database {face_engine.EMBEDDING_DB_PATH} tidak ditemukan!")
+        return
+    face_engine.init_embedding_db()
+
+    print("=" * 60)
+    print("KONSOLIDASI GALERI EMBEDDING" + (" (DRY RUN)" if args.dry_run else ""))
+    print("=" * 60)
+
+    report = face_engine.consolidate_gallery(args.max_per_nik, args.keep_mean, dry_run=args.dry_run)
+    for r in report['niks_consolidated']:
+        print(f"   - NIK {r['nik']}: {r['before']} -> {r['after']} embedding")
+    if not report['niks_consolidated']:
+        print(f"\nTidak ada NIK dengan lebih dari {args.max_per_nik} embedding.")
+
+    print(f"\nBiaya scan per query: {report['scan_cost_before']} -> {report['scan_cost_after']} perbandingan "
+          f"({report['scan_cost_reduction'] * 100:.1f}% lebih sedikit)")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,16 +10,25 @@ Pipeline:
 """
 
 import os
+import atexit
 import json
 import sqlite3
 import threading
 import logging
-from datetime import datetime
+import itertools
+import queue
+import time
+import tempfile
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from typing import Optional, Tuple, List, Dict, Any
 
 import cv2
 import numpy as np
 
+from face_tracker import FaceTracker
+from gallery import ColdSegment, ColdSegmentWriter, Gallery, GalleryIndex, GallerySnapshot, ShardPool
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -54,11 +63,98 @@ MIN_VALID_FRAMES = int(os.environ.get("MIN_VALID_FRAMES", "2"))  # Minimum valid
 EARLY_VOTES_REQUIRED = int(os.environ.get("EARLY_VOTES_REQUIRED", "4"))  # Early stop votes
 EARLY_SIM_THRESHOLD = float(os.environ.get("EARLY_SIM_THRESHOLD", "0.55"))  # Early stop similarity
 
+# Recent identity cache (repeat visitors per kiosk)
+RECENT_CACHE_SIZE = int(os.environ.get("RECENT_CACHE_SIZE", "50"))  # Identities kept per kiosk (0 = disabled)
+RECENT_CACHE_TTL = float(os.environ.get("RECENT_CACHE_TTL", "28800"))  # Seconds before a cached identity expires
+RECENT_CACHE_MARGIN = float(os.environ.get("RECENT_CACHE_MARGIN", "0.15"))  # Extra similarity above threshold to accept from cache
+RECENT_CACHE_MAX_KIOSKS = int(os.environ.get("RECENT_CACHE_MAX_KIOSKS", "64"))  # Kiosk caches kept; least recently used is dropped beyond this
+RECENT_CACHE_KIOSKS = {k.strip() for k in os.environ.get("RECENT_CACHE_KIOSKS", "").split(",") if k.strip()}  # Allowed kiosk ids (empty = any); others share "default"
+
+# In-memory index padding (noisy copies of real embeddings, never written to embeddings.db)
+EMBEDDING_INDEX_PADDING = os.environ.get("EMBEDDING_INDEX_PADDING", "0") == "1"  # 1 = pad sparse NIKs in memory
+EMBEDDING_INDEX_MIN = int(os.environ.get("EMBEDDING_INDEX_MIN", "5"))  # Target embeddings per NIK when padding
+SYNTHETIC_QUALITY_SCORE = 0.5  # quality_score the old enrollment padding persisted noisy copies with
+
+# Haar fallback detection
+DETECT_MAX_WIDTH = int(os.environ.get("DETECT_MAX_WIDTH", "320"))  # Max image width for Haar detection (0 = full resolution)
+TRACK_DET_SIZE = int(os.environ.get("TRACK_DET_SIZE", "320"))  # RetinaFace input size when detecting inside a tracking ROI
+
+# Head-pose pre-filter (from the detector's 5 keypoints)
+POSE_MAX_YAW = float(os.environ.get("POSE_MAX_YAW", "35"))  # Max |yaw| in degrees before a frame is skipped
+POSE_MAX_ROLL = float(os.environ.get("POSE_MAX_ROLL", "25"))  # Max |roll| in degrees before a frame is skipped
+
+# Enrollment frame selection
+ENROLL_BEST_K = int(os.environ.get("ENROLL_BEST_K", "10"))  # Frames embedded and stored per registration
+ENROLL_DIVERSITY_WEIGHT = float(os.environ.get("ENROLL_DIVERSITY_WEIGHT", "0.3"))  # Weight of pose spread vs quality when picking frames
+ENROLL_DUPLICATE_SIM = float(os.environ.get("ENROLL_DUPLICATE_SIM", "0.95"))  # Picks this similar to an earlier pick are dropped
+
+# Gallery consolidation (cap embeddings per NIK)
+GALLERY_MAX_PER_NIK = int(os.environ.get("GALLERY_MAX_PER_NIK", "10"))  # Max stored embeddings per NIK (0 = no cap)
+GALLERY_KEEP_MEAN = os.environ.get("GALLERY_KEEP_MEAN", "0") == "1"  # Also keep a quality-weighted mean template per NIK
+GALLERY_CONSOLIDATE_ONLINE = os.environ.get("GALLERY_CONSOLIDATE_ONLINE", "1") == "1"  # Consolidate oversized NIKs in the background after enrollment
+
+# Multi-frame decision
+MULTI_FRAME_MODE = os.environ.get("MULTI_FRAME_MODE", "vote")  # "vote" = per-frame voting with early stop, "fusion" = one search on a fused template (embeds every frame)
+FUSION_CONSISTENCY = float(os.environ.get("FUSION_CONSISTENCY", "0.5"))  # Min similarity to the medoid frame to enter the fused template
+
+# Early decision policy for per-frame voting
+EARLY_STOP_POLICY = os.environ.get("EARLY_STOP_POLICY", "sprt")  # "sprt", "heuristic" or "none" (vote mode only; fusion embeds every frame)
+VOTE_CANDIDATES = 5  # Best identities per frame that get votes and feed the early-stop policy
+SPRT_ALPHA = float(os.environ.get("SPRT_ALPHA", "0.01"))  # Target false-accept rate of the sequential test
+SPRT_BETA = float(os.environ.get("SPRT_BETA", "0.05"))  # Target false-reject rate of the sequential test
+SPRT_LLR_CLIP = 2.5  # Max evidence per frame: no single frame can settle a decision
+SPRT_SAMPLE = 2000  # Max gallery embeddings used to fit the score distributions
+SPRT_GENUINE_STD_MIN = 0.10  # Floor of the genuine std: enrollment rows of one session are tighter than live queries
+SPRT_MIN_ACCEPTED = 50  # Accepted per-frame scores needed before they replace the gallery-fitted genuine distribution
+SPRT_DEFAULT_DISTRIBUTIONS = {'genuine_mean': 0.65, 'genuine_std': 0.10, 'impostor_mean': 0.20, 'impostor_std': 0.10}
+
+# Two-stage gallery search
+CENTROID_PREFILTER = os.environ.get("CENTROID_PREFILTER", "1") == "1"  # Score per-NIK centroids first (0 = exact scan)
+CENTROID_TOP_M = int(os.environ.get("CENTROID_TOP_M", "20"))  # Identities re-ranked exactly after the centroid pass
+CENTROID_MARGIN = float(os.environ.get("CENTROID_MARGIN", "0.05"))  # Also re-rank identities within this of the M-th centroid score
+
+# Gallery tiers (hot = in RAM, cold = memory-mapped segment scanned only on a miss)
+GALLERY_HOT_BUDGET_MB = float(os.environ.get("GALLERY_HOT_BUDGET_MB", "512"))  # RAM budget of the hot tier (0 = unlimited)
+GALLERY_HOT_DAYS = int(os.environ.get("GALLERY_HOT_DAYS", "365"))  # Identities not seen for longer are loaded cold (0 = age ignored)
+GALLERY_COLD_CHUNK = int(os.environ.get("GALLERY_COLD_CHUNK", "65536"))  # Rows per chunk when scanning the cold tier
+GALLERY_COLD_DIR = os.environ.get("GALLERY_COLD_DIR", "")  # Directory of the cold segment file (empty = system temp dir)
+GALLERY_COLD_TOP_K = 5  # Cold identities merged into the hot results on a miss
+GALLERY_HOT_FILL = 0.9  # Share of the budget filled on (re)load, headroom for promotions
+LAST_SEEN_FLUSH_SECONDS = float(os.environ.get("LAST_SEEN_FLUSH_SECONDS", "30"))  # Batch interval for writing last-seen times to SQLite
+
+# Site partitions (multi-clinic deployments)
+DEFAULT_SITE = os.environ.get("DEFAULT_SITE", "default")  # Site of enrollments that do not name one
+SITE_PARTITIONING = os.environ.get("SITE_PARTITIONING", "1") == "1"  # Search the request's site first, other sites only on a miss
+
+# Sharded search (worker processes, one shared-memory segment per shard)
+GALLERY_SHARDS = int(os.environ.get("GALLERY_SHARDS", "0"))  # Worker processes scanning the hot tier in parallel (0 = in-process search)
+GALLERY_SHARD_MIN_ROWS = int(os.environ.get("GALLERY_SHARD_MIN_ROWS", "200000"))  # Smaller galleries stay in-process (IPC costs more than it saves)
+
 # Global state
+_fallback_local = threading.local()  # Per-thread Haar cascade
 _engine_lock = threading.Lock()
 _face_app = None
-_embeddings_db = {}  # {nik: [embeddings]}
+_gallery = Gallery()  # Copy-on-write {nik: embeddings}; readers take _gallery.snapshot()
 _embeddings_loaded = False
+_embedding_total = 0  # Maintained counter (avoids COUNT(*) on every status call)
+_gallery_lock = threading.Lock()  # Serializes per-NIK DB + gallery edits (enrollment vs consolidation)
+_score_distributions = None  # (GalleryIndex, distributions) cache for SPRT
+_accepted_scores = deque(maxlen=SPRT_SAMPLE)  # Per-frame scores of accepted queries (genuine distribution)
+_early_stop_stats = {}  # policy -> decisions / frames counters
+_early_stop_lock = threading.Lock()
+_consolidation_queue = queue.Queue()
+_consolidation_pending = set()
+_consolidation_thread = None
+_cold_segment = None  # ColdSegment of identities not loaded into _gallery
+_tier_stats = {'cold_searches': 0, 'cold_hits': 0, 'promotions': 0, 'rebalances': 0}
+_tier_lock = threading.Lock()
+_rebalance_thread = None
+_last_seen_pending = {}  # nik -> ISO time of recognitions not yet written to identity_last_seen
+_last_seen_thread = None
+_site_stats = {}  # site -> local-first search counters
+_site_lock = threading.Lock()
+_shard_pool = None  # ShardPool, started by initialize() when GALLERY_SHARDS > 0
+_shard_lock = threading.Lock()
 
 
 def _get_face_app():
@@ -139,22 +235,41 @@ def init_embedding_db():
             timestamp TEXT NOT NULL
         )
     """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_templates (
+            nik INTEGER PRIMARY KEY,
+            embedding BLOB NOT NULL,
+            source_count INTEGER DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS identity_last_seen (
+            nik INTEGER PRIMARY KEY,
+            last_seen TEXT NOT NULL
+        )
+    """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(embeddings)")}
+    if "site" not in columns:
+        conn.execute("ALTER TABLE embeddings ADD COLUMN site TEXT")  # Older databases: NULL = DEFAULT_SITE
     conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_nik ON embeddings(nik)")
     conn.commit()
     conn.close()
     logger.info(f"Embedding database initialized at {EMBEDDING_DB_PATH}")
 
 
-def save_embedding(nik: int, embedding: np.ndarray, quality_score: float = 0.0) -> bool:
-    """Save embedding to database"""
+def save_embedding(nik: int, embedding: np.ndarray, quality_score: float = 0.0, site: Optional[str] = None) -> bool:
+    """Save embedding to database (an identity belongs to the site of its latest enrollment)"""
+    site = site or DEFAULT_SITE
     try:
         conn = sqlite3.connect(EMBEDDING_DB_PATH)
         normalized = _normalize_embedding(embedding)
         blob = normalized.astype(np.float32).tobytes()
         conn.execute(
-            "INSERT INTO embeddings (nik, embedding, created_at, quality_score) VALUES (?, ?, ?, ?)",
-            (nik, blob, datetime.now().isoformat(), quality_score)
+            "INSERT INTO embeddings (nik, embedding, created_at, quality_score, site) VALUES (?, ?, ?, ?, ?)",
+            (nik, blob, datetime.now().isoformat(), quality_score, site)
         )
+        conn.execute("UPDATE embeddings SET site = ? WHERE nik = ? AND (site IS NULL OR site != ?)", (site, nik, site))
         conn.commit()
         conn.close()
         return True
@@ -163,50 +278,107 @@ def save_embedding(nik: int, embedding: np.ndarray, quality_score: float = 0.0)
         return False
 
 
-def load_all_embeddings() -> Dict[int, List[np.ndarray]]:
-    """Load all embeddings from database into memory"""
-    global _embeddings_db, _embeddings_loaded
+def _pad_index_embeddings(nik: int, embs, min_embeddings: int) -> List[np.ndarray]:
+    """
+    Pad a sparse NIK with slightly noisy copies of its real embeddings.
+    Index-time only: the copies live in the in-memory gallery and are never
+    persisted. Returns a new list (embs itself is not modified).
+    """
+    padded = list(embs or ())
+    if not padded or len(padded) >= min_embeddings:
+        return padded
+    rng = np.random.default_rng(nik)  # Deterministic per NIK so reloads build the same index
+    real = list(padded)
+    for i in range(min_embeddings - len(real)):
+        base_emb = real[i % len(real)]
+        noise = rng.normal(0, 0.01, base_emb.shape)
+        padded.append(_normalize_embedding(base_emb + noise).astype(np.float32))
+    return padded
+
+
+def load_all_embeddings() -> GallerySnapshot:
+    """
+    Load all embeddings from database (publishes a new gallery snapshot).
+    Identities seen within GALLERY_HOT_DAYS, most recent first, fill the
+    in-memory gallery up to GALLERY_HOT_BUDGET_MB; the rest are streamed
+    into a memory-mapped cold segment.
+    """
+    global _embeddings_loaded, _embedding_total, _cold_segment
     try:
         if not os.path.exists(EMBEDDING_DB_PATH):
             init_embedding_db()
             _embeddings_loaded = True
-            return {}
-
-        conn = sqlite3.connect(EMBEDDING_DB_PATH)
-        cursor = conn.execute("SELECT nik, embedding FROM embeddings ORDER BY quality_score DESC")
-
-        _embeddings_db = {}
-        count = 0
-        for row in cursor:
-            nik = int(row[0])
-            emb = np.frombuffer(row[1], dtype=np.float32)
-            if nik not in _embeddings_db:
-                _embeddings_db[nik] = []
-            _embeddings_db[nik].append(emb)
-            count += 1
-
-        conn.close()
+            return _gallery.snapshot()
+
+        with _gallery_lock:
+            conn = sqlite3.connect(EMBEDDING_DB_PATH)
+            try:
+                # Consolidated mean templates are scanned like any other embedding
+                templates = {}
+                try:
+                    templates = {int(nik): np.frombuffer(blob, dtype=np.float32)
+                                 for nik, blob in conn.execute("SELECT nik, embedding FROM embedding_templates")}
+                except sqlite3.OperationalError:
+                    pass  # Older database without the templates table
+
+                _flush_identity_seen_locked(conn)
+                counts, hot = _plan_hot_tier(conn, templates)
+                cold_rows = sum(n for nik, n in counts.items() if nik not in hot)
+                writer = _new_cold_writer(cold_rows) if cold_rows else None
+
+                db, sites = {}, {}
+                count = 0
+                cursor = conn.execute("SELECT nik, embedding, site FROM embeddings ORDER BY nik, quality_score DESC")
+                for nik, rows in itertools.groupby(cursor, key=lambda r: int(r[0])):
+                    rows = list(rows)
+                    embs = [np.frombuffer(r[1], dtype=np.float32) for r in rows]
+                    count += len(embs)
+                    if nik in templates:
+                        embs.append(templates[nik])
+                    if nik in hot:
+                        db[nik] = _pad_index_embeddings(nik, embs, EMBEDDING_INDEX_MIN) if EMBEDDING_INDEX_PADDING else embs
+                        sites[nik] = rows[0][2] or DEFAULT_SITE
+                    else:
+                        writer.append(nik, embs)
+            finally:
+                conn.close()
+
+            snapshot = _gallery.replace_all(db, sites)
+            old_cold, _cold_segment = _cold_segment, (writer.close() if writer is not None else None)
+            _embedding_total = count
+        if old_cold is not None:
+            old_cold.close()
         _embeddings_loaded = True
-        logger.info(f"Loaded {count} embeddings for {len(_embeddings_db)} unique NIKs")
-        return _embeddings_db
+        _sync_shards(snapshot)
+        cold_niks = len(_cold_segment) if _cold_segment is not None else 0
+        logger.info(f"Loaded {count} embeddings for {len(snapshot) + cold_niks} unique NIKs ({cold_niks} cold)")
+        return snapshot
     except Exception as e:
         logger.error(f"Failed to load embeddings: {e}")
         _embeddings_loaded = True
-        return {}
+        return _gallery.snapshot()
 
 
 def delete_embeddings_for_nik(nik: int) -> int:
     """Delete all embeddings for a given NIK"""
-    global _embeddings_db
+    global _embedding_total
     try:
-        conn = sqlite3.connect(EMBEDDING_DB_PATH)
-        cursor = conn.execute("DELETE FROM embeddings WHERE nik = ?", (nik,))
-        deleted = cursor.rowcount
-        conn.commit()
-        conn.close()
-
-        if nik in _embeddings_db:
-            del _embeddings_db[nik]
+        with _gallery_lock:
+            conn = sqlite3.connect(EMBEDDING_DB_PATH)
+            cursor = conn.execute("DELETE FROM embeddings WHERE nik = ?", (nik,))
+            deleted = cursor.rowcount
+            conn.execute("DELETE FROM embedding_templates WHERE nik = ?", (nik,))
+            conn.execute("DELETE FROM identity_last_seen WHERE nik = ?", (nik,))
+            conn.commit()
+            conn.close()
+            with _tier_lock:
+                _last_seen_pending.pop(nik, None)
+
+            _gallery.remove(nik)
+            if _cold_segment is not None:
+                _cold_segment.kill(nik)
+            _embedding_total = max(0, _embedding_total - deleted)
+        invalidate_recent_identity(nik)
 
         logger.info(f"Deleted {deleted} embeddings for NIK {nik}")
         return deleted
@@ -217,19 +389,37 @@ def delete_embeddings_for_nik(nik: int) -> int:
 
 def update_nik_in_embeddings(old_nik: int, new_nik: int) -> int:
     """Update NIK in embeddings database"""
-    global _embeddings_db
     try:
-        conn = sqlite3.connect(EMBEDDING_DB_PATH)
-        cursor = conn.execute(
-            "UPDATE embeddings SET nik = ? WHERE nik = ?",
-            (new_nik, old_nik)
-        )
-        updated = cursor.rowcount
-        conn.commit()
-        conn.close()
-
-        if old_nik in _embeddings_db:
-            _embeddings_db[new_nik] = _embeddings_db.pop(old_nik)
+        with _gallery_lock:
+            conn = sqlite3.connect(EMBEDDING_DB_PATH)
+            cursor = conn.execute(
+                "UPDATE embeddings SET nik = ? WHERE nik = ?",
+                (new_nik, old_nik)
+            )
+            updated = cursor.rowcount
+            conn.execute("DELETE FROM embedding_templates WHERE nik = ?", (new_nik,))
+            conn.execute("UPDATE embedding_templates SET nik = ? WHERE nik = ?", (new_nik, old_nik))
+            conn.execute("DELETE FROM identity_last_seen WHERE nik = ?", (new_nik,))
+            conn.execute("UPDATE identity_last_seen SET nik = ? WHERE nik = ?", (new_nik, old_nik))
+            conn.commit()
+            conn.close()
+            with _tier_lock:
+                _last_seen_pending.pop(new_nik, None)
+                if old_nik in _last_seen_pending:
+                    _last_seen_pending[new_nik] = _last_seen_pending.pop(old_nik)
+
+            cold = _cold_segment
+            if cold is not None and (old_nik in cold or new_nik in cold):
+                # Renamed identity is loaded hot from the database
+                cold.kill(old_nik)
+                cold.kill(new_nik)
+                _gallery.remove(old_nik)
+                embs, site = _read_identity_embeddings(new_nik)
+                _gallery.set(new_nik, embs, site)
+            else:
+                _gallery.rename(old_nik, new_nik)
+        invalidate_recent_identity(old_nik)
+        invalidate_recent_identity(new_nik)
 
         logger.info(f"Updated {updated} embeddings from NIK {old_nik} to {new_nik}")
         return updated
@@ -270,14 +460,118 @@ def get_unique_nik_count() -> int:
 
 # ====== FACE DETECTION ======
 
-def detect_faces(img_bgr: np.ndarray, detection_threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+def estimate_pose(landmarks) -> Optional[Tuple[float, float]]:
+    """
+    Cheap head-pose estimate from the detector's 5 keypoints
+    (left eye, right eye, nose, left mouth, right mouth).
+    Returns (yaw, roll) in degrees, or None without landmarks.
+
+    roll: angle of the eye line.
+    yaw: horizontal nose offset from the eye midpoint (in the roll-corrected
+    frame) relative to half the inter-ocular distance, mapped through asin.
+    """
+    if landmarks is None or len(landmarks) < 3:
+        return None
+    kps = np.asarray(landmarks, dtype=np.float64)
+    left_eye, right_eye, nose = kps[0], kps[1], kps[2]
+    eye_vec = right_eye - left_eye
+    eye_dist = float(np.hypot(eye_vec[0], eye_vec[1]))
+    if eye_dist < 1e-6:
+        return None
+    roll = float(np.degrees(np.arctan2(eye_vec[1], eye_vec[0])))
+
+    # Project the nose offset onto the eye line direction (removes roll)
+    mid = (left_eye + right_eye) / 2.0
+    offset = float(np.dot(nose - mid, eye_vec / eye_dist)) / (eye_dist / 2.0)
+    yaw = float(np.degrees(np.arcsin(np.clip(offset, -1.0, 1.0))))
+    return yaw, roll
+
+
+def pose_quality(pose: Optional[Tuple[float, float]]) -> float:
+    """1.0 for a frontal face, 0.0 at the POSE_MAX_YAW / POSE_MAX_ROLL limits"""
+    if pose is None:
+        return 1.0  # Unknown (Haar fallback): do not penalize
+    yaw, roll = pose
+    worst = max(abs(yaw) / max(POSE_MAX_YAW, 1e-6), abs(roll) / max(POSE_MAX_ROLL, 1e-6))
+    return float(max(0.0, 1.0 - worst))
+
+
+def _pose_within_limits(pose: Optional[Tuple[float, float]]) -> bool:
+    if pose is None:
+        return True
+    return abs(pose[0]) <= POSE_MAX_YAW and abs(pose[1]) <= POSE_MAX_ROLL
+
+
+def _build_faces(
+    app,
+    img_bgr: np.ndarray,
+    bboxes: np.ndarray,
+    kpss: Optional[np.ndarray],
+    detection_threshold: float,
+    tasks: Optional[Tuple[str, ...]] = None,
+    check_pose: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Turn raw detector output into face dicts, running the other InsightFace
+    models (recognition, attributes) per face, as FaceAnalysis.get() does.
+    tasks limits which models run (None = all). With check_pose, faces beyond
+    the pose limits keep embedding None so ArcFace is never run on them.
+    """
+    from insightface.app.common import Face
+
+    results = []
+    for i in range(bboxes.shape[0]):
+        det_score = float(bboxes[i, 4])
+        if det_score < detection_threshold:
+            continue
+        face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=det_score)
+        bbox = face.bbox.astype(int).tolist()
+
+        # Filter small faces
+        if bbox[2] - bbox[0] < MIN_FACE_SIZE or bbox[3] - bbox[1] < MIN_FACE_SIZE:
+            continue
+
+        pose = estimate_pose(face.kps)
+        pose_ok = _pose_within_limits(pose)
+        if pose_ok or not check_pose:
+            for taskname, model in app.models.items():
+                if taskname == 'detection' or (tasks is not None and taskname not in tasks):
+                    continue
+                model.get(img_bgr, face)
+
+        results.append({
+            'bbox': bbox,
+            'landmarks': face.kps.tolist() if face.kps is not None else None,
+            'det_score': det_score,
+            'embedding': _normalize_embedding(face.embedding) if getattr(face, 'embedding', None) is not None else None,
+            'age': getattr(face, 'age', None),
+            'gender': getattr(face, 'gender', None),
+            'pose': pose,
+            'pose_ok': pose_ok
+        })
+
+    # Sort by face size (largest first)
+    results.sort(key=lambda x: (x['bbox'][2]-x['bbox'][0]) * (x['bbox'][3]-x['bbox'][1]), reverse=True)
+    return results
+
+
+def detect_faces(
+    img_bgr: np.ndarray,
+    detection_threshold: Optional[float] = None,
+    check_pose: bool = False,
+    embed: bool = True
+) -> List[Dict[str, Any]]:
     """
     Detect faces in image using InsightFace RetinaFace.
-    Returns list of face dictionaries with bbox, landmarks, det_score, embedding.
+    Returns list of face dictionaries with bbox, landmarks, det_score, embedding, pose.
 
     Args:
         img_bgr: BGR image array
         detection_threshold: Optional custom detection threshold (defaults to DETECTION_THRESHOLD)
+        check_pose: Skip embedding for faces beyond POSE_MAX_YAW / POSE_MAX_ROLL
+            (they are returned with pose_ok=False and embedding None)
+        embed: False = detection only, no recognition/attribute models
+            (embed later with embed_face())
     """
     if detection_threshold is None:
         detection_threshold = DETECTION_THRESHOLD
@@ -287,75 +581,132 @@ def detect_faces(img_bgr: np.ndarray, detection_threshold: Optional[float] = Non
         return _detect_faces_fallback(img_bgr)
 
     try:
-        faces = app.get(img_bgr)
-        results = []
-        for face in faces:
-            if face.det_score < detection_threshold:
-                continue
-
-            bbox = face.bbox.astype(int).tolist()
-            w = bbox[2] - bbox[0]
-            h = bbox[3] - bbox[1]
-
-            # Filter small faces
-            if w < MIN_FACE_SIZE or h < MIN_FACE_SIZE:
-                continue
-
-            results.append({
-                'bbox': bbox,
-                'landmarks': face.kps.tolist() if getattr(face, 'kps', None) is not None else None,
-                'det_score': float(face.det_score),
-                'embedding': _normalize_embedding(face.embedding) if getattr(face, 'embedding', None) is not None else None,
-                'age': getattr(face, 'age', None),
-                'gender': getattr(face, 'gender', None)
-            })
-
-        # Sort by face size (largest first)
-        results.sort(key=lambda x: (x['bbox'][2]-x['bbox'][0]) * (x['bbox'][3]-x['bbox'][1]), reverse=True)
-        return results
+        bboxes, kpss = app.det_model.detect(img_bgr, max_num=0, metric='default')
+        return _build_faces(app, img_bgr, bboxes, kpss, detection_threshold,
+                            tasks=None if embed else (), check_pose=check_pose)
     except Exception as e:
         logger.error(f"Face detection failed: {e}")
         return _detect_faces_fallback(img_bgr)
 
 
+def _get_fallback_detector():
+    """Haar cascade cached per thread (CascadeClassifier is not thread-safe)"""
+    detector = getattr(_fallback_local, 'detector', None)
+    if detector is None:
+        cascade_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+        detector = cv2.CascadeClassifier(cascade_path)
+        _fallback_local.detector = detector
+    return detector
+
+
 def _detect_faces_fallback(img_bgr: np.ndarray) -> List[Dict[str, Any]]:
     """Fallback face detection using Haar Cascade when InsightFace is unavailable"""
     try:
-        cascade_path = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
-        detector = cv2.CascadeClassifier(cascade_path)
+        detector = _get_fallback_detector()
 
         gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-        faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(MIN_FACE_SIZE, MIN_FACE_SIZE))
+        # Detect on a downscaled copy, then map boxes back to full resolution
+        scale = 1.0
+        h_img, w_img = gray.shape[:2]
+        if DETECT_MAX_WIDTH > 0 and w_img > DETECT_MAX_WIDTH:
+            scale = w_img / float(DETECT_MAX_WIDTH)
+            gray = cv2.resize(gray, (DETECT_MAX_WIDTH, int(round(h_img / scale))), interpolation=cv2.INTER_AREA)
+        min_size = max(20, int(round(MIN_FACE_SIZE / scale)))
+        faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
 
         results = []
-        for (x, y, w, h) in faces:
+        for rect in faces:
+            x, y, w, h = (int(round(v * scale)) for v in rect)
             results.append({
                 'bbox': [x, y, x+w, y+h],
                 'landmarks': None,
                 'det_score': 0.9,  # Haar doesn't give confidence
                 'embedding': None,
                 'age': None,
-                'gender': None
+                'gender': None,
+                'pose': None,
+                'pose_ok': True
             })
 
+        results.sort(key=lambda x: (x['bbox'][2]-x['bbox'][0]) * (x['bbox'][3]-x['bbox'][1]), reverse=True)
         return results
     except Exception as e:
         logger.error(f"Fallback detection failed: {e}")
         return []
 
 
-def detect_largest_face(img_bgr: np.ndarray, detection_threshold: Optional[float] = None) -> Optional[Dict[str, Any]]:
+def _detect_faces_in_region(
+    img_bgr: np.ndarray,
+    region: Tuple[int, int, int, int],
+    detection_threshold: float,
+    check_pose: bool = False,
+    embed: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Detect faces inside region (x0, y0, x1, y1) only; boxes and landmarks are
+    returned in full-frame coordinates.
+
+    With InsightFace the crop is fed to the detector at TRACK_DET_SIZE and only
+    the recognition model runs on the result (no landmark/attribute heads).
+    """
+    x0, y0, x1, y1 = region
+    crop = np.ascontiguousarray(img_bgr[y0:y1, x0:x1])
+
+    app = _get_face_app()
+    if app is None:
+        faces = _detect_faces_fallback(crop)
+    else:
+        size = max(32, TRACK_DET_SIZE // 32 * 32)
+        bboxes, kpss = app.det_model.detect(crop, input_size=(size, size))
+        faces = _build_faces(app, crop, bboxes, kpss, detection_threshold,
+                             tasks=('recognition',) if embed else (), check_pose=check_pose)
+
+    for face in faces:
+        b = face['bbox']
+        face['bbox'] = [b[0] + x0, b[1] + y0, b[2] + x0, b[3] + y0]
+        if face['landmarks'] is not None:
+            face['landmarks'] = [[p[0] + x0, p[1] + y0] for p in face['landmarks']]
+    return faces
+
+
+def detect_largest_face(
+    img_bgr: np.ndarray,
+    detection_threshold: Optional[float] = None,
+    tracker: Optional[FaceTracker] = None,
+    check_pose: bool = False,
+    embed: bool = True
+) -> Optional[Dict[str, Any]]:
     """
     Detect and return the largest face in the image.
 
     Args:
         img_bgr: BGR image array
         detection_threshold: Optional custom detection threshold (defaults to DETECTION_THRESHOLD)
+        tracker: Optional per-request FaceTracker; while it holds a track only
+            the predicted ROI is searched, with full-frame detection as fallback
+        check_pose: Do not embed faces beyond the pose limits (see detect_faces)
+        embed: False = detection only (see detect_faces)
     """
-    faces = detect_faces(img_bgr, detection_threshold=detection_threshold)
-    if not faces:
-        return None
-    return faces[0]  # Already sorted by size
+    face = None
+    region = tracker.search_region(img_bgr.shape) if tracker is not None else None
+    if region is not None:
+        try:
+            threshold = DETECTION_THRESHOLD if detection_threshold is None else detection_threshold
+            faces = _detect_faces_in_region(img_bgr, region, threshold, check_pose=check_pose, embed=embed)
+            face = faces[0] if faces else None
+        except Exception as e:
+            logger.warning(f"ROI detection failed, using full frame: {e}")
+    full_frame = face is None
+    if face is None:
+        faces = detect_faces(img_bgr, detection_threshold=detection_threshold, check_pose=check_pose, embed=embed)
+        face = faces[0] if faces else None  # Already sorted by size
+    if tracker is not None:
+        box = None
+        if face is not None:
+            b = face['bbox']
+            box = (b[0], b[1], b[2] - b[0], b[3] - b[1])
+        tracker.update(box, full_frame)
+    return face
 
 
 # ====== IMAGE QUALITY ASSESSMENT ======
@@ -372,14 +723,20 @@ def calculate_quality_score(face_dict: Dict[str, Any], img_bgr: np.ndarray) -> f
 
     # Detection confidence
     det_score = face_dict.get('det_score', 0.0)
-    score += det_score * 0.4
+    score += det_score * 0.3
 
     # Face size score
     bbox = face_dict.get('bbox', [0, 0, 0, 0])
     face_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
     img_area = img_bgr.shape[0] * img_bgr.shape[1]
     size_ratio = min(face_area / img_area, 0.5) / 0.5  # Normalize to 0-1
-    score += size_ratio * 0.3
+    score += size_ratio * 0.25
+
+    # Pose score (frontal = 1, at the yaw/roll limits = 0)
+    pose = face_dict.get('pose')
+    if pose is None and face_dict.get('landmarks') is not None:
+        pose = estimate_pose(face_dict['landmarks'])
+    score += pose_quality(pose) * 0.2
 
     # Sharpness score
     x1, y1, x2, y2 = bbox
@@ -388,7 +745,7 @@ def calculate_quality_score(face_dict: Dict[str, Any], img_bgr: np.ndarray) -> f
         gray = cv2.cvtColor(face_region, cv2.COLOR_BGR2GRAY) if len(face_region.shape) == 3 else face_region
         laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
         sharpness_score = min(laplacian_var / 500.0, 1.0)  # Normalize
-        score += sharpness_score * 0.3
+        score += sharpness_score * 0.25
 
     return min(score, 1.0)
 
@@ -429,6 +786,126 @@ def align_face(img_bgr: np.ndarray, landmarks: Optional[List[List[float]]] = Non
         return img_bgr
 
 
+# ====== RECENT IDENTITY CACHE ======
+
+class RecentIdentityCache:
+    """
+    LRU cache (with TTL) of recently recognized identities for one kiosk.
+    Holds a copy of each identity's embeddings so repeat visitors can be
+    matched without scanning the full gallery.
+    """
+
+    def __init__(self, max_size: int = RECENT_CACHE_SIZE, ttl: float = RECENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # nik -> (expires_at, embeddings matrix)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, nik: int, embeddings: List[np.ndarray]):
+        """Add or refresh an identity (most recently used goes last)"""
+        if self.max_size <= 0 or not embeddings:
+            return
+        matrix = np.vstack(embeddings).astype(np.float32)
+        with self._lock:
+            self._entries[nik] = (time.monotonic() + self.ttl, matrix)
+            self._entries.move_to_end(nik)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def lookup(self, query_embedding: np.ndarray, min_similarity: float) -> Optional[Tuple[int, float]]:
+        """
+        Return (nik, similarity) of the best cached identity if it reaches
+        min_similarity, otherwise None.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for nik in [n for n, (expires_at, _) in self._entries.items() if expires_at < now]:
+                del self._entries[nik]
+            entries = list(self._entries.items())
+
+        best_nik, best_sim = None, -1.0
+        for nik, (_, matrix) in entries:
+            sim = float(np.max(matrix @ query_embedding))
+            if sim > best_sim:
+                best_nik, best_sim = nik, sim
+
+        with self._lock:
+            if best_nik is not None and best_sim >= min_similarity:
+                self.hits += 1
+                if best_nik in self._entries:
+                    self._entries.move_to_end(best_nik)
+                return best_nik, best_sim
+            self.misses += 1
+        return None
+
+    def invalidate(self, nik: int):
+        """Drop an identity whose embeddings changed or were removed"""
+        with self._lock:
+            self._entries.pop(nik, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0
+            }
+
+
+_recent_caches = OrderedDict()  # kiosk_id -> RecentIdentityCache, least recently used first
+_recent_caches_lock = threading.Lock()
+
+
+def get_recent_cache(kiosk_id: Optional[str] = None) -> RecentIdentityCache:
+    """
+    Get (or create) the recent identity cache for a kiosk. kiosk_id comes
+    from the client, so ids outside RECENT_CACHE_KIOSKS (when set) share
+    the "default" cache, and at most RECENT_CACHE_MAX_KIOSKS caches are
+    kept (least recently used dropped).
+    """
+    key = kiosk_id or "default"
+    if RECENT_CACHE_KIOSKS and key not in RECENT_CACHE_KIOSKS:
+        key = "default"
+    with _recent_caches_lock:
+        cache = _recent_caches.get(key)
+        if cache is None:
+            cache = RecentIdentityCache()
+            _recent_caches[key] = cache
+            while len(_recent_caches) > max(1, RECENT_CACHE_MAX_KIOSKS):
+                _recent_caches.popitem(last=False)
+        else:
+            _recent_caches.move_to_end(key)
+        return cache
+
+
+def invalidate_recent_identity(nik: int):
+    """Remove a NIK from every kiosk cache"""
+    with _recent_caches_lock:
+        caches = list(_recent_caches.values())
+    for cache in caches:
+        cache.invalidate(nik)
+
+
+def get_recent_cache_stats() -> Dict[str, Any]:
+    """Aggregate and per-kiosk hit rates of the recent identity caches"""
+    with _recent_caches_lock:
+        items = list(_recent_caches.items())
+    per_kiosk = {kiosk: cache.stats() for kiosk, cache in items}
+    hits = sum(s['hits'] for s in per_kiosk.values())
+    misses = sum(s['misses'] for s in per_kiosk.values())
+    return {
+        'enabled': RECENT_CACHE_SIZE > 0,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': (hits / (hits + misses)) if (hits + misses) else 0.0,
+        'kiosks': per_kiosk
+    }
+
+
 # ====== FACE RECOGNITION ======
 
 def get_embedding(img_bgr: np.ndarray, face_dict: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
@@ -462,38 +939,98 @@ def get_embedding(img_bgr: np.ndarray, face_dict: Optional[Dict[str, Any]] = Non
         return None
 
 
+# ====== GALLERY INDEX ======
+
+def get_gallery_index() -> GalleryIndex:
+    """GalleryIndex of the current snapshot (built lazily, once per version)"""
+    return _gallery.snapshot().index
+
+
+def _gallery_matches(
+    query_embedding: np.ndarray,
+    threshold: float,
+    prefilter: Optional[bool] = None,
+    snapshot: Optional[GallerySnapshot] = None,
+    cold_threshold: Optional[float] = None,
+    site: Optional[str] = None,
+    top_k: Optional[int] = None
+) -> List[Tuple[int, float]]:
+    """
+    Identities with max similarity >= threshold, highest first (current
+    snapshot by default). With GALLERY_SHARDS the hot tier is searched by
+    the shard workers (exact, top_k per shard, CENTROID_TOP_M when unset).
+    A miss means no match >= cold_threshold (defaults to threshold):
+    - with site (and SITE_PARTITIONING), that site's partition is searched
+      first and the other partitions only on a miss
+    - on a miss of the whole hot tier, the cold tier is scanned and its
+      best identities are merged in
+    """
+    if prefilter is None:
+        prefilter = CENTROID_PREFILTER
+    snapshot = snapshot or _gallery.snapshot()
+    query = np.asarray(query_embedding, dtype=np.float32)
+    miss_at = threshold if cold_threshold is None else cold_threshold
+    pool = _get_shard_pool(snapshot)
+
+    def search(part=None, exclude=False):
+        if pool is not None:
+            found = pool.search(snapshot, query, threshold, top_k or CENTROID_TOP_M, part, exclude)
+            if found is not None:
+                return found
+        if prefilter:
+            scores = snapshot.index.prefiltered_scores(query, CENTROID_TOP_M, CENTROID_MARGIN, part, exclude)
+        else:
+            scores = snapshot.index.exact_scores(query, part, exclude, top_k)
+        found = [(nik, sim) for nik, sim in scores if sim >= threshold]
+        found.sort(key=lambda x: x[1], reverse=True)
+        return found[:top_k] if top_k else found
+
+    if site is None or not SITE_PARTITIONING:
+        matches = search()
+    else:
+        matches = search(site)
+        outcome = 'local_hits'
+        if not matches or matches[0][1] < miss_at:
+            others = search(site, exclude=True)
+            outcome = 'fanout_hits' if others and others[0][1] >= miss_at else 'misses'
+            matches = sorted(matches + others, key=lambda x: x[1], reverse=True)
+        _record_site_search(site, outcome)
+
+    cold = _cold_segment
+    if cold is not None and len(cold) and (not matches or matches[0][1] < miss_at):
+        cold_matches = _search_cold(cold, query, threshold, miss_at)
+        if cold_matches:
+            hot_niks = {nik for nik, _ in matches}
+            matches += [(nik, sim) for nik, sim in cold_matches if nik not in hot_niks]
+            matches.sort(key=lambda x: x[1], reverse=True)
+    return matches[:top_k] if top_k else matches
+
+
 def find_matching_identity(
     query_embedding: np.ndarray,
     threshold: float = None,
-    top_k: int = 5
+    top_k: int = 5,
+    prefilter: Optional[bool] = None,
+    site: Optional[str] = None
 ) -> List[Tuple[int, float]]:
     """
     Find matching identity from database.
     Returns list of (nik, similarity) tuples sorted by similarity.
-    """
-    global _embeddings_db, _embeddings_loaded
 
+    prefilter: two-stage centroid search (defaults to CENTROID_PREFILTER);
+    False = exact scan over every embedding.
+    site: search this site's partition first (None = whole gallery).
+    """
     if threshold is None:
         threshold = RECOGNITION_THRESHOLD
 
     if not _embeddings_loaded:
         load_all_embeddings()
 
-    if not _embeddings_db:
+    if _gallery_empty():
         return []
 
-    matches = []
-    for nik, embeddings in _embeddings_db.items():
-        # Calculate similarity with all embeddings for this NIK
-        similarities = [_cosine_similarity(query_embedding, emb) for emb in embeddings]
-        max_sim = max(similarities) if similarities else 0.0
-
-        if max_sim >= threshold:
-            matches.append((nik, max_sim))
-
-    # Sort by similarity (highest first)
-    matches.sort(key=lambda x: x[1], reverse=True)
-    return matches[:top_k]
+    return _gallery_matches(query_embedding, threshold, prefilter, site=site, top_k=top_k)[:top_k]
 
 
 def recognize_face_in_image(
@@ -522,68 +1059,575 @@ def recognize_face_in_image(
     return None
 
 
+def _iter_frame_embeddings(frames: List[np.ndarray], stats: Dict[str, int]):
+    """
+    Yield (embedding, quality) for each usable frame, lazily so voting can
+    stop early. Frames without a face, with an extreme pose or blurry are
+    skipped; stats collects the detection counters for logging.
+    """
+    tracker = FaceTracker()
+    try:
+        for frame in frames:
+            face = detect_largest_face(frame, tracker=tracker, check_pose=True)
+            if face is None:
+                continue
+            if not face.get('pose_ok', True):
+                stats['pose_skipped'] += 1
+                continue  # Turned / tilted face: no ArcFace, no vote
+
+            # Check quality
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if len(frame.shape) == 3 else frame
+            bbox = face.get('bbox', [0, 0, 0, 0])
+            face_gray = gray[bbox[1]:bbox[3], bbox[0]:bbox[2]]
+            if face_gray.size > 0 and is_blurry(face_gray, 50.0):
+                continue
+
+            embedding = face.get('embedding')
+            if embedding is None:
+                embedding = get_embedding(frame, face)
+                if embedding is None:
+                    continue
+
+            yield embedding, calculate_quality_score(face, frame)
+    finally:
+        logger.debug(f"Detection: {tracker.full_detections} full-frame, {tracker.roi_detections} ROI, "
+                     f"{tracker.lost} lost, {stats['pose_skipped']} skipped for pose")
+
+
+def fuse_embeddings(embeddings: List[np.ndarray], qualities: List[float]) -> Optional[Tuple[np.ndarray, List[int]]]:
+    """
+    Aggregate frame embeddings into one query template.
+
+    Outliers are rejected against the medoid frame (similarity below
+    FUSION_CONSISTENCY); the rest are averaged with quality weights.
+    Returns (template, kept indices), or None when too few frames agree
+    (fewer than MIN_VALID_FRAMES or less than VOTE_MIN_SHARE of the frames).
+    """
+    if not embeddings:
+        return None
+    embs = np.stack([np.asarray(e, dtype=np.float32) for e in embeddings])
+    sims = embs @ embs.T
+    medoid = int(np.argmax(sims.sum(axis=1)))
+    kept = np.flatnonzero(sims[medoid] >= FUSION_CONSISTENCY).tolist()
+    if len(kept) < MIN_VALID_FRAMES or len(kept) / len(embeddings) < VOTE_MIN_SHARE:
+        return None
+    weights = np.maximum(np.asarray(qualities, dtype=np.float64)[kept], 1e-3)
+    template = _normalize_embedding((embs[kept] * weights[:, None]).sum(axis=0)).astype(np.float32)
+    return template, kept
+
+
+# ====== GALLERY TIERS ======
+
+def _gallery_empty() -> bool:
+    return not _gallery.snapshot() and (_cold_segment is None or len(_cold_segment) == 0)
+
+
+def _plan_hot_tier(conn: sqlite3.Connection, templates: Dict[int, np.ndarray]) -> Tuple[Dict[int, int], set]:
+    """
+    Rows per NIK and the NIKs to keep in RAM: most recently seen first
+    (last recognition, or latest enrollment), within GALLERY_HOT_DAYS,
+    until GALLERY_HOT_FILL of GALLERY_HOT_BUDGET_MB is used.
+    """
+    counts, seen = {}, {}
+    for nik, n, created in conn.execute("SELECT nik, COUNT(*), MAX(created_at) FROM embeddings GROUP BY nik"):
+        counts[int(nik)] = n + (1 if int(nik) in templates else 0)
+        seen[int(nik)] = created or ""
+    try:
+        for nik, last_seen in conn.execute("SELECT nik, last_seen FROM identity_last_seen"):
+            if int(nik) in seen:
+                seen[int(nik)] = max(seen[int(nik)], last_seen)
+    except sqlite3.OperationalError:
+        pass  # Older database without the last-seen table
+
+    cutoff = (datetime.now() - timedelta(days=GALLERY_HOT_DAYS)).isoformat() if GALLERY_HOT_DAYS > 0 else ""
+    budget_rows = GALLERY_HOT_FILL * GALLERY_HOT_BUDGET_MB * 1024 * 1024 / (EMBEDDING_DIM * 4)
+    hot, rows = set(), 0
+    for nik in sorted(seen, key=seen.get, reverse=True):
+        if seen[nik] < cutoff:
+            break
+        n = max(counts[nik], EMBEDDING_INDEX_MIN) if EMBEDDING_INDEX_PADDING else counts[nik]
+        if GALLERY_HOT_BUDGET_MB > 0 and rows + n > budget_rows:
+            break
+        hot.add(nik)
+        rows += n
+    return counts, hot
+
+
+def _new_cold_writer(rows: int) -> ColdSegmentWriter:
+    fd, path = tempfile.mkstemp(prefix="gallery_cold_", suffix=".npy", dir=GALLERY_COLD_DIR or None)
+    os.close(fd)
+    return ColdSegmentWriter(path, rows, EMBEDDING_DIM)
+
+
+def _read_identity_embeddings(nik: int) -> Tuple[List[np.ndarray], str]:
+    """One NIK's embeddings (+ template, + index padding) and site, straight from the database"""
+    conn = sqlite3.connect(EMBEDDING_DB_PATH)
+    try:
+        rows = conn.execute(
+            "SELECT embedding, site FROM embeddings WHERE nik = ? ORDER BY quality_score DESC", (nik,)).fetchall()
+        row = conn.execute("SELECT embedding FROM embedding_templates WHERE nik = ?", (nik,)).fetchone()
+    finally:
+        conn.close()
+    embs = [np.frombuffer(r[0], dtype=np.float32) for r in rows]
+    site = (rows[0][1] if rows else None) or DEFAULT_SITE
+    if embs and row is not None:
+        embs.append(np.frombuffer(row[0], dtype=np.float32))
+    if EMBEDDING_INDEX_PADDING:
+        embs = _pad_index_embeddings(nik, embs, EMBEDDING_INDEX_MIN)
+    return embs, site
+
+
+def _search_cold(cold: ColdSegment, query: np.ndarray, threshold: float, hit_at: float) -> List[Tuple[int, float]]:
+    matches = [(nik, sim) for nik, sim in cold.search(query, GALLERY_COLD_TOP_K, GALLERY_COLD_CHUNK) if sim >= threshold]
+    with _tier_lock:
+        _tier_stats['cold_searches'] += 1
+        if matches and matches[0][1] >= hit_at:
+            _tier_stats['cold_hits'] += 1
+    return matches
+
+
+def record_identity_seen(nik: int):
+    """
+    Note the last successful recognition time of nik (drives hot/cold
+    placement). In memory only: the request thread never writes SQLite; a
+    background thread flushes the pending times every LAST_SEEN_FLUSH_SECONDS
+    in one transaction, and every reload flushes before planning the tiers.
+    """
+    global _last_seen_thread
+    with _tier_lock:
+        _last_seen_pending[nik] = datetime.now().isoformat()
+        if _last_seen_thread is None or not _last_seen_thread.is_alive():
+            _last_seen_thread = threading.Thread(target=_last_seen_worker, daemon=True)
+            _last_seen_thread.start()
+
+
+def _last_seen_worker():
+    while True:
+        time.sleep(LAST_SEEN_FLUSH_SECONDS)
+        flush_identity_seen()
+
+
+def flush_identity_seen() -> int:
+    """Write pending last-seen times to identity_last_seen. Returns the number of rows written."""
+    with _tier_lock:
+        if not _last_seen_pending:
+            return 0
+    with _gallery_lock:
+        conn = sqlite3.connect(EMBEDDING_DB_PATH)
+        try:
+            return _flush_identity_seen_locked(conn)
+        finally:
+            conn.close()
+
+
+def _flush_identity_seen_locked(conn: sqlite3.Connection) -> int:
+    """Flush under _gallery_lock, so a concurrent delete / rename cannot be undone by a stale row"""
+    with _tier_lock:
+        batch = list(_last_seen_pending.items())
+        _last_seen_pending.clear()
+    if not batch:
+        return 0
+    try:
+        conn.executemany("INSERT OR REPLACE INTO identity_last_seen (nik, last_seen) VALUES (?, ?)", batch)
+        conn.commit()
+    except sqlite3.Error as e:
+        with _tier_lock:
+            for nik, seen in batch:
+                _last_seen_pending.setdefault(nik, seen)  # Retry with the next flush
+        logger.error(f"Failed to flush last-seen times: {e}")
+        return 0
+    return len(batch)
+
+
+atexit.register(flush_identity_seen)
+
+
+def promote_identity(nik: int) -> bool:
+    """Move a recognized cold identity into the hot tier."""
+    cold = _cold_segment
+    if cold is None or nik not in cold:
+        return False
+    with _gallery_lock:
+        embs, site = _read_identity_embeddings(nik)
+        if embs:
+            _gallery.set(nik, embs, site)  # Hot first, so the identity is never missing from both tiers
+        cold.kill(nik)
+    with _tier_lock:
+        _tier_stats['promotions'] += 1
+    logger.info(f"Promoted NIK {nik} to the hot gallery tier")
+    _maybe_rebalance_tiers()
+    return True
+
+
+def _hot_tier_mb(snapshot: Optional[GallerySnapshot] = None) -> float:
+    snapshot = snapshot or _gallery.snapshot()
+    return snapshot.total_embeddings * EMBEDDING_DIM * 4 / (1024 * 1024)
+
+
+def _maybe_rebalance_tiers():
+    """Reload in the background (demoting the least recently seen) once the hot tier is over budget."""
+    global _rebalance_thread
+    if GALLERY_HOT_BUDGET_MB <= 0 or _hot_tier_mb() <= GALLERY_HOT_BUDGET_MB:
+        return
+    with _tier_lock:
+        if _rebalance_thread is not None and _rebalance_thread.is_alive():
+            return
+        _tier_stats['rebalances'] += 1
+        _rebalance_thread = threading.Thread(target=load_all_embeddings, daemon=True)
+        _rebalance_thread.start()
+
+
+def get_tier_stats() -> Dict[str, Any]:
+    snapshot = _gallery.snapshot()
+    cold = _cold_segment
+    with _tier_lock:
+        stats = dict(_tier_stats)
+    stats.update({
+        'hot_niks': len(snapshot),
+        'hot_embeddings': snapshot.total_embeddings,
+        'hot_mb': round(_hot_tier_mb(snapshot), 2),
+        'hot_budget_mb': GALLERY_HOT_BUDGET_MB,
+        'cold_niks': len(cold) if cold is not None else 0,
+        'cold_embeddings': cold.n_rows if cold is not None else 0,
+        'cold_mb': round(cold.nbytes / (1024 * 1024), 2) if cold is not None else 0.0,
+        'cold_hit_rate': (stats['cold_hits'] / stats['cold_searches']) if stats['cold_searches'] else 0.0,
+    })
+    return stats
+
+
+# ====== SITE PARTITIONS ======
+
+def _record_site_search(site: str, outcome: str):
+    with _site_lock:
+        stats = _site_stats.setdefault(site, {'searches': 0, 'local_hits': 0, 'fanout_hits': 0, 'misses': 0})
+        stats['searches'] += 1
+        stats[outcome] += 1
+
+
+def get_site_stats() -> Dict[str, Dict[str, Any]]:
+    """Per-partition size (hot tier) and local-first search outcomes"""
+    sizes = _gallery.snapshot().index.partition_sizes()
+    with _site_lock:
+        counters = {site: dict(stats) for site, stats in _site_stats.items()}
+    out = {}
+    for site in sorted(set(sizes) | set(counters)):
+        stats = counters.get(site, {'searches': 0, 'local_hits': 0, 'fanout_hits': 0, 'misses': 0})
+        searches = stats['searches']
+        out[site] = {
+            **sizes.get(site, {'niks': 0, 'embeddings': 0}),
+            **stats,
+            'local_hit_rate': (stats['local_hits'] / searches) if searches else 0.0,
+            'fanout_hit_rate': (stats['fanout_hits'] / searches) if searches else 0.0,
+        }
+    return out
+
+
+# ====== SHARDED SEARCH ======
+
+def start_shard_pool() -> Optional[ShardPool]:
+    """
+    Start the shard workers (GALLERY_SHARDS > 0). Called from initialize(),
+    i.e. on import, before the app starts any thread, so the workers can be
+    forked safely; never started lazily from a request thread.
+    """
+    global _shard_pool
+    if GALLERY_SHARDS <= 0:
+        return None
+    with _shard_lock:
+        if _shard_pool is None:
+            pool = ShardPool(GALLERY_SHARDS, EMBEDDING_DIM)
+            atexit.register(pool.close)
+            _shard_pool = pool
+            logger.info(f"[SHARDS] Started {GALLERY_SHARDS} search workers ({pool.start_method})")
+    return _shard_pool
+
+
+def _get_shard_pool(snapshot: GallerySnapshot) -> Optional[ShardPool]:
+    """Shard workers for searching snapshot (None = search in-process)"""
+    if GALLERY_SHARDS <= 0 or snapshot.total_embeddings < GALLERY_SHARD_MIN_ROWS:
+        return None
+    return _shard_pool
+
+
+def _sync_shards(snapshot: Optional[GallerySnapshot] = None):
+    """Route new rows and tombstones to their shards now, not on the next query"""
+    snapshot = snapshot or _gallery.snapshot()
+    pool = _get_shard_pool(snapshot)
+    if pool is not None:
+        pool.sync(snapshot)
+
+
+def get_shard_stats() -> Dict[str, Any]:
+    pool = _shard_pool
+    return pool.stats() if pool is not None else {'shards': 0}
+
+
+# ====== EARLY DECISION POLICIES ======
+
+class EarlyStopPolicy:
+    """
+    Decides after each frame of a voting run whether the outcome is settled.
+    observe() gets the frame's gallery scores [(nik, sim), ...] (highest
+    first, not thresholded), the thresholded votes so far and the number of
+    processed frames; it returns "accept", "reject" or None (keep going).
+    """
+    name = "none"
+
+    def reset(self):
+        pass
+
+    def observe(self, scores: List[Tuple[int, float]], votes: Dict[int, List[float]], processed: int) -> Optional[str]:
+        return None
+
+
+class HeuristicEarlyStop(EarlyStopPolicy):
+    """The original rule: enough confident votes with enough share"""
+    name = "heuristic"
+
+    def observe(self, scores, votes, processed):
+        if not votes:
+            return None
+        best_nik = max(votes.keys(), key=lambda k: np.mean(votes[k]))
+        vote_share = len(votes[best_nik]) / processed
+        avg_sim = np.mean(votes[best_nik])
+        if (vote_share >= VOTE_MIN_SHARE and
+            len(votes[best_nik]) >= EARLY_VOTES_REQUIRED and
+            avg_sim >= EARLY_SIM_THRESHOLD):
+            return "accept"
+        return None
+
+
+class SPRTEarlyStop(EarlyStopPolicy):
+    """
+    Wald's sequential probability ratio test over per-frame similarities.
+
+    H1 (genuine) and H0 (impostor) are Gaussians fitted to our own gallery
+    (estimate_score_distributions). Each frame adds
+    log p(s|H1) - log p(s|H0), clipped to +-SPRT_LLR_CLIP:
+    - per identity, using the frame's score for that NIK (the impostor mean
+      when the NIK was not a candidate); accept once an identity with at
+      least MIN_VALID_FRAMES votes reaches log((1-beta)/alpha)
+    - over the frame's best score, whatever the identity; reject once it
+      drops to log(beta/(1-alpha)), i.e. not even the best match looks genuine.
+      Never while some identity holds votes above the recognition threshold:
+      then the run continues and the normal vote resolution decides
+    """
+    name = "sprt"
+
+    def __init__(self, distributions: Optional[Dict[str, float]] = None,
+                 alpha: float = None, beta: float = None):
+        self.alpha = SPRT_ALPHA if alpha is None else alpha
+        self.beta = SPRT_BETA if beta is None else beta
+        self.dist = distributions
+        self.upper = float(np.log((1 - self.beta) / self.alpha))
+        self.lower = float(np.log(self.beta / (1 - self.alpha)))
+        self.reset()
+
+    def reset(self):
+        self.identity_llr = {}
+        self.best_llr = 0.0
+        self.frames = 0
+
+    def _llr(self, s: float) -> float:
+        d = self.dist
+        zg = (s - d['genuine_mean']) / d['genuine_std']
+        zi = (s - d['impostor_mean']) / d['impostor_std']
+        llr = (-0.5 * zg * zg - np.log(d['genuine_std'])) - (-0.5 * zi * zi - np.log(d['impostor_std']))
+        return float(np.clip(llr, -SPRT_LLR_CLIP, SPRT_LLR_CLIP))
+
+    def observe(self, scores, votes, processed):
+        if self.dist is None:
+            self.dist = estimate_score_distributions()
+        absent = self._llr(self.dist['impostor_mean'])
+        frame_scores = dict(scores)
+        for nik in set(self.identity_llr) | set(frame_scores):
+            prior = self.identity_llr.get(nik, self.frames * absent)
+            self.identity_llr[nik] = prior + self._llr(frame_scores.get(nik, self.dist['impostor_mean']))
+        self.best_llr += self._llr(scores[0][1]) if scores else absent
+        self.frames += 1
+
+        for nik, llr in self.identity_llr.items():
+            if llr >= self.upper and len(votes.get(nik, ())) >= MIN_VALID_FRAMES:
+                return "accept"
+        if self.best_llr <= self.lower and not any(votes.values()):
+            return "reject"
+        return None
+
+
+def estimate_score_distributions() -> Dict[str, float]:
+    """
+    Genuine / impostor similarity distributions from the current gallery.
+    Genuine: per-frame scores of accepted queries once SPRT_MIN_ACCEPTED
+    are recorded; until then the similarity of an embedding to another
+    embedding of the same NIK. Either way the std is floored at
+    SPRT_GENUINE_STD_MIN (gallery rows come from one enrollment session and
+    score higher and tighter than a live camera).
+    Impostor: best similarity of an embedding to any other NIK (what the
+    top-1 score looks like when the person is not enrolled).
+    Uses up to SPRT_SAMPLE embeddings; the gallery part is cached per
+    gallery version, with conservative defaults while the gallery is too small.
+    """
+    global _score_distributions
+    index = get_gallery_index()
+    cached = _score_distributions
+    if cached is not None and cached[0] is index:
+        dist = dict(cached[1])
+    else:
+        dist = _gallery_score_distributions(index)
+        _score_distributions = (index, dist)
+        dist = dict(dist)
+
+    accepted = np.fromiter(tuple(_accepted_scores), dtype=np.float64)
+    if len(accepted) >= SPRT_MIN_ACCEPTED:
+        dist['genuine_mean'] = float(accepted.mean())
+        dist['genuine_std'] = float(accepted.std())
+    dist['genuine_std'] = max(dist['genuine_std'], SPRT_GENUINE_STD_MIN)
+    return dist
+
+
+def _gallery_score_distributions(index: GalleryIndex) -> Dict[str, float]:
+    dist = dict(SPRT_DEFAULT_DISTRIBUTIONS)
+    if len(index.niks) >= 2:
+        embs, owners = index.embeddings()
+        if len(embs) > SPRT_SAMPLE:
+            pick = np.random.default_rng(0).choice(len(embs), SPRT_SAMPLE, replace=False)
+            embs, owners = embs[pick], owners[pick]
+        sims = embs @ embs.T
+        same = owners[:, None] == owners[None, :]
+        np.fill_diagonal(same, False)
+        genuine = sims[same]
+        impostor = np.where(same | np.eye(len(embs), dtype=bool), -np.inf, sims).max(axis=1)
+        impostor = impostor[np.isfinite(impostor)]
+        if len(genuine) >= 10 and len(impostor) >= 10:
+            dist = {
+                'genuine_mean': float(genuine.mean()),
+                'genuine_std': max(float(genuine.std()), 0.03),
+                'impostor_mean': float(impostor.mean()),
+                'impostor_std': max(float(impostor.std()), 0.03),
+            }
+    return dist
+
+
+def get_early_stop_policy(name: Optional[str] = None) -> EarlyStopPolicy:
+    """New policy instance by name (defaults to EARLY_STOP_POLICY)"""
+    name = EARLY_STOP_POLICY if name is None else name
+    if name == "sprt":
+        return SPRTEarlyStop()
+    if name == "heuristic":
+        return HeuristicEarlyStop()
+    return EarlyStopPolicy()
+
+
+def record_early_stop(policy: str, frames: int, decision: Optional[str]):
+    """Count frames processed per decision (reported in get_engine_status)"""
+    with _early_stop_lock:
+        stats = _early_stop_stats.setdefault(policy, {'decisions': 0, 'frames': 0, 'accept': 0, 'reject': 0})
+        stats['decisions'] += 1
+        stats['frames'] += frames
+        if decision in ('accept', 'reject'):
+            stats[decision] += 1
+
+
+def get_early_stop_stats() -> Dict[str, Any]:
+    with _early_stop_lock:
+        return {
+            name: dict(s, avg_frames=round(s['frames'] / s['decisions'], 2) if s['decisions'] else 0.0)
+            for name, s in _early_stop_stats.items()
+        }
+
+
 def recognize_face_multi_frame(
     frames: List[np.ndarray],
-    threshold: float = None
+    threshold: float = None,
+    kiosk_id: Optional[str] = None,
+    mode: Optional[str] = None,
+    early_stop: Optional["EarlyStopPolicy"] = None,
+    site: Optional[str] = None
 ) -> Optional[Dict[str, Any]]:
     """
-    Recognize face across multiple frames with voting.
+    Recognize face across multiple frames.
     Returns result dict with nik, similarity, confidence, etc.
-    """
-    global _embeddings_db, _embeddings_loaded
 
+    mode (defaults to MULTI_FRAME_MODE):
+    - "vote" (default): one gallery search per frame with voting; an
+      EarlyStopPolicy (defaults to EARLY_STOP_POLICY) may accept or reject
+      before all frames are processed, so later frames are never embedded.
+    - "fusion" (opt-in): fuse all valid frame embeddings into one
+      outlier-rejected, quality-weighted template and run a single gallery
+      search. Falls back to voting over the same embeddings when the frames
+      disagree. Every frame is detected and embedded; only the gallery
+      searches are saved.
+
+    Each query is first matched against the kiosk's recent identity cache;
+    a cached identity above threshold + RECENT_CACHE_MARGIN is accepted
+    without scanning the full gallery.
+
+    The whole request runs against one gallery snapshot, so concurrent
+    enrollments never change the gallery between its frames. With site,
+    that site's partition is searched first (see _gallery_matches).
+    """
     if threshold is None:
         threshold = RECOGNITION_THRESHOLD
+    if mode is None:
+        mode = MULTI_FRAME_MODE
 
     if not _embeddings_loaded:
         load_all_embeddings()
 
-    if not _embeddings_db:
+    snapshot = _gallery.snapshot()
+    if _gallery_empty():
         logger.info("No embeddings in database")
         return None
 
+    recent_cache = get_recent_cache(kiosk_id) if RECENT_CACHE_SIZE > 0 else None
+    cache_min_sim = threshold + RECENT_CACHE_MARGIN
+    stats = {'pose_skipped': 0}
+    samples = _iter_frame_embeddings(frames, stats)
+
+    if mode == "fusion":
+        samples = list(samples)
+        fused = fuse_embeddings([e for e, _ in samples], [q for _, q in samples])
+        if fused is not None:
+            winner = _match_fused_template(fused[0], len(fused[1]), len(samples), threshold,
+                                           recent_cache, cache_min_sim, snapshot, site)
+            if winner is None:
+                logger.info(f"Recognition failed (fusion): processed={len(samples)}")
+                return None
+            return _accept_winner(winner, recent_cache, snapshot)
+        logger.info(f"Fusion: frames disagree ({len(samples)} frames), falling back to voting")
+
     from collections import defaultdict
     votes = defaultdict(list)  # nik -> list of similarities
     processed = 0
+    policy = early_stop if early_stop is not None else get_early_stop_policy()
+    policy.reset()
+    decision = None
 
-    for frame in frames:
-        face = detect_largest_face(frame)
-        if face is None:
-            continue
-
-        # Check quality
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if len(frame.shape) == 3 else frame
-        bbox = face.get('bbox', [0, 0, 0, 0])
-        face_gray = gray[bbox[1]:bbox[3], bbox[0]:bbox[2]]
-        if face_gray.size > 0 and is_blurry(face_gray, 50.0):
-            continue
-
-        embedding = face.get('embedding')
-        if embedding is None:
-            embedding = get_embedding(frame, face)
-            if embedding is None:
-                continue
-
+    for embedding, _ in samples:
         processed += 1
 
-        # Find matches
-        for nik, embs in _embeddings_db.items():
-            similarities = [_cosine_similarity(embedding, emb) for emb in embs]
-            max_sim = max(similarities) if similarities else 0.0
+        # Repeat visitor: accept a strict match from the recent cache
+        cached = recent_cache.lookup(embedding, cache_min_sim) if recent_cache is not None else None
+        if cached is not None:
+            scores = [cached]
+        else:
+            # Best few identities (centroid prefilter + exact re-rank), below-threshold scores feed the policy
+            scores = _gallery_matches(embedding, -1.0, snapshot=snapshot, cold_threshold=threshold, site=site,
+                                      top_k=VOTE_CANDIDATES)
+        for nik, max_sim in scores:
             if max_sim >= threshold:
                 votes[nik].append(max_sim)
 
-        # Early stop if confident
-        if votes:
-            best_nik = max(votes.keys(), key=lambda k: np.mean(votes[k]))
-            vote_share = len(votes[best_nik]) / processed
-            avg_sim = np.mean(votes[best_nik])
+        # Early decision (accept / reject) from the configured policy
+        decision = policy.observe(scores, votes, processed)
+        if decision is not None:
+            logger.info(f"Early {decision} ({policy.name}) after {processed} frames")
+            break
 
-            if (vote_share >= VOTE_MIN_SHARE and
-                len(votes[best_nik]) >= EARLY_VOTES_REQUIRED and
-                avg_sim >= EARLY_SIM_THRESHOLD):
-                logger.info(f"Early stop: NIK={best_nik}, sim={avg_sim:.3f}, votes={len(votes[best_nik])}")
-                break
+    record_early_stop(policy.name, processed, decision)
+    if decision == "reject":
+        logger.info(f"Recognition rejected early: processed={processed}")
+        return None
 
     if processed == 0 or not votes:
         logger.info(f"Recognition failed: processed={processed}, votes={len(votes)}")
@@ -606,7 +1650,8 @@ def recognize_face_multi_frame(
                 'vote_count': vote_count,
                 'vote_share': vote_count / processed,
                 'processed_frames': processed,
-                'confidence': int(min(avg_sim * 100, 100))
+                'confidence': int(min(avg_sim * 100, 100)),
+                'mode': 'vote'
             }
 
     if winner is None:
@@ -619,7 +1664,49 @@ def recognize_face_multi_frame(
         logger.info(f"Recognition rejected: {winner}")
         return None
 
-    logger.info(f"Recognition success: NIK={winner['nik']}, sim={winner['similarity']:.3f}")
+    return _accept_winner(winner, recent_cache, snapshot, votes[winner['nik']])
+
+
+def _match_fused_template(
+    template: np.ndarray,
+    agreeing: int,
+    processed: int,
+    threshold: float,
+    recent_cache,
+    cache_min_sim: float,
+    snapshot: Optional[GallerySnapshot] = None,
+    site: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """Single gallery search for a fused template (recent cache first)"""
+    cached = recent_cache.lookup(template, cache_min_sim) if recent_cache is not None else None
+    if cached is not None:
+        nik, sim = cached
+    else:
+        matches = _gallery_matches(template, threshold, snapshot=snapshot, site=site)
+        if not matches:
+            return None
+        nik, sim = matches[0]
+    return {
+        'nik': nik,
+        'similarity': float(sim),
+        'vote_count': agreeing,
+        'vote_share': agreeing / max(1, processed),
+        'processed_frames': processed,
+        'confidence': int(min(sim * 100, 100)),
+        'mode': 'fusion'
+    }
+
+
+def _accept_winner(winner: Dict[str, Any], recent_cache, snapshot: Optional[GallerySnapshot] = None,
+                   frame_scores: Optional[List[float]] = None) -> Dict[str, Any]:
+    _accepted_scores.extend(frame_scores if frame_scores is not None else (winner['similarity'],))
+    record_identity_seen(winner['nik'])
+    if promote_identity(winner['nik']) or snapshot is None:
+        snapshot = _gallery.snapshot()
+    if recent_cache is not None and winner['nik'] in snapshot:
+        recent_cache.remember(winner['nik'], list(snapshot.get(winner['nik'])))
+
+    logger.info(f"Recognition success: NIK={winner['nik']}, sim={winner['similarity']:.3f} ({winner['mode']})")
     return winner
 
 
@@ -627,7 +1714,8 @@ def recognize_face_multi_frame(
 
 def enroll_face(
     img_bgr: np.ndarray,
-    nik: int
+    nik: int,
+    site: Optional[str] = None
 ) -> Tuple[bool, str, Optional[np.ndarray]]:
     """
     Enroll a single face image to database.
@@ -636,9 +1724,12 @@ def enroll_face(
     Uses relaxed detection and quality thresholds for easier registration.
     """
     # Use relaxed detection threshold for registration
-    face = detect_largest_face(img_bgr, detection_threshold=REGISTRATION_DETECTION_THRESHOLD)
+    face = detect_largest_face(img_bgr, detection_threshold=REGISTRATION_DETECTION_THRESHOLD, check_pose=True)
     if face is None:
         return False, "No face detected", None
+    if not face.get('pose_ok', True):
+        yaw, roll = face['pose']
+        return False, f"Face pose out of range (yaw {yaw:.0f}, roll {roll:.0f})", None
 
     # Check quality with relaxed threshold for registration
     quality = calculate_quality_score(face, img_bgr)
@@ -653,51 +1744,146 @@ def enroll_face(
             return False, "Could not extract embedding (is InsightFace installed and models downloaded?)", None
 
     # Save embedding
-    if save_embedding(nik, embedding, quality):
-        # Update in-memory cache
-        global _embeddings_db
-        if nik not in _embeddings_db:
-            _embeddings_db[nik] = []
-        _embeddings_db[nik].append(embedding)
-
+    if _store_enrolled_embedding(nik, embedding, quality, site):
         return True, f"Enrolled with quality {quality:.2f}", embedding
 
     return False, "Failed to save embedding", None
 
 
+def _store_enrolled_embedding(nik: int, embedding: np.ndarray, quality: float, site: Optional[str] = None) -> bool:
+    """Persist one embedding and add it to the in-memory gallery (moving the identity to site)"""
+    global _embedding_total
+    with _gallery_lock:
+        if not save_embedding(nik, embedding, quality, site):
+            return False
+        cold = _cold_segment
+        if cold is not None and nik in cold:
+            # Re-enrolled cold identity: bring all of its embeddings into RAM
+            embs, _ = _read_identity_embeddings(nik)
+            snapshot = _gallery.set(nik, embs, site or DEFAULT_SITE)
+            cold.kill(nik)
+        else:
+            snapshot = _gallery.add(nik, [embedding], site or DEFAULT_SITE)
+        _embedding_total += 1
+        oversized = GALLERY_MAX_PER_NIK > 0 and len(snapshot.get(nik)) > GALLERY_MAX_PER_NIK
+    invalidate_recent_identity(nik)
+    _sync_shards(snapshot)
+    if oversized and GALLERY_CONSOLIDATE_ONLINE:
+        schedule_consolidation(nik)
+    _maybe_rebalance_tiers()
+    return True
+
+
+def embed_face(img_bgr: np.ndarray, face_dict: Dict[str, Any]) -> Optional[np.ndarray]:
+    """
+    Run only the recognition model (ArcFace) for an already detected face.
+    Needs the detector's 5 keypoints for alignment.
+    """
+    if face_dict.get('embedding') is not None:
+        return face_dict['embedding']
+    app = _get_face_app()
+    if app is None or face_dict.get('landmarks') is None:
+        return None
+    rec_model = app.models.get('recognition')
+    if rec_model is None:
+        return None
+    try:
+        from insightface.app.common import Face
+        face = Face(bbox=np.asarray(face_dict['bbox'], dtype=np.float32),
+                    kps=np.asarray(face_dict['landmarks'], dtype=np.float32),
+                    det_score=face_dict.get('det_score', 0.0))
+        rec_model.get(img_bgr, face)
+        embedding = _normalize_embedding(face.embedding)
+        face_dict['embedding'] = embedding
+        return embedding
+    except Exception as e:
+        logger.error(f"Failed to embed face: {e}")
+        return None
+
+
+def _pose_distance(a: Optional[Tuple[float, float]], b: Optional[Tuple[float, float]]) -> float:
+    """Pose difference normalized by the pose limits (0 when unknown)"""
+    if a is None or b is None:
+        return 0.0
+    return float(np.hypot((a[0] - b[0]) / max(POSE_MAX_YAW, 1e-6), (a[1] - b[1]) / max(POSE_MAX_ROLL, 1e-6)))
+
+
+def select_enrollment_frames(
+    candidates: List[Dict[str, Any]],
+    k: int,
+    embed_fn=None
+) -> List[Dict[str, Any]]:
+    """
+    Greedy best-K selection over detected (not yet embedded) candidates.
+
+    Each candidate is {'frame', 'face', 'quality'}. The next pick maximizes
+    quality + ENROLL_DIVERSITY_WEIGHT * (pose distance to the picks so far).
+    The pick is embedded right away with embed_fn; an embedding within
+    ENROLL_DUPLICATE_SIM of a previous pick adds no spread and is dropped.
+    Only picks (plus dropped duplicates) ever reach the recognition model.
+    """
+    if embed_fn is None:
+        embed_fn = embed_face
+    remaining = sorted(candidates, key=lambda c: c['quality'], reverse=True)
+    selected = []
+    while remaining and len(selected) < k:
+        if selected:
+            def gain(c):
+                spread = min(_pose_distance(c['face'].get('pose'), s['face'].get('pose')) for s in selected)
+                return c['quality'] + ENROLL_DIVERSITY_WEIGHT * min(spread, 1.0)
+            best = max(range(len(remaining)), key=lambda i: gain(remaining[i]))
+        else:
+            best = 0
+        cand = remaining.pop(best)
+        embedding = embed_fn(cand['frame'], cand['face'])
+        if embedding is None:
+            continue
+        if any(float(np.dot(embedding, s['embedding'])) >= ENROLL_DUPLICATE_SIM for s in selected):
+            continue
+        cand['embedding'] = embedding
+        selected.append(cand)
+    return selected
+
+
 def enroll_multiple_frames(
     frames: List[np.ndarray],
     nik: int,
-    min_embeddings: int = 5
+    min_embeddings: int = 5,
+    site: Optional[str] = None
 ) -> Tuple[int, str]:
     """
     Enroll multiple frames for a single NIK.
     Returns (num_enrolled, message).
-    """
-    enrolled = 0
 
+    Detection runs on every frame, but the recognition model only runs on
+    the best ENROLL_BEST_K frames (quality + pose / embedding diversity),
+    and only those embeddings are stored. The identity is recorded under
+    site (defaults to DEFAULT_SITE).
+    """
+    candidates = []
+    tracker = FaceTracker()
     for frame in frames:
-        success, msg, _ = enroll_face(frame, nik)
-        if success:
-            enrolled += 1
-            if enrolled >= 20:  # Max 20 embeddings per person
-                break
-
-    # Augment if needed (by duplicating best embeddings)
-    global _embeddings_db
-    if enrolled > 0 and enrolled < min_embeddings and nik in _embeddings_db:
-        current_count = len(_embeddings_db[nik])
-        needed = min_embeddings - current_count
-
-        # Add slightly noisy versions of existing embeddings
-        for i in range(needed):
-            idx = i % current_count
-            base_emb = _embeddings_db[nik][idx]
-            noise = np.random.normal(0, 0.01, base_emb.shape)
-            augmented = _normalize_embedding(base_emb + noise)
-            save_embedding(nik, augmented, 0.5)
-            _embeddings_db[nik].append(augmented)
+        face = detect_largest_face(frame, detection_threshold=REGISTRATION_DETECTION_THRESHOLD,
+                                   tracker=tracker, check_pose=True, embed=False)
+        if face is None or not face.get('pose_ok', True):
+            continue
+        quality = calculate_quality_score(face, frame)
+        if quality < REGISTRATION_QUALITY_THRESHOLD:
+            continue
+        candidates.append({'frame': frame, 'face': face, 'quality': quality})
+
+    enrolled = 0
+    for cand in select_enrollment_frames(candidates, ENROLL_BEST_K):
+        if _store_enrolled_embedding(nik, cand['embedding'], cand['quality'], site):
             enrolled += 1
+    logger.info(f"Enrollment NIK {nik}: {len(frames)} frames, {len(candidates)} candidates, {enrolled} embedded")
+
+    # Optional in-memory padding; only real embeddings are persisted and counted
+    if EMBEDDING_INDEX_PADDING and enrolled > 0:
+        with _gallery_lock:
+            current = _gallery.snapshot().get(nik)
+            if len(current) < min_embeddings:
+                _gallery.set(nik, _pad_index_embeddings(nik, current, min_embeddings))
 
     if enrolled == 0:
         return 0, "No valid face frames to enroll"
@@ -705,6 +1891,178 @@ def enroll_multiple_frames(
     return enrolled, f"Successfully enrolled {enrolled} embeddings"
 
 
+# ====== GALLERY CONSOLIDATION ======
+
+def select_representatives(embeddings: np.ndarray, qualities: np.ndarray, k: int) -> List[int]:
+    """
+    k-center selection by cosine distance.
+    Starts from the medoid (highest mean similarity, ties broken by quality)
+    and then repeatedly adds the embedding farthest from everything kept,
+    so the kept subset covers the spread of the gallery.
+    Returns indices into embeddings.
+    """
+    n = len(embeddings)
+    if n <= k:
+        return list(range(n))
+    sims = embeddings @ embeddings.T
+    first = int(np.argmax(sims.mean(axis=1) + 1e-6 * qualities))
+    chosen = [first]
+    # Distance of every embedding to its closest chosen one
+    min_dist = 1.0 - sims[first]
+    while len(chosen) < k:
+        nxt = int(np.argmax(min_dist + 1e-6 * qualities))
+        if min_dist[nxt] <= 0.0:
+            break  # Remaining ones are exact duplicates
+        chosen.append(nxt)
+        min_dist = np.minimum(min_dist, 1.0 - sims[nxt])
+    return chosen
+
+
+def consolidate_nik(
+    nik: int,
+    max_per_nik: int = None,
+    keep_mean: bool = None,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """
+    Cap the stored embeddings of one NIK at max_per_nik, keeping a diverse
+    representative subset (select_representatives). With keep_mean, a
+    quality-weighted mean of all embeddings before pruning is kept as a
+    template in embedding_templates.
+    Returns {'nik', 'before', 'after', 'removed'}.
+    """
+    global _embedding_total
+    if max_per_nik is None:
+        max_per_nik = GALLERY_MAX_PER_NIK
+    if keep_mean is None:
+        keep_mean = GALLERY_KEEP_MEAN
+
+    with _gallery_lock:
+        conn = sqlite3.connect(EMBEDDING_DB_PATH)
+        try:
+            rows = conn.execute(
+                "SELECT id, embedding, quality_score FROM embeddings WHERE nik = ? ORDER BY quality_score DESC, id",
+                (nik,)
+            ).fetchall()
+            report = {'nik': nik, 'before': len(rows), 'after': len(rows), 'removed': 0}
+            if max_per_nik <= 0 or len(rows) <= max_per_nik:
+                return report
+
+            embs = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            qualities = np.array([r[2] or 0.0 for r in rows], dtype=np.float64)
+            keep = set(select_representatives(embs, qualities, max_per_nik))
+            removed_ids = [rows[i][0] for i in range(len(rows)) if i not in keep]
+            report['after'] = len(keep)
+            report['removed'] = len(removed_ids)
+            if dry_run:
+                return report
+
+            conn.executemany("DELETE FROM embeddings WHERE id = ?", [(i,) for i in removed_ids])
+            template = None
+            if keep_mean:
+                weights = np.maximum(qualities, 1e-3)
+                template = _normalize_embedding((embs * weights[:, None]).sum(axis=0)).astype(np.float32)
+                conn.execute(
+                    "INSERT OR REPLACE INTO embedding_templates (nik, embedding, source_count, updated_at) VALUES (?, ?, ?, ?)",
+                    (nik, template.tobytes(), len(rows), datetime.now().isoformat())
+                )
+            else:
+                row = conn.execute("SELECT embedding FROM embedding_templates WHERE nik = ?", (nik,)).fetchone()
+                if row is not None:
+                    template = np.frombuffer(row[0], dtype=np.float32)
+            conn.commit()
+        finally:
+            conn.close()
+
+        if nik in _gallery.snapshot():
+            kept = [embs[i] for i in sorted(keep)]  # Rows are in quality order
+            if template is not None:
+                kept.append(template)
+            if EMBEDDING_INDEX_PADDING:
+                kept = _pad_index_embeddings(nik, kept, EMBEDDING_INDEX_MIN)
+            _gallery.set(nik, kept)
+            promoted = False
+        else:
+            # A cold identity's segment rows are immutable: move the pruned set into RAM
+            # instead of leaving the deleted embeddings searchable until the next reload
+            cold = _cold_segment
+            promoted = cold is not None and nik in cold
+            if promoted:
+                kept, site = _read_identity_embeddings(nik)
+                if kept:
+                    _gallery.set(nik, kept, site)
+                cold.kill(nik)
+        _embedding_total = max(0, _embedding_total - len(removed_ids))
+    invalidate_recent_identity(nik)
+    if promoted:
+        with _tier_lock:
+            _tier_stats['promotions'] += 1
+        _maybe_rebalance_tiers()
+    logger.info(f"Consolidated NIK {nik}: {report['before']} -> {report['after']} embeddings")
+    return report
+
+
+def consolidate_gallery(
+    max_per_nik: int = None,
+    keep_mean: bool = None,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """
+    Consolidate every NIK over the cap (maintenance command).
+    Scan cost = embeddings compared per query in find_matching_identity.
+    """
+    if max_per_nik is None:
+        max_per_nik = GALLERY_MAX_PER_NIK
+    if keep_mean is None:
+        keep_mean = GALLERY_KEEP_MEAN
+    conn = sqlite3.connect(EMBEDDING_DB_PATH)
+    counts = conn.execute("SELECT nik, COUNT(*) FROM embeddings GROUP BY nik").fetchall()
+    conn.close()
+
+    before = sum(c for _, c in counts)
+    after = before
+    niks = []
+    for nik, count in counts:
+        if max_per_nik > 0 and count > max_per_nik:
+            report = consolidate_nik(int(nik), max_per_nik, keep_mean, dry_run=dry_run)
+            after -= report['removed']
+            if keep_mean:
+                after += 1  # The mean template is scanned as well
+            niks.append(report)
+    return {
+        'niks_consolidated': niks,
+        'scan_cost_before': before,
+        'scan_cost_after': after,
+        'scan_cost_reduction': (1.0 - after / before) if before else 0.0,
+    }
+
+
+def schedule_consolidation(nik: int):
+    """Queue one NIK for background consolidation (deduplicated)."""
+    global _consolidation_thread
+    with _gallery_lock:
+        if nik in _consolidation_pending:
+            return
+        _consolidation_pending.add(nik)
+        if _consolidation_thread is None or not _consolidation_thread.is_alive():
+            _consolidation_thread = threading.Thread(target=_consolidation_worker, daemon=True)
+            _consolidation_thread.start()
+    _consolidation_queue.put(nik)
+
+
+def _consolidation_worker():
+    while True:
+        nik = _consolidation_queue.get()
+        with _gallery_lock:
+            _consolidation_pending.discard(nik)
+        try:
+            consolidate_nik(nik)
+        except Exception as e:
+            logger.error(f"Consolidation failed for NIK {nik}: {e}")
+        finally:
+            _consolidation_queue.task_done()
+
+
 # ====== THRESHOLD TUNING ======
 
 def log_threshold_performance(
@@ -730,23 +2088,22 @@ def suggest_threshold() -> float:
     Suggest optimal threshold based on embedding distribution.
     Analyzes intra-class and inter-class distances.
     """
-    global _embeddings_db, _embeddings_loaded
-
     if not _embeddings_loaded:
         load_all_embeddings()
 
-    if len(_embeddings_db) < 2:
+    snapshot = _gallery.snapshot()
+    if len(snapshot) < 2:
         return RECOGNITION_THRESHOLD
 
     try:
         intra_sims = []  # Same person similarities
         inter_sims = []  # Different person similarities
 
-        niks = list(_embeddings_db.keys())
+        niks = snapshot.niks()
 
         # Calculate intra-class similarities
         for nik in niks:
-            embs = _embeddings_db[nik]
+            embs = snapshot.get(nik)
             for i in range(len(embs)):
                 for j in range(i+1, len(embs)):
                     intra_sims.append(_cosine_similarity(embs[i], embs[j]))
@@ -755,8 +2112,8 @@ def suggest_threshold() -> float:
         import random
         for _ in range(min(1000, len(niks) * len(niks))):
             nik1, nik2 = random.sample(niks, 2)
-            emb1 = random.choice(_embeddings_db[nik1])
-            emb2 = random.choice(_embeddings_db[nik2])
+            emb1 = random.choice(snapshot.get(nik1))
+            emb2 = random.choice(snapshot.get(nik2))
             inter_sims.append(_cosine_similarity(emb1, emb2))
 
         if not intra_sims or not inter_sims:
@@ -787,6 +2144,7 @@ def initialize():
         if _initialized:
             return  # Already initialized
 
+        start_shard_pool()  # Before any thread exists (workers are forked)
         init_embedding_db()
         load_all_embeddings()
 
@@ -807,15 +2165,25 @@ def is_available() -> bool:
 
 def get_engine_status() -> Dict[str, Any]:
     """Get face engine status"""
-    global _embeddings_db, _embeddings_loaded
-
+    snapshot = _gallery.snapshot()
     return {
         'insightface_available': _get_face_app() is not None,
         'embeddings_loaded': _embeddings_loaded,
-        'total_embeddings': get_embedding_count(),
-        'unique_niks': get_unique_nik_count(),
+        'total_embeddings': _embedding_total if _embeddings_loaded else get_embedding_count(),
+        'unique_niks': (len(snapshot) + (len(_cold_segment) if _cold_segment is not None else 0))
+                       if _embeddings_loaded else get_unique_nik_count(),
+        'gallery': _gallery.stats(),
+        'tiers': get_tier_stats(),
+        'sites': get_site_stats(),
+        'shards': get_shard_stats(),
         'recognition_threshold': RECOGNITION_THRESHOLD,
-        'detection_threshold': DETECTION_THRESHOLD
+        'detection_threshold': DETECTION_THRESHOLD,
+        'recent_cache': get_recent_cache_stats(),
+        'gallery_max_per_nik': GALLERY_MAX_PER_NIK,
+        'consolidation_pending': len(_consolidation_pending),
+        'multi_frame_mode': MULTI_FRAME_MODE,
+        'early_stop_policy': EARLY_STOP_POLICY if MULTI_FRAME_MODE == "vote" else "none (fusion mode)",
+        'early_stop': get_early_stop_stats()
     }
 
 
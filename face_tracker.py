@@ -0,0 +1,84 @@
+"""
+Lightweight face tracking across the frames of one recognition request
+
+A 2-second burst from the kiosk camera shows one face that barely moves, so
+only the first good frame needs a full-image detection:
+1. Full detection until a face is found
+2. Later frames: detect only inside an expanded ROI around the box predicted
+   from the last two boxes (constant velocity)
+3. Every TRACK_REDETECT_EVERY frames, or when the ROI search misses, fall
+   back to full-frame detection
+
+The tracker only keeps geometry; the caller runs the detector. Boxes are
+(x, y, w, h) in full-frame pixels. One tracker per request, not shared
+between threads.
+"""
+
+import os
+from typing import Optional, Tuple
+
+# ====== CONFIGURATION ======
+TRACK_ROI_MARGIN = float(os.environ.get("TRACK_ROI_MARGIN", "0.5"))  # ROI expansion around the predicted box (x face size)
+TRACK_REDETECT_EVERY = int(os.environ.get("TRACK_REDETECT_EVERY", "5"))  # Force a full-frame detection every N frames (0 = only when lost)
+TRACK_MIN_ROI = 60  # ROIs smaller than this (pixels) are not worth searching
+
+Box = Tuple[int, int, int, int]
+
+
+class FaceTracker:
+    """Predicts where to look for the face in the next frame of a request."""
+
+    def __init__(self, margin: float = TRACK_ROI_MARGIN, redetect_every: int = TRACK_REDETECT_EVERY):
+        self.margin = margin
+        self.redetect_every = redetect_every
+        self.box: Optional[Box] = None
+        self.velocity = (0, 0)
+        self.frames_since_full = 0
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.lost = 0
+
+    def predicted_box(self) -> Optional[Box]:
+        """Box expected in the next frame, or None when a full detection is due."""
+        if self.box is None:
+            return None
+        if self.redetect_every > 0 and self.frames_since_full >= self.redetect_every:
+            return None
+        x, y, w, h = self.box
+        return (x + self.velocity[0], y + self.velocity[1], w, h)
+
+    def search_region(self, shape) -> Optional[Tuple[int, int, int, int]]:
+        """(x0, y0, x1, y1) to search in the next frame, or None for full-frame detection."""
+        box = self.predicted_box()
+        if box is None:
+            return None
+        x, y, w, h = box
+        mx, my = int(w * self.margin), int(h * self.margin)
+        x0, y0 = max(0, x - mx), max(0, y - my)
+        x1, y1 = min(shape[1], x + w + mx), min(shape[0], y + h + my)
+        if x1 - x0 < TRACK_MIN_ROI or y1 - y0 < TRACK_MIN_ROI:
+            return None
+        return (x0, y0, x1, y1)
+
+    def face_size(self) -> int:
+        """Side of the last tracked face (0 when not tracking)."""
+        return max(self.box[2], self.box[3]) if self.box is not None else 0
+
+    def update(self, box: Optional[Box], full_frame: bool):
+        """Record the detection result for the current frame."""
+        if full_frame:
+            self.full_detections += 1
+            self.frames_since_full = 0
+        else:
+            self.roi_detections += 1
+            self.frames_since_full += 1
+        if box is None:
+            if self.box is not None:
+                self.lost += 1
+            self.box = None
+            self.velocity = (0, 0)
+            return
+        box = tuple(int(v) for v in box)
+        if self.box is not None:
+            self.velocity = (box[0] - self.box[0], box[1] - self.box[1])
+        self.box = box
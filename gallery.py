@@ -0,0 +1,1050 @@
+"""
+Embedding gallery with copy-on-write snapshots
+
+The in-memory gallery (NIK -> embeddings) is published as immutable,
+versioned GallerySnapshot objects:
+1. Readers call Gallery.snapshot() and keep using that object for the whole
+   request; no lock, and nothing they see ever changes underneath them
+2. Writers (enrollment, delete, rename, consolidation) serialize on one
+   lock, apply their change and swap a single reference, which is atomic
+   in CPython
+
+Storage is one append-only matrix shared by all snapshots (_Store):
+- Rows are appended into spare capacity (doubling growth), so adding k
+  embeddings costs O(k) amortized
+- Each row points to a slot; a small indirection table maps slots to NIKs,
+  so the matrix never stores NIKs and per-identity maxima stay vectorized
+- Deleting a NIK tombstones its rows with the version that removed them.
+  A snapshot sees a row iff it was appended before the snapshot and its
+  tombstone version is newer, so old snapshots stay intact without copies
+- Renames and replacements tombstone the old rows and append the new ones
+  (O(k) in the affected embeddings)
+- Once tombstones exceed GALLERY_COMPACT_RATIO of the rows, a background
+  thread rebuilds a dense store and publishes it as the next version
+
+Per-slot centroid sums (for the two-stage centroid search) are maintained
+in place. They only pick which identities are re-ranked, so an older
+snapshot may see centroids a few writes ahead of it; the similarity scores
+themselves always come from the snapshot's own rows.
+
+Each slot also carries a site (clinic) tag. Sites are logical partitions
+of the same matrix: GalleryIndex can score one site, or every site except
+one, so a kiosk searches its own clinic first. An identity re-enrolled at
+another site moves there (old rows tombstoned, live rows re-appended).
+
+ColdSegment is the on-disk tier for identities not kept in RAM: a
+memory-mapped matrix written once per (re)load and scanned in chunks.
+
+ShardPool spreads the search over worker processes: rows are routed to
+shard_of(nik), each shard mirrors its rows (with the same versioned
+tombstones) in a shared-memory segment, and per-shard top-k lists are
+merged with a heap. Any snapshot of the mirrored store is searched exactly.
+Concurrent queries each take their own pipe to every shard, so they only
+share the short sync step, not the scatter/gather.
+"""
+
+import os
+import heapq
+import itertools
+import multiprocessing
+import queue
+import threading
+import logging
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import wait
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ====== CONFIGURATION ======
+GALLERY_INITIAL_CAPACITY = int(os.environ.get("GALLERY_INITIAL_CAPACITY", "1024"))  # Rows preallocated for a new store
+GALLERY_COMPACT_RATIO = float(os.environ.get("GALLERY_COMPACT_RATIO", "0.3"))  # Compact when tombstoned rows exceed this share (0 = never)
+GALLERY_SHARD_CHANNELS = int(os.environ.get("GALLERY_SHARD_CHANNELS", "4"))  # Queries in flight per shard worker (one pipe each)
+
+ALIVE = np.iinfo(np.int64).max  # row_dead value of a row that was never tombstoned
+DEFAULT_PARTITION = "default"  # Site of identities enrolled without one
+
+
+def _as_rows(embeddings: Iterable[np.ndarray]) -> np.ndarray:
+    rows = [np.asarray(e, dtype=np.float32).ravel() for e in embeddings]
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(rows)
+
+
+class _Store:
+    """Append-only rows + slot table. Mutated only by the Gallery writer."""
+
+    def __init__(self, dim: int, capacity: int = GALLERY_INITIAL_CAPACITY):
+        capacity = max(1, capacity)
+        self.dim = dim
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.row_slot = np.zeros(capacity, dtype=np.int32)
+        self.row_dead = np.full(capacity, ALIVE, dtype=np.int64)
+        self.slot_sum = np.zeros((max(16, capacity // 4), dim), dtype=np.float32)
+        self.slot_nik: List[int] = []  # Indirection table: slot -> NIK (append-only)
+        self.slot_site: List[str] = []  # slot -> site partition (fixed per slot)
+        self.slot_rows: List[List[int]] = []  # slot -> every row ever appended (append-only)
+        self.nik_slots: Dict[int, List[int]] = {}  # NIK -> its slots, current last (a site move opens a new slot)
+        self.slot_alive: List[int] = []  # Writer bookkeeping: live rows per slot
+        self.n_rows = 0
+        self.n_dead = 0
+        self.n_live_slots = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.matrix)
+
+    def _grow_rows(self, needed: int):
+        cap = self.capacity
+        while cap < needed:
+            cap *= 2
+        # New arrays are fully written before the attribute swap, so a reader
+        # holding either array sees identical rows below its snapshot's n_rows
+        matrix = np.zeros((cap, self.dim), dtype=np.float32)
+        matrix[:self.n_rows] = self.matrix[:self.n_rows]
+        row_slot = np.zeros(cap, dtype=np.int32)
+        row_slot[:self.n_rows] = self.row_slot[:self.n_rows]
+        row_dead = np.full(cap, ALIVE, dtype=np.int64)
+        row_dead[:self.n_rows] = self.row_dead[:self.n_rows]
+        self.matrix, self.row_slot, self.row_dead = matrix, row_slot, row_dead
+
+    def current_slot(self, nik: int) -> Optional[int]:
+        slots = self.nik_slots.get(nik)
+        return slots[-1] if slots else None
+
+    def _slot_for(self, nik: int, site: str) -> int:
+        slot = self.current_slot(nik)
+        if slot is not None and self.slot_site[slot] == site:
+            return slot
+        slot = len(self.slot_nik)
+        if slot >= len(self.slot_sum):
+            grown = np.zeros((len(self.slot_sum) * 2, self.dim), dtype=np.float32)
+            grown[:slot] = self.slot_sum[:slot]
+            self.slot_sum = grown
+        self.slot_nik.append(nik)
+        self.slot_site.append(site)
+        self.slot_rows.append([])
+        self.slot_alive.append(0)
+        self.nik_slots.setdefault(nik, []).append(slot)
+        return slot
+
+    def append(self, nik: int, rows: np.ndarray, site: str = DEFAULT_PARTITION):
+        k = len(rows)
+        if k == 0:
+            return
+        slot = self._slot_for(nik, site)
+        if self.n_rows + k > self.capacity:
+            self._grow_rows(self.n_rows + k)
+        start, end = self.n_rows, self.n_rows + k
+        self.matrix[start:end] = rows
+        self.row_slot[start:end] = slot
+        self.row_dead[start:end] = ALIVE
+        self.slot_rows[slot].extend(range(start, end))
+        self.slot_sum[slot] += rows.sum(axis=0)
+        if self.slot_alive[slot] == 0:
+            self.n_live_slots += 1
+        self.slot_alive[slot] += k
+        self.n_rows = end
+
+    def kill(self, nik: int, version: int) -> int:
+        """Tombstone every live row of nik as of version; returns rows killed."""
+        slot = self.current_slot(nik)
+        if slot is None or self.slot_alive[slot] == 0:
+            return 0
+        rows = np.array(self.slot_rows[slot], dtype=np.int64)
+        rows = rows[self.row_dead[rows] == ALIVE]
+        self.row_dead[rows] = version
+        self.slot_sum[slot] = 0.0
+        self.slot_alive[slot] = 0
+        self.n_live_slots -= 1
+        self.n_dead += len(rows)
+        return len(rows)
+
+    def site_of(self, nik: int) -> Optional[str]:
+        slot = self.current_slot(nik)
+        return self.slot_site[slot] if slot is not None else None
+
+    def live_rows(self, nik: int) -> np.ndarray:
+        slot = self.current_slot(nik)
+        if slot is None:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        rows = np.array(self.slot_rows[slot], dtype=np.int64)
+        return self.matrix[rows[self.row_dead[rows] == ALIVE]]
+
+
+# ====== SNAPSHOTS ======
+
+class GallerySnapshot:
+    """Immutable view of the gallery at one version."""
+
+    __slots__ = ("version", "_store", "_n_rows", "_n_slots", "_n_niks", "_total", "_index")
+
+    def __init__(self, version: int, store: Optional[_Store]):
+        self.version = version
+        self._store = store
+        self._n_rows = store.n_rows if store is not None else 0
+        self._n_slots = len(store.slot_nik) if store is not None else 0
+        self._n_niks = store.n_live_slots if store is not None else 0
+        self._total = (store.n_rows - store.n_dead) if store is not None else 0
+        self._index = None
+
+    def _visible(self, rows) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[rows < self._n_rows]
+        return rows[self._store.row_dead[rows] > self.version]
+
+    def _slot_of(self, nik: int) -> Optional[int]:
+        if self._store is None:
+            return None
+        for slot in reversed(list(self._store.nik_slots.get(nik, ()))):
+            if slot < self._n_slots:
+                return slot
+        return None
+
+    def _slot_rows(self, slot: int) -> np.ndarray:
+        return self._visible(list(self._store.slot_rows[slot]))
+
+    def __len__(self) -> int:
+        return self._n_niks
+
+    def __bool__(self) -> bool:
+        return self._n_niks > 0
+
+    def __contains__(self, nik: int) -> bool:
+        slot = self._slot_of(nik)
+        return slot is not None and len(self._slot_rows(slot)) > 0
+
+    def get(self, nik: int) -> Tuple[np.ndarray, ...]:
+        """Read-only embeddings of one NIK (empty tuple when absent)"""
+        slot = self._slot_of(nik)
+        if slot is None:
+            return ()
+        matrix = self._store.matrix
+        out = []
+        for r in self._slot_rows(slot):
+            row = matrix[r]
+            row.flags.writeable = False
+            out.append(row)
+        return tuple(out)
+
+    def site_of(self, nik: int) -> Optional[str]:
+        slot = self._slot_of(nik)
+        return self._store.slot_site[slot] if slot is not None else None
+
+    def niks(self) -> List[int]:
+        return [nik for nik, _ in self.items()]
+
+    def items(self):
+        for slot in range(self._n_slots):
+            embs = self.get(self._store.slot_nik[slot])
+            if embs:
+                yield self._store.slot_nik[slot], embs
+
+    @property
+    def total_embeddings(self) -> int:
+        return self._total
+
+    @property
+    def index(self) -> "GalleryIndex":
+        # Built at most a few times concurrently; every build is identical
+        index = self._index
+        if index is None:
+            index = GalleryIndex(self)
+            self._index = index
+        return index
+
+
+# ====== INDEX ======
+
+class GalleryIndex:
+    """
+    Vectorized search over one snapshot.
+
+    exact_scores() is the reference max-similarity scan: one matrix-vector
+    product over every row, tombstoned rows masked out, per-slot maxima via
+    np.maximum.at. prefiltered_scores() scores slot centroids first and
+    re-ranks only the top M identities (plus any within margin of the M-th)
+    over their full embedding sets. Both compute a candidate's score the
+    same way, so they agree whenever the true match is a candidate.
+
+    Every search can be limited to one site partition (site=...) or to all
+    other partitions (site=..., exclude=True).
+    """
+
+    def __init__(self, snapshot: GallerySnapshot):
+        self.snapshot = snapshot
+        self._views = {}
+        self._centroids = None
+        store = snapshot._store
+        n = snapshot._n_rows
+        if store is None or n == 0:
+            self._rows = np.zeros(0, dtype=np.int64)
+            self._slots = np.zeros(0, dtype=np.int32)
+            self._live_slots = np.zeros(0, dtype=np.int64)
+            self._matrix = np.zeros((0, 1), dtype=np.float32)
+            self._slot_sum = np.zeros((0, 1), dtype=np.float32)
+            self._slot_nik = []
+            self._slot_site = []
+            return
+        self._matrix = store.matrix[:n]  # Rows below n never change
+        self._rows = np.flatnonzero(store.row_dead[:n] > snapshot.version)
+        self._slots = store.row_slot[:n][self._rows]
+        self._live_slots = np.flatnonzero(np.bincount(self._slots, minlength=snapshot._n_slots))
+        self._slot_sum = store.slot_sum
+        self._slot_nik = store.slot_nik
+        self._slot_site = store.slot_site[:snapshot._n_slots]
+
+    @property
+    def niks(self) -> List[int]:
+        return [self._slot_nik[s] for s in self._live_slots]
+
+    def embeddings(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(live embeddings, owner slot per embedding)"""
+        return self._matrix[self._rows], self._slots
+
+    def sites(self) -> List[str]:
+        return sorted({self._slot_site[s] for s in self._live_slots})
+
+    def partition_sizes(self) -> Dict[str, Dict[str, int]]:
+        """site -> {'niks', 'embeddings'}"""
+        rows_per_slot = np.bincount(self._slots, minlength=self.snapshot._n_slots)
+        sizes = {}
+        for s in self._live_slots:
+            part = sizes.setdefault(self._slot_site[s], {'niks': 0, 'embeddings': 0})
+            part['niks'] += 1
+            part['embeddings'] += int(rows_per_slot[s])
+        return sizes
+
+    def _view(self, site: Optional[str] = None, exclude: bool = False):
+        """(rows, slots, live slots) of one partition, all other partitions, or everything (site=None)"""
+        if site is None:
+            return self._rows, self._slots, self._live_slots
+        view = self._views.get((site, exclude))
+        if view is None:
+            in_part = np.fromiter((x == site for x in self._slot_site), dtype=bool, count=len(self._slot_site))
+            if exclude:
+                in_part = ~in_part
+            keep = in_part[self._slots]
+            view = (self._rows[keep], self._slots[keep], self._live_slots[in_part[self._live_slots]])
+            self._views[(site, exclude)] = view
+        return view
+
+    def _slot_max(self, scores: np.ndarray, slots: np.ndarray) -> np.ndarray:
+        best = np.full(self.snapshot._n_slots, -np.inf, dtype=np.float32)
+        np.maximum.at(best, slots, scores)
+        return best
+
+    def exact_scores(self, query: np.ndarray, site: Optional[str] = None, exclude: bool = False,
+                     top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+        """(nik, max similarity) for every identity (of the partition); only the best top_k when set"""
+        rows, slots, live = self._view(site, exclude)
+        if len(rows) == 0:
+            return []
+        if len(rows) == len(self._rows):
+            scores = self._matrix @ query  # Tombstoned rows are scored too, then dropped
+            if len(rows) < len(scores):
+                scores = scores[rows]
+        else:
+            scores = self._matrix[rows] @ query
+        best = self._slot_max(scores, slots)
+        if top_k and len(live) > top_k:
+            live = live[np.argpartition(-best[live], top_k - 1)[:top_k]]
+        return [(self._slot_nik[s], float(best[s])) for s in live]
+
+    def candidates(self, query: np.ndarray, top_m: int, margin: float,
+                   site: Optional[str] = None, exclude: bool = False) -> List[int]:
+        """Slots worth an exact re-rank"""
+        live = self._view(site, exclude)[2]
+        n = len(live)
+        if top_m <= 0 or n <= top_m:
+            return live.tolist()
+        if self._centroids is None:
+            sums = self._slot_sum[:self.snapshot._n_slots]
+            self._centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        cent = (self._centroids @ query)[live]
+        mth = float(np.partition(cent, n - top_m)[n - top_m])  # M-th highest centroid score
+        return live[cent >= mth - margin].tolist()
+
+    def prefiltered_scores(self, query: np.ndarray, top_m: int, margin: float,
+                           site: Optional[str] = None, exclude: bool = False) -> List[Tuple[int, float]]:
+        """(nik, max similarity) for the centroid candidates only"""
+        cands = self.candidates(query, top_m, margin, site, exclude)
+        if not cands:
+            return []
+        per_slot = [self.snapshot._slot_rows(s) for s in cands]
+        rows = np.concatenate(per_slot)
+        slots = np.repeat(np.array(cands, dtype=np.int32), [len(r) for r in per_slot])
+        best = self._slot_max(self._matrix[rows] @ query, slots)
+        return [(self._slot_nik[s], float(best[s])) for s in cands]
+
+
+# ====== WRITER ======
+
+class Gallery:
+    """Owner of the current snapshot; single writer lock, lock-free reads."""
+
+    def __init__(self, data: Optional[Mapping[int, Iterable[np.ndarray]]] = None,
+                 compact_ratio: float = GALLERY_COMPACT_RATIO,
+                 sites: Optional[Mapping[int, str]] = None):
+        self._write_lock = threading.Lock()
+        self.compact_ratio = compact_ratio
+        self.compactions = 0
+        self._compactor = None
+        self._store = None
+        self._snapshot = GallerySnapshot(0, None)
+        if data:
+            self._store = self._build_store(data, sites)
+            self._snapshot = GallerySnapshot(0, self._store)
+
+    def snapshot(self) -> GallerySnapshot:
+        """Current version (no lock; the returned object never changes)."""
+        return self._snapshot
+
+    @staticmethod
+    def _build_store(data, sites: Optional[Mapping[int, str]] = None,
+                     capacity: int = GALLERY_INITIAL_CAPACITY) -> Optional[_Store]:
+        """New dense store from a mapping or (nik, embeddings) pairs, grouped by site"""
+        pairs = data.items() if isinstance(data, Mapping) else data
+        sites = sites or {}
+        blocks = [(int(nik), _as_rows(embs)) for nik, embs in pairs]
+        blocks = [(nik, rows, sites.get(nik, DEFAULT_PARTITION)) for nik, rows in blocks if len(rows)]
+        if not blocks:
+            return None
+        blocks.sort(key=lambda b: b[2])  # Stable: a partition's rows are contiguous after a rebuild
+        total = sum(len(rows) for _, rows, _ in blocks)
+        store = _Store(blocks[0][1].shape[1], max(capacity, total + total // 4))
+        for nik, rows, site in blocks:
+            store.append(nik, rows, site)
+        return store
+
+    def _publish(self) -> GallerySnapshot:
+        snap = GallerySnapshot(self._snapshot.version + 1, self._store)
+        self._snapshot = snap  # Single reference swap
+        return snap
+
+    def _next_version(self) -> int:
+        return self._snapshot.version + 1
+
+    def _site_for(self, nik: int, site: Optional[str]) -> str:
+        if site is not None:
+            return site
+        current = self._store.site_of(nik) if self._store is not None else None
+        return current or DEFAULT_PARTITION
+
+    def _append(self, nik: int, rows: np.ndarray, site: str):
+        if len(rows) == 0:
+            return
+        if self._store is None:
+            self._store = _Store(rows.shape[1])
+        current = self._store.site_of(nik)
+        if current is not None and current != site:
+            # Site move: the identity's live rows follow it into the new partition
+            carried = self._store.live_rows(nik).copy()
+            self._kill(nik)
+            rows = np.vstack([carried, rows]) if len(carried) else rows
+        self._store.append(nik, rows, site)
+
+    def _kill(self, nik: int) -> int:
+        return self._store.kill(nik, self._next_version()) if self._store is not None else 0
+
+    def replace_all(self, data: Mapping[int, Iterable[np.ndarray]],
+                    sites: Optional[Mapping[int, str]] = None) -> GallerySnapshot:
+        """Publish a freshly built store (full reload)."""
+        store = self._build_store(data, sites)
+        with self._write_lock:
+            self._store = store
+            return self._publish()
+
+    def add(self, nik: int, embeddings: Iterable[np.ndarray], site: Optional[str] = None) -> GallerySnapshot:
+        """
+        Append embeddings to one NIK: O(k). site=None keeps the NIK's
+        partition; another site moves the identity there (O(its rows)).
+        """
+        rows = _as_rows(embeddings)
+        with self._write_lock:
+            self._append(nik, rows, self._site_for(nik, site))
+            snap = self._publish()
+        self._maybe_compact()
+        return snap
+
+    def set(self, nik: int, embeddings: Iterable[np.ndarray], site: Optional[str] = None) -> GallerySnapshot:
+        """Replace all embeddings of one NIK: tombstone + append."""
+        rows = _as_rows(embeddings)
+        with self._write_lock:
+            site = self._site_for(nik, site)
+            self._kill(nik)
+            self._append(nik, rows, site)
+            snap = self._publish()
+        self._maybe_compact()
+        return snap
+
+    def remove(self, nik: int) -> GallerySnapshot:
+        with self._write_lock:
+            if not self._kill(nik):
+                return self._snapshot
+            snap = self._publish()
+        self._maybe_compact()
+        return snap
+
+    def rename(self, old_nik: int, new_nik: int) -> GallerySnapshot:
+        """Move old_nik's embeddings under new_nik (replacing new_nik's)."""
+        with self._write_lock:
+            if self._store is None or old_nik == new_nik:
+                return self._snapshot
+            rows = self._store.live_rows(old_nik).copy()
+            if len(rows) == 0:
+                return self._snapshot
+            site = self._store.site_of(old_nik)
+            self._kill(old_nik)
+            self._kill(new_nik)
+            self._append(new_nik, rows, site)
+            snap = self._publish()
+        self._maybe_compact()
+        return snap
+
+    # ====== COMPACTION ======
+
+    def tombstone_ratio(self) -> float:
+        store = self._store
+        return store.n_dead / store.n_rows if store is not None and store.n_rows else 0.0
+
+    def compact(self) -> GallerySnapshot:
+        """Rebuild a dense store from the live rows and publish it."""
+        with self._write_lock:
+            store = self._store
+            if store is None or store.n_dead == 0:
+                return self._snapshot
+            live = [(store.slot_nik[s], store.live_rows(store.slot_nik[s]))
+                    for s in range(len(store.slot_nik)) if store.slot_alive[s] > 0]
+            sites = {nik: store.site_of(nik) for nik, _ in live}
+            before = store.n_rows
+            self._store = self._build_store(live, sites)
+            snap = self._publish()
+            self.compactions += 1
+        logger.info(f"[GALLERY] Compacted {before} -> {snap.total_embeddings} rows (v{snap.version})")
+        return snap
+
+    def _maybe_compact(self):
+        if self.compact_ratio <= 0 or self.tombstone_ratio() <= self.compact_ratio:
+            return
+        with self._write_lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self._compact_worker, daemon=True)
+            self._compactor.start()
+
+    def _compact_worker(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"[GALLERY] Compaction failed: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        store = self._store
+        return {
+            'version': self._snapshot.version,
+            'rows': store.n_rows if store is not None else 0,
+            'capacity': store.capacity if store is not None else 0,
+            'tombstones': store.n_dead if store is not None else 0,
+            'tombstone_ratio': round(self.tombstone_ratio(), 3),
+            'compactions': self.compactions,
+        }
+
+
+# ====== COLD SEGMENT ======
+
+class ColdSegment:
+    """
+    Read-only on-disk gallery tier: one memory-mapped float32 .npy matrix,
+    rows grouped by NIK, owners kept in RAM (4 bytes per row). Scanned in
+    chunks so only one chunk of pages is touched at a time. Identities
+    promoted to the hot tier (or deleted) are masked through a dead set
+    that is swapped as a whole, so scans never take a lock.
+    """
+
+    def __init__(self, path: str, matrix: np.ndarray, owners: np.ndarray, niks: List[int]):
+        self.path = path
+        self.matrix = matrix
+        self.owners = owners
+        self.niks = niks
+        self.slot_of = {nik: i for i, nik in enumerate(niks)}
+        self._dead = frozenset()
+
+    def __len__(self) -> int:
+        return len(self.niks) - len(self._dead)
+
+    def __contains__(self, nik: int) -> bool:
+        return nik in self.slot_of and nik not in self._dead
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.owners)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes
+
+    def kill(self, nik: int):
+        """Mask one identity (caller serializes writers)."""
+        if nik in self.slot_of:
+            self._dead = self._dead | {nik}
+
+    def search(self, query: np.ndarray, top_k: int, chunk_rows: int) -> List[Tuple[int, float]]:
+        """(nik, max similarity) of the top_k live identities, highest first"""
+        dead, matrix = self._dead, self.matrix
+        best = np.full(len(self.niks), -np.inf, dtype=np.float32)
+        step = max(1, chunk_rows)
+        for start in range(0, self.n_rows, step):
+            chunk = np.asarray(matrix[start:start + step])
+            np.maximum.at(best, self.owners[start:start + step], chunk @ query)
+        for nik in dead:
+            best[self.slot_of[nik]] = -np.inf
+        live = np.flatnonzero(np.isfinite(best))
+        if len(live) > top_k > 0:
+            live = live[np.argpartition(best[live], len(live) - top_k)[len(live) - top_k:]]
+        order = live[np.argsort(-best[live])]
+        return [(self.niks[i], float(best[i])) for i in order]
+
+    def close(self):
+        """Remove the file; the mapping itself is released with the last reader."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ColdSegmentWriter:
+    """Streams rows into a new cold segment file, NIK by NIK."""
+
+    def __init__(self, path: str, rows: int, dim: int):
+        self.path = path
+        self._matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(rows, dim))
+        self._owners = np.zeros(rows, dtype=np.int32)
+        self._niks: List[int] = []
+        self._n = 0
+
+    def append(self, nik: int, embeddings: Iterable[np.ndarray]):
+        rows = _as_rows(embeddings)
+        k = len(rows)
+        if k == 0:
+            return
+        self._matrix[self._n:self._n + k] = rows
+        self._owners[self._n:self._n + k] = len(self._niks)
+        self._niks.append(nik)
+        self._n += k
+
+    def close(self) -> ColdSegment:
+        self._matrix.flush()
+        del self._matrix
+        n = self._n
+        matrix = np.load(self.path, mmap_mode="r")[:n]
+        try:
+            os.remove(self.path)  # POSIX keeps the mapping valid; nothing is left behind after a crash
+        except OSError:
+            pass  # Windows: removed by ColdSegment.close()
+        return ColdSegment(self.path, matrix, self._owners[:n], self._niks)
+
+
+# ====== SHARDED SEARCH ======
+
+SHARD_INITIAL_CAPACITY = 4096  # Rows per shard segment before its first growth
+_SHARD_COLUMNS = ((np.int64, "gid"), (np.int64, "dead"), (np.int32, "lid"), (np.int32, "site"))
+
+
+def shard_of(nik: int, n_shards: int) -> int:
+    """Stable shard of a NIK (Fibonacci hashing spreads consecutive NIKs evenly)"""
+    return (((int(nik) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % n_shards
+
+
+def _segment_bytes(capacity: int, dim: int) -> int:
+    return capacity * (dim * 4 + sum(np.dtype(dtype).itemsize for dtype, _ in _SHARD_COLUMNS))
+
+
+def _segment_views(buf, capacity: int, dim: int) -> List[np.ndarray]:
+    """[matrix, gid, dead, lid, site] laid out back to back in one buffer"""
+    views = [np.ndarray((capacity, dim), dtype=np.float32, buffer=buf)]
+    offset = views[0].nbytes
+    for dtype, _ in _SHARD_COLUMNS:
+        views.append(np.ndarray((capacity,), dtype=dtype, buffer=buf, offset=offset))
+        offset += views[-1].nbytes
+    return views
+
+
+def _shard_top_k(views, n: int, n_lids: int, n_rows: int, version: int, site: int, exclude: bool,
+                 query: np.ndarray, threshold: float, top_k: Optional[int]) -> List[Tuple[int, float]]:
+    """(lid, similarity) of one shard's best identities, highest first"""
+    matrix, gid, dead, lid, site_code = views
+    if n == 0 or n_lids == 0:
+        return []
+    # Same visibility rule as GallerySnapshot: appended before it, tombstoned after it
+    visible = (gid[:n] < n_rows) & (dead[:n] > version)
+    if site >= 0:
+        visible &= (site_code[:n] == site) != exclude
+    rows = np.flatnonzero(visible)
+    if len(rows) == 0:
+        return []
+    scores = (matrix[:n] @ query)[rows]
+    best = np.full(n_lids, -np.inf, dtype=np.float32)
+    np.maximum.at(best, lid[rows], scores)
+    hits = np.flatnonzero(best >= threshold)
+    if top_k and len(hits) > top_k:
+        hits = hits[np.argpartition(-best[hits], top_k - 1)[:top_k]]
+    hits = hits[np.argsort(-best[hits], kind="stable")]
+    return [(int(h), float(best[h])) for h in hits]
+
+
+def _shard_worker(conns, dim: int, parent_pid: int):
+    """Worker process: scores queries from any of its pipes against one shard's shared-memory segment"""
+    shm, views, name = None, None, None
+    conns = list(conns)
+    try:
+        while True:
+            ready = wait(conns, timeout=1.0)
+            if not ready:
+                if os.getppid() != parent_pid:
+                    return  # Parent is gone (killed without running its atexit hooks)
+                continue
+            for conn in ready:
+                msg = conn.recv()
+                if msg is None:
+                    return
+                seg_name, capacity, n, n_lids, n_rows, version, site, exclude, query, threshold, top_k = msg
+                if seg_name != name:
+                    # Another segment (grown or rebuilt): the parent keeps the old one until no query names it
+                    views = None
+                    if shm is not None:
+                        shm.close()
+                    shm = shared_memory.SharedMemory(name=seg_name)
+                    views, name = _segment_views(shm.buf, capacity, dim), seg_name
+                conn.send(_shard_top_k(views, n, n_lids, n_rows, version, site, exclude,
+                                       np.frombuffer(query, dtype=np.float32), threshold, top_k))
+    except (EOFError, OSError, KeyboardInterrupt):
+        return
+    finally:
+        views = None
+        if shm is not None:
+            shm.close()
+
+
+class ShardPool:
+    """
+    Gallery search scattered over worker processes, one shard each.
+
+    This process owns every shared-memory segment and is the only writer:
+    sync() routes rows appended to the store since the last sync to their
+    shard (growing that shard's segment when full) and copies new
+    tombstones, so enrollment pays the routing cost instead of the next
+    query. Workers only read rows below the row count sent with a query,
+    and new tombstones always carry a version newer than any snapshot
+    already being searched, so writes never race a reader.
+    A replaced store (reload, compaction) is re-routed from scratch into
+    fresh segments.
+
+    The lock covers sync and a copy of the shard metadata only. A query
+    then takes one of `channels` pipes per shard (lowest shard first, so
+    callers never wait on each other in a cycle); a worker serves whichever
+    of its pipes is ready. Segments that were grown out or replaced stay
+    mapped until no query in flight can still name them.
+
+    Workers are forked only from a single-threaded process (start the pool
+    at startup, before any thread exists); otherwise they come from a
+    forkserver (spawn where that is unavailable), since a fork could copy
+    a lock another thread is holding.
+    """
+
+    def __init__(self, n_shards: int, dim: int, capacity: int = SHARD_INITIAL_CAPACITY,
+                 channels: int = GALLERY_SHARD_CHANNELS, start_method: Optional[str] = None):
+        if n_shards < 1:
+            raise ValueError("n_shards must be >= 1")
+        self.n_shards = n_shards
+        self.dim = dim
+        self.channels = max(1, channels)
+        self._initial_capacity = max(1, capacity)
+        self._lock = threading.Lock()  # Sync + metadata copy; never held across worker round trips
+        self._broken = False
+        self._in_flight = 0
+        self._retired: List[shared_memory.SharedMemory] = []  # Old segments a query in flight may still name
+        # Workers must share this process's resource tracker; one of their own
+        # would unlink the segments when the worker exits
+        resource_tracker.ensure_running()
+        methods = multiprocessing.get_all_start_methods()
+        if start_method is None:
+            if "fork" in methods and threading.active_count() == 1:
+                start_method = "fork"
+            else:
+                start_method = "forkserver" if "forkserver" in methods else "spawn"
+        self.start_method = start_method
+        ctx = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            ctx.set_forkserver_preload(["gallery"])  # Workers only need this module
+        self._conns, self._free, self._workers = [], [], []
+        for i in range(n_shards):
+            pipes = [ctx.Pipe() for _ in range(self.channels)]
+            proc = ctx.Process(target=_shard_worker, args=([child for _, child in pipes], dim, os.getpid()),
+                               name=f"gallery-shard-{i}", daemon=True)
+            proc.start()
+            free = queue.Queue()
+            for parent_end, child_end in pipes:
+                child_end.close()
+                free.put(parent_end)
+            self._conns.append([parent_end for parent_end, _ in pipes])
+            self._free.append(free)
+            self._workers.append(proc)
+        self._segments: List[Optional[shared_memory.SharedMemory]] = [None] * n_shards
+        self._views: List[Optional[List[np.ndarray]]] = [None] * n_shards
+        self._sites: Dict[str, int] = {}
+        self.queries = 0
+        self.rebuilds = 0
+        self.grows = 0
+        self._reset(None)
+
+    def _reset(self, store: Optional[_Store]):
+        self._store = store
+        self._version = -1  # Newest snapshot version synced
+        self._rows = 0  # Store rows routed so far
+        self._seen_dead = 0  # store.n_dead at the last tombstone copy
+        self._n = [0] * self.n_shards
+        self._lid_nik: List[List[int]] = [[] for _ in range(self.n_shards)]  # Shard-local id -> NIK
+        self._nik_lid: List[Dict[int, int]] = [{} for _ in range(self.n_shards)]
+        self._row_shard = np.zeros(0, dtype=np.int32)  # Store row -> shard
+        self._row_pos = np.zeros(0, dtype=np.int64)  # Store row -> row inside its shard
+        self._mirror_dead = np.zeros(0, dtype=np.int64)  # row_dead as last copied to the shards
+
+    def _reserve_rows(self, needed: int):
+        cap = len(self._row_shard)
+        if needed <= cap:
+            return
+        cap = max(cap, GALLERY_INITIAL_CAPACITY)
+        while cap < needed:
+            cap *= 2
+        for attr in ("_row_shard", "_row_pos", "_mirror_dead"):
+            old = getattr(self, attr)
+            grown = np.zeros(cap, dtype=old.dtype)
+            grown[:self._rows] = old[:self._rows]
+            setattr(self, attr, grown)
+
+    def _reserve_shard(self, shard: int, needed: int):
+        old = self._segments[shard]
+        cap = len(self._views[shard][0]) if old is not None else 0
+        if needed <= cap:
+            return
+        cap = max(cap, self._initial_capacity)
+        while cap < needed:
+            cap *= 2
+        shm = shared_memory.SharedMemory(create=True, size=_segment_bytes(cap, self.dim))
+        views = _segment_views(shm.buf, cap, self.dim)
+        n = self._n[shard]
+        if old is not None:
+            for dst, src in zip(views, self._views[shard]):
+                dst[:n] = src[:n]
+            del dst, src  # No exported buffers may remain when the old segment closes
+            self._views[shard] = None
+            self._retire(old)
+            self.grows += 1
+        self._segments[shard], self._views[shard] = shm, views
+
+    def _retire(self, seg: shared_memory.SharedMemory):
+        if self._in_flight:
+            self._retired.append(seg)
+        else:
+            seg.close()
+            seg.unlink()
+
+    def _release_retired(self):
+        for seg in self._retired:
+            seg.close()
+            seg.unlink()
+        self._retired = []
+
+    def _site_code(self, site: str) -> int:
+        code = self._sites.get(site)
+        if code is None:
+            code = self._sites[site] = len(self._sites)
+        return code
+
+    def _route(self, store: _Store, start: int, end: int):
+        matrix, row_dead = store.matrix, store.row_dead[start:end].copy()
+        uniq, inverse = np.unique(store.row_slot[start:end], return_inverse=True)
+        slot_shard = np.zeros(len(uniq), dtype=np.int32)
+        slot_lid = np.zeros(len(uniq), dtype=np.int32)
+        slot_site = np.zeros(len(uniq), dtype=np.int32)
+        for i, slot in enumerate(uniq.tolist()):
+            nik = store.slot_nik[slot]
+            shard = shard_of(nik, self.n_shards)
+            lid = self._nik_lid[shard].get(nik)
+            if lid is None:
+                lid = self._nik_lid[shard][nik] = len(self._lid_nik[shard])
+                self._lid_nik[shard].append(nik)
+            slot_shard[i], slot_lid[i], slot_site[i] = shard, lid, self._site_code(store.slot_site[slot])
+
+        row_shard = slot_shard[inverse]
+        self._reserve_rows(end)
+        self._row_shard[start:end] = row_shard
+        self._mirror_dead[start:end] = row_dead
+        for shard in np.unique(row_shard).tolist():
+            sel = np.flatnonzero(row_shard == shard)
+            pos, k = self._n[shard], len(sel)
+            self._reserve_shard(shard, pos + k)
+            s_matrix, s_gid, s_dead, s_lid, s_site = self._views[shard]
+            s_matrix[pos:pos + k] = matrix[start + sel]
+            s_gid[pos:pos + k] = start + sel
+            s_dead[pos:pos + k] = row_dead[sel]
+            s_lid[pos:pos + k] = slot_lid[inverse[sel]]
+            s_site[pos:pos + k] = slot_site[inverse[sel]]
+            self._row_pos[start + sel] = np.arange(pos, pos + k)
+            self._n[shard] = pos + k
+        self._rows = end
+
+    def _copy_tombstones(self, store: _Store):
+        n_dead = store.n_dead
+        if n_dead == self._seen_dead:
+            return
+        # Tombstones only ever go from ALIVE to a version, so a plain diff finds the new ones
+        row_dead = store.row_dead[:self._rows].copy()
+        changed = np.flatnonzero(row_dead != self._mirror_dead[:self._rows])
+        shards = self._row_shard[changed]
+        for shard in np.unique(shards).tolist():
+            sel = changed[shards == shard]
+            self._views[shard][2][self._row_pos[sel]] = row_dead[sel]
+        self._mirror_dead[changed] = row_dead[changed]
+        self._seen_dead = n_dead
+
+    def _sync(self, snapshot: GallerySnapshot) -> bool:
+        store = snapshot._store
+        if store is not self._store:
+            if snapshot.version < self._version:
+                return False  # Snapshot of a store that was already replaced
+            if self._store is not None:
+                self.rebuilds += 1
+                # Queries in flight may still read the old rows: route into fresh segments
+                for shard, seg in enumerate(self._segments):
+                    if seg is not None:
+                        self._views[shard] = None
+                        self._retire(seg)
+                self._segments = [None] * self.n_shards
+            self._reset(store)
+        self._version = max(self._version, snapshot.version)
+        if store is None:
+            return True
+        if snapshot._n_rows > self._rows:
+            self._route(store, self._rows, snapshot._n_rows)
+        self._copy_tombstones(store)
+        return True
+
+    def sync(self, snapshot: GallerySnapshot) -> bool:
+        """Bring the shards up to snapshot; False when its store was already replaced."""
+        with self._lock:
+            return not self._broken and self._sync(snapshot)
+
+    def search(self, snapshot: GallerySnapshot, query: np.ndarray, threshold: float,
+               top_k: Optional[int] = None, site: Optional[str] = None,
+               exclude: bool = False) -> Optional[List[Tuple[int, float]]]:
+        """
+        (nik, max similarity) >= threshold in snapshot, highest first; top_k
+        per shard and overall. site / exclude restrict the search like
+        GalleryIndex. None when the shards cannot serve this snapshot (the
+        caller searches in-process instead).
+        """
+        query = np.ascontiguousarray(query, dtype=np.float32).ravel().tobytes()
+        with self._lock:
+            if self._broken or not self._sync(snapshot):
+                return None
+            if self._store is None:
+                return []
+            code = -1 if site is None else self._sites.get(site)
+            if code is None:
+                if not exclude:
+                    return []
+                code = -1  # Unknown site: every identity is "elsewhere"
+            jobs = []  # (free pipes, lid -> NIK, request) per non-empty shard, lowest shard first
+            for s in range(self.n_shards):
+                if self._n[s]:
+                    jobs.append((self._free[s], self._lid_nik[s],
+                                 (self._segments[s].name, len(self._views[s][0]), self._n[s], len(self._lid_nik[s]),
+                                  snapshot._n_rows, snapshot.version, code, exclude, query, threshold, top_k)))
+            self._in_flight += 1
+
+        taken, per_shard, ok = [], [], False
+        try:
+            for free, _, msg in jobs:
+                conn = self._take(free)
+                taken.append((free, conn))
+                conn.send(msg)
+            for (_, lid_nik, _), (_, conn) in zip(jobs, taken):
+                per_shard.append([(lid_nik[lid], sim) for lid, sim in conn.recv()])
+            ok = True
+        except (EOFError, OSError) as e:
+            logger.error(f"[SHARDS] Worker lost, falling back to in-process search: {e}")
+        finally:
+            if ok:
+                for free, conn in taken:
+                    free.put(conn)
+            with self._lock:
+                self._in_flight -= 1
+                if ok:
+                    self.queries += 1
+                else:
+                    self._broken = True  # A pipe may hold an unread reply: never reuse any of them
+                if not self._in_flight:
+                    self._release_retired()
+        if not ok:
+            return None
+        merged = heapq.merge(*per_shard, key=lambda m: m[1], reverse=True)
+        return list(itertools.islice(merged, top_k)) if top_k else list(merged)
+
+    def _take(self, free: "queue.Queue"):
+        """A free pipe of one shard; gives up once the pool broke (its pipes are never returned then)"""
+        while True:
+            try:
+                return free.get(timeout=1.0)
+            except queue.Empty:
+                if self._broken:
+                    raise OSError("shard pool is closed")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            live = [int(np.count_nonzero(self._views[s][2][:self._n[s]] == ALIVE)) if self._n[s] else 0
+                    for s in range(self.n_shards)]
+            return {
+                'shards': self.n_shards,
+                'rows': list(self._n),
+                'live_rows': live,
+                'identities': [len(lids) for lids in self._lid_nik],
+                'segment_mb': round(sum(seg.size for seg in self._segments if seg is not None) / (1024 * 1024), 2),
+                'queries': self.queries,
+                'rebuilds': self.rebuilds,
+                'grows': self.grows,
+                'channels': self.channels,
+                'start_method': self.start_method,
+                'in_flight': self._in_flight,
+                'healthy': not self._broken,
+            }
+
+    def close(self):
+        """Stop the workers and unlink every segment (idempotent)"""
+        with self._lock:
+            self._broken = True
+            for conns in self._conns:
+                try:
+                    conns[0].send(None)
+                except (OSError, ValueError):
+                    pass
+            for proc in self._workers:
+                proc.join(timeout=2)
+                if proc.is_alive():
+                    proc.terminate()
+            for conns in self._conns:
+                for conn in conns:
+                    conn.close()
+            self._conns, self._free, self._workers = [], [], []
+            for shard, seg in enumerate(self._segments):
+                if seg is not None:
+                    self._views[shard] = None
+                    seg.close()
+                    seg.unlink()
+            self._segments = [None] * self.n_shards
+            self._release_retired()
+            self._reset(None)
@@ -0,0 +1,448 @@
+"""
+Vectorized LBPH matcher (NumPy)
+
+Drop-in replacement for cv2.face.LBPHFaceRecognizer.predict():
+1. Feature: extended LBP codes (same interpolation as OpenCV's elbp)
+2. Spatial histogram: grid_x x grid_y cells, normalized per cell
+3. Matching: chi-square (HISTCMP_CHISQR_ALT) against the whole histogram
+   matrix at once instead of one training sample at a time
+
+predict() returns the same (label, distance) pair as OpenCV, so
+LBPH_CONF_THRESHOLD keeps its meaning.
+
+Matchers are immutable: extended() returns a new matcher and never touches
+samples an existing matcher can see, so one instance can be shared by any
+number of request threads without locking.
+
+Persistence (LBPHModelStore): histograms + labels as raw .npy files plus a
+small JSON header. Registrations append rows in place; the header is
+replaced atomically after the rows are written. Loading decodes the rows
+into the matcher's in-RAM transposed float32 layout (scoring gathers the
+query's non-zero bins across all samples, which the sample-major file
+cannot serve efficiently); the file is only streamed through a read-only
+map so the decode never holds a second full copy.
+"""
+
+import json
+import os
+import uuid
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# ====== CONFIGURATION ======
+# Same parameters as cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8) in app.py
+LBPH_RADIUS = 1
+LBPH_NEIGHBORS = 8
+LBPH_GRID_X = 8
+LBPH_GRID_Y = 8
+
+SCORE_CHUNK_COLS = 256     # training samples scored per block (keeps temporaries in cache)
+EXTRACT_CHUNK_IMAGES = 64  # images per LBP extraction block
+LOAD_CHUNK_ROWS = 256      # rows decoded per block when loading a saved model
+
+# ====== FEATURE EXTRACTION ======
+
+def _neighbor_weights(radius: int, neighbors: int):
+    """Sampling offsets and bilinear weights, computed exactly like OpenCV (float32)."""
+    out = []
+    for n in range(neighbors):
+        angle = 2.0 * np.pi * n / np.float32(neighbors)
+        x = np.float32(radius * np.cos(angle))
+        y = np.float32(-radius * np.sin(angle))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        tx, ty = np.float32(x - fx), np.float32(y - fy)
+        one = np.float32(1)
+        w = ((one - tx) * (one - ty), tx * (one - ty), (one - tx) * ty, tx * ty)
+        out.append((fx, fy, cx, cy, w))
+    return out
+
+
+def lbp_codes(images: np.ndarray, radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS) -> np.ndarray:
+    """
+    Extended LBP for a batch of grayscale images.
+
+    Args:
+        images: uint8 array (N, H, W)
+
+    Returns:
+        int32 array (N, H - 2*radius, W - 2*radius)
+    """
+    src = images.astype(np.float32)
+    n, h, w = src.shape
+    r = radius
+    center = src[:, r:h - r, r:w - r]
+    eps = np.finfo(np.float32).eps
+    codes = np.zeros(center.shape, np.int32)
+
+    def at(dy, dx):
+        return src[:, r + dy:h - r + dy, r + dx:w - r + dx]
+
+    for bit, (fx, fy, cx, cy, (w1, w2, w3, w4)) in enumerate(_neighbor_weights(radius, neighbors)):
+        t = w1 * at(fy, fx) + w2 * at(fy, cx) + w3 * at(cy, fx) + w4 * at(cy, cx)
+        codes |= ((t > center) | (np.abs(t - center) < eps)).astype(np.int32) << bit
+    return codes
+
+
+def spatial_histograms(codes: np.ndarray, num_patterns: int, grid_x: int = LBPH_GRID_X,
+                       grid_y: int = LBPH_GRID_Y) -> np.ndarray:
+    """
+    Per-cell normalized histograms, concatenated row-major like OpenCV.
+
+    Returns:
+        float32 array (N, grid_x * grid_y * num_patterns)
+    """
+    n, h, w = codes.shape
+    ch, cw = h // grid_y, w // grid_x
+    cells = codes[:, :ch * grid_y, :cw * grid_x]
+    cells = cells.reshape(n, grid_y, ch, grid_x, cw).transpose(0, 1, 3, 2, 4).reshape(n, grid_y * grid_x, ch * cw)
+    # One bincount for the whole batch: offset each cell into its own bin range
+    offsets = (np.arange(n * grid_y * grid_x, dtype=np.int64) * num_patterns).reshape(n, -1, 1)
+    counts = np.bincount((cells + offsets).ravel(), minlength=n * grid_y * grid_x * num_patterns)
+    hist = counts.reshape(n, grid_y * grid_x * num_patterns).astype(np.float32)
+    hist /= np.float32(ch * cw)
+    return hist
+
+
+def extract_histograms(images, radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS,
+                       grid_x: int = LBPH_GRID_X, grid_y: int = LBPH_GRID_Y) -> np.ndarray:
+    """
+    LBPH feature vectors for a list/array of equally sized grayscale images.
+
+    Returns:
+        float32 array (N, grid_x * grid_y * 2**neighbors)
+    """
+    num_patterns = 2 ** neighbors
+    dim = grid_x * grid_y * num_patterns
+    if len(images) == 0:
+        return np.empty((0, dim), np.float32)
+    out = np.empty((len(images), dim), np.float32)
+    for start in range(0, len(images), EXTRACT_CHUNK_IMAGES):
+        batch = np.asarray(images[start:start + EXTRACT_CHUNK_IMAGES], dtype=np.uint8)
+        codes = lbp_codes(batch, radius, neighbors)
+        out[start:start + len(batch)] = spatial_histograms(codes, num_patterns, grid_x, grid_y)
+    return out
+
+# ====== MATCHER ======
+
+class LBPHMatcher:
+    """
+    Immutable LBPH model: histogram matrix + labels.
+
+    Histograms are stored transposed (dim x N) so a query only has to gather
+    the rows of its non-zero bins. Chi-square (CHISQR_ALT) is computed as
+
+        2 * sum((h - q)^2 / (h + q)) = 2 * (sum(h) + sum(q) - 4 * sum(h*q / (h + q)))
+
+    where the last sum only runs over bins with q > 0 (typically ~20%).
+
+    The buffer may have spare capacity; extended() writes new columns past
+    self._count and hands them to a new matcher, so appending is amortized
+    O(new samples) while older matchers stay valid.
+    """
+
+    def __init__(self, histograms: np.ndarray, labels: Sequence[int],
+                 radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS,
+                 grid_x: int = LBPH_GRID_X, grid_y: int = LBPH_GRID_Y):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        histograms = np.asarray(histograms, dtype=np.float32).reshape(-1, self.dim)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        if len(histograms) != len(labels):
+            raise ValueError("histograms and labels must have the same length")
+        self._count = len(labels)
+        self._hist_t = np.ascontiguousarray(histograms.T)
+        self._labels = labels.copy()
+        self._row_sums = histograms.sum(axis=1, dtype=np.float64)
+        self._tail_taken = False  # set once a matcher extended from us owns columns past _count
+
+    @property
+    def dim(self) -> int:
+        return self.grid_x * self.grid_y * (2 ** self.neighbors)
+
+    @property
+    def params(self) -> dict:
+        return dict(radius=self.radius, neighbors=self.neighbors, grid_x=self.grid_x, grid_y=self.grid_y)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def histograms(self) -> np.ndarray:
+        """(N, dim) view of the training histograms."""
+        return self._hist_t[:, :self._count].T
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels[:self._count]
+
+    # --- construction ---
+
+    @classmethod
+    def empty(cls, radius: int = LBPH_RADIUS, neighbors: int = LBPH_NEIGHBORS,
+              grid_x: int = LBPH_GRID_X, grid_y: int = LBPH_GRID_Y):
+        dim = grid_x * grid_y * 2 ** neighbors
+        return cls(np.empty((0, dim), np.float32), [], radius, neighbors, grid_x, grid_y)
+
+    @classmethod
+    def from_images(cls, images, labels, **params):
+        return cls(extract_histograms(images, **params), labels, **params)
+
+    @classmethod
+    def from_recognizer(cls, recognizer):
+        """Copy histograms/labels out of a trained cv2.face.LBPHFaceRecognizer."""
+        hists = recognizer.getHistograms()
+        labels = np.asarray(recognizer.getLabels()).reshape(-1)
+        params = dict(radius=recognizer.getRadius(), neighbors=recognizer.getNeighbors(),
+                      grid_x=recognizer.getGridX(), grid_y=recognizer.getGridY())
+        dim = params["grid_x"] * params["grid_y"] * 2 ** params["neighbors"]
+        matrix = np.empty((len(hists), dim), np.float32)
+        for i, h in enumerate(hists):
+            matrix[i] = np.asarray(h, np.float32).reshape(-1)
+        return cls(matrix, labels, **params)
+
+    def extended(self, images, labels) -> "LBPHMatcher":
+        """New matcher with extra training samples (this one is unchanged)."""
+        new_hist = extract_histograms(images, **self.params)
+        labels = np.asarray(labels, np.int64).reshape(-1)
+        n, k = self._count, len(new_hist)
+        hist_t, lab, sums = self._hist_t, self._labels, self._row_sums
+        # Columns past n may already belong to a matcher extended from us:
+        # write in place only the first time (callers extend from one thread).
+        if n + k > hist_t.shape[1] or self._tail_taken:
+            capacity = max(n + k, 2 * n, 64)
+            hist_t = np.empty((self.dim, capacity), np.float32)
+            hist_t[:, :n] = self._hist_t[:, :n]
+            lab = np.empty(capacity, np.int64)
+            lab[:n] = self._labels[:n]
+            sums = np.empty(capacity, np.float64)
+            sums[:n] = self._row_sums[:n]
+        self._tail_taken = True
+        hist_t[:, n:n + k] = new_hist.T
+        lab[n:n + k] = labels
+        sums[n:n + k] = new_hist.sum(axis=1, dtype=np.float64)
+
+        return LBPHMatcher._wrap(hist_t, lab, sums, n + k, self.params)
+
+    @classmethod
+    def _wrap(cls, hist_t, labels, row_sums, count: int, params: dict) -> "LBPHMatcher":
+        """Matcher over already transposed buffers (no copy)."""
+        m = object.__new__(cls)
+        m.__dict__.update(params)
+        m._count = count
+        m._hist_t, m._labels, m._row_sums = hist_t, labels, row_sums
+        m._tail_taken = False
+        return m
+
+    # --- matching ---
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Chi-square (CHISQR_ALT) distance of each query to each training sample.
+
+        Args:
+            queries: float32 (Q, dim)
+
+        Returns:
+            float64 (Q, N)
+        """
+        n = self._count
+        out = np.empty((len(queries), n), np.float64)
+        for qi, q in enumerate(queries):
+            bins = np.flatnonzero(q)
+            qj = q[bins][:, None]
+            q_sum = q.sum(dtype=np.float64)
+            for start in range(0, n, SCORE_CHUNK_COLS):
+                stop = min(n, start + SCORE_CHUNK_COLS)
+                h = self._hist_t[bins, start:stop]  # gather -> private copy
+                s = h + qj
+                h *= qj
+                h /= s
+                cross = h.sum(axis=0, dtype=np.float64)
+                out[qi, start:stop] = 2.0 * (self._row_sums[start:stop] + q_sum - 4.0 * cross)
+        return out
+
+    def predict_many(self, images, executor=None) -> List[Tuple[int, float]]:
+        """
+        (label, distance) per image, same semantics as cv2 predict().
+
+        With an executor (concurrent.futures), images are scored in parallel:
+        NumPy releases the GIL in the gather/ufunc/reduction loops and the
+        matcher is read-only, so no locking is needed.
+        """
+        if self._count == 0:
+            raise ValueError("LBPH matcher has no training data")
+        if executor is not None and len(images) > 1:
+            return list(executor.map(self.predict, images))
+        queries = extract_histograms(images, **self.params)
+        dist = self.distances(queries)
+        best = dist.argmin(axis=1)  # first minimum, like OpenCV
+        return [(int(self._labels[i]), float(dist[qi, i])) for qi, i in enumerate(best)]
+
+    def predict(self, image) -> Tuple[int, float]:
+        return self.predict_many([image])[0]
+
+# ====== PERSISTENCE ======
+
+class LBPHModelStore:
+    """
+    Binary LBPH model in a directory:
+
+        model.json           header (format, params, count, file names)
+        hist.<token>.npy     (capacity, dim), rows [0, count) valid
+        labels.<token>.npy   int64 (capacity,)
+
+    LBPH histograms are pixel counts divided by the cell size, so they are
+    stored as exact uint16 counts plus a scale (half the size of float32);
+    float32 is used only if a row does not round-trip exactly.
+
+    Rows are stored sample-major so appending a registration only touches
+    its own rows. model.json is written last via os.replace, so a crash
+    never exposes half-written rows. Array files are never modified below
+    the published count, which lets readers keep old memory maps open.
+    """
+
+    FORMAT = "lbph-npy-1"
+
+    def __init__(self, model_dir: str):
+        self.model_dir = model_dir
+        self.header_path = os.path.join(model_dir, "model.json")
+        self._header = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.header_path)
+
+    def _read_header(self) -> dict:
+        with open(self.header_path, "r") as f:
+            header = json.load(f)
+        if header.get("format") != self.FORMAT:
+            raise ValueError(f"unknown LBPH model format: {header.get('format')}")
+        return header
+
+    def _write_header(self, header: dict):
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, self.header_path)
+        self._header = header
+
+    def _cleanup(self, keep):
+        """Remove array files no longer referenced (may fail on Windows while mapped)."""
+        for fname in os.listdir(self.model_dir):
+            if fname.endswith(".npy") and fname not in keep:
+                try:
+                    os.remove(os.path.join(self.model_dir, fname))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _count_scale(rows: np.ndarray) -> Optional[int]:
+        """Pixels per cell if every value is exactly count / scale, else None."""
+        nonzero = rows[rows > 0]
+        if nonzero.size == 0:
+            return None
+        scale = int(round(1.0 / float(nonzero.min())))
+        if not 0 < scale <= np.iinfo(np.uint16).max:
+            return None
+        return scale if LBPHModelStore._encodes(rows, scale) else None
+
+    @staticmethod
+    def _encodes(rows: np.ndarray, scale: int) -> bool:
+        counts = np.rint(rows * np.float32(scale))
+        return bool(np.array_equal(counts.astype(np.float32) / np.float32(scale), rows))
+
+    @staticmethod
+    def _decode(rows: np.ndarray, scale) -> np.ndarray:
+        if scale is None:
+            return np.asarray(rows, np.float32)
+        return rows.astype(np.float32) / np.float32(scale)
+
+    @staticmethod
+    def _encode(rows: np.ndarray, scale) -> np.ndarray:
+        if scale is None:
+            return rows
+        return np.rint(rows * np.float32(scale)).astype(np.uint16)
+
+    def load(self) -> Optional[LBPHMatcher]:
+        """
+        Decode the saved model into an in-RAM matcher (None if no model saved).
+        The arrays are opened read-only mapped only to stream the decode a
+        block at a time; the matcher does not keep the mapping.
+        """
+        if not self.exists():
+            return None
+        header = self._read_header()
+        n, dim, scale = header["count"], header["dim"], header.get("scale")
+        params = {k: header[k] for k in ("radius", "neighbors", "grid_x", "grid_y")}
+        hist = np.load(os.path.join(self.model_dir, header["histograms"]), mmap_mode="r")
+        labels = np.load(os.path.join(self.model_dir, header["labels"]), mmap_mode="r")
+        # Decode straight into the matcher's transposed layout, a block at a time
+        hist_t = np.empty((dim, n), np.float32)
+        row_sums = np.empty(n, np.float64)
+        for start in range(0, n, LOAD_CHUNK_ROWS):
+            block = self._decode(hist[start:min(n, start + LOAD_CHUNK_ROWS)], scale)
+            hist_t[:, start:start + len(block)] = block.T
+            row_sums[start:start + len(block)] = block.sum(axis=1, dtype=np.float64)
+        self._header = header
+        return LBPHMatcher._wrap(hist_t, np.array(labels[:n], np.int64), row_sums, n, params)
+
+    def save(self, matcher: LBPHMatcher, capacity: Optional[int] = None):
+        """Write a complete model into fresh array files (with room for appends)."""
+        os.makedirs(self.model_dir, exist_ok=True)
+        n = len(matcher)
+        capacity = max(n, capacity or n + max(64, n // 4))
+        rows = matcher.histograms
+        scale = self._count_scale(rows)
+        token = uuid.uuid4().hex[:12]
+        hist_name, labels_name = f"hist.{token}.npy", f"labels.{token}.npy"
+        hist = np.lib.format.open_memmap(os.path.join(self.model_dir, hist_name), mode="w+",
+                                         dtype=np.float32 if scale is None else np.uint16,
+                                         shape=(capacity, matcher.dim))
+        labels = np.lib.format.open_memmap(os.path.join(self.model_dir, labels_name), mode="w+",
+                                           dtype=np.int64, shape=(capacity,))
+        hist[:n] = self._encode(rows, scale)
+        labels[:n] = matcher.labels
+        hist.flush(); labels.flush()
+        del hist, labels
+        header = dict(format=self.FORMAT, count=n, capacity=capacity, dim=matcher.dim, scale=scale,
+                      histograms=hist_name, labels=labels_name, **matcher.params)
+        self._write_header(header)
+        self._cleanup({hist_name, labels_name})
+
+    def append(self, matcher: LBPHMatcher, start: int):
+        """
+        Persist rows [start, len(matcher)) of a matcher extended from the saved
+        model (which must hold exactly `start` rows). Falls back to save().
+        """
+        header = self._header or (self._read_header() if self.exists() else None)
+        n = len(matcher)
+        rows = matcher.histograms[start:n]
+        if header is None or header["count"] != start or n > header["capacity"] \
+                or header["dim"] != matcher.dim \
+                or (header.get("scale") is not None and not self._encodes(rows, header["scale"])):
+            self.save(matcher)
+            return
+        hist = np.load(os.path.join(self.model_dir, header["histograms"]), mmap_mode="r+")
+        labels = np.load(os.path.join(self.model_dir, header["labels"]), mmap_mode="r+")
+        hist[start:n] = self._encode(rows, header.get("scale"))
+        labels[start:n] = matcher.labels[start:n]
+        hist.flush(); labels.flush()
+        del hist, labels
+        self._write_header(dict(header, count=n))
+
+    def clear(self):
+        if self.exists():
+            os.remove(self.header_path)
+            self._header = None
+            self._cleanup(set())
+
+    def disk_size(self) -> int:
+        """Bytes on disk for the current header + referenced arrays."""
+        if not self.exists():
+            return 0
+        header = self._read_header()
+        return sum(os.path.getsize(os.path.join(self.model_dir, f))
+                   for f in ("model.json", header["histograms"], header["labels"]))
@@ -7,12 +7,12 @@
   const pageNumber = document.getElementById('page-number');
   const sortHeaders = document.querySelectorAll('.sortable');
   const bodyEl = document.getElementById('tabel-pasien-body');
+  const searchInput = document.getElementById('search-pasien');
 
   // Arrows
   const arrowMap = {
     nik: document.getElementById('arrow-nik'),
     name: document.getElementById('arrow-name'),
-    dob: document.getElementById('arrow-dob'),
     address: document.getElementById('arrow-address')
   };
 
@@ -26,8 +26,15 @@
   const editAlamat = document.getElementById('edit-alamat');
   const btnEditCancel = document.getElementById('btn-edit-cancel');
 
+  // Data diambil per halaman dari server (keyset pagination).
+  // cursors[i] = cursor untuk halaman ke-(i+1); sort dikirim ke server (berlaku seluruh tabel).
+  // Jika query terisi, data diambil dari /api/patients/search (urut relevansi, header sort nonaktif).
   let state = {
+    query: '',
     patients: [],
+    total: 0,
+    cursors: [null],
+    nextCursor: null,
     sortKey: 'nik',
     sortDir: 'asc',
     rowsPerPage: 10,
@@ -38,31 +45,15 @@
     Object.keys(arrowMap).forEach(k => {
       arrowMap[k].textContent = '';
     });
+    if(state.query) return;
     const arrow = state.sortDir === 'asc' ? '▲' : '▼';
     arrowMap[state.sortKey].textContent = arrow;
   }
 
-  function sort() {
-    const { sortKey, sortDir } = state;
-    state.patients.sort((a,b)=>{
-      if(a[sortKey] < b[sortKey]) return sortDir==='asc' ? -1 : 1;
-      if(a[sortKey] > b[sortKey]) return sortDir==='asc' ? 1 : -1;
-      return 0;
-    });
-    updateArrows();
-  }
-
-  function pageData() {
-    const start=(state.currentPage-1)*state.rowsPerPage;
-    return state.patients.slice(start,start+state.rowsPerPage);
-  }
-
   function render() {
     bodyEl.innerHTML='';
-    const total = state.patients.length;
-    const totalPages = Math.ceil(total/state.rowsPerPage)||1;
-    state.currentPage = Math.min(state.currentPage,totalPages);
-    const data = pageData();
+    const total = state.total;
+    const data = state.patients;
     if(data.length===0){
       bodyEl.innerHTML='<tr><td colspan="5" class="py-6 px-4 text-center text-gray-400">Tidak ada data pasien.</td></tr>';
     } else {
@@ -84,47 +75,76 @@
         bodyEl.appendChild(tr);
       });
     }
-    const startRange = total===0?0:(state.currentPage-1)*state.rowsPerPage+1;
-    const endRange = Math.min(state.currentPage*state.rowsPerPage,total);
-    pageInfo.textContent=`Menampilkan ${startRange}-${endRange} dari ${total}`;
-    pageNumber.textContent=`Halaman ${state.currentPage} / ${totalPages}`;
+    const startRange = data.length===0?0:(state.currentPage-1)*state.rowsPerPage+1;
+    const endRange = startRange===0?0:startRange+data.length-1;
+    if(state.query){
+      pageInfo.textContent=`Hasil cari ${startRange}-${endRange}`;
+      pageNumber.textContent=`Halaman ${state.currentPage}`;
+    } else {
+      const totalPages = Math.ceil(total/state.rowsPerPage)||1;
+      pageInfo.textContent=`Menampilkan ${startRange}-${endRange} dari ${total}`;
+      pageNumber.textContent=`Halaman ${state.currentPage} / ${totalPages}`;
+    }
     prevPageBtn.disabled = state.currentPage===1;
-    nextPageBtn.disabled = state.currentPage===totalPages;
+    nextPageBtn.disabled = !state.nextCursor;
   }
 
   async function fetchPatients(){
     try{
-      const r=await fetch('/api/patients');
+      const params=new URLSearchParams({limit:state.rowsPerPage});
+      const cursor=state.cursors[state.currentPage-1];
+      if(cursor) params.set('cursor',cursor);
+      if(state.query) params.set('q',state.query);
+      else { params.set('sort',state.sortKey); params.set('dir',state.sortDir); }
+      const url=(state.query?'/api/patients/search?':'/api/patients?')+params.toString();
+      const r=await fetch(url);
       const d=await r.json();
       if(!d.ok){alert(d.msg||'Gagal memuat pasien');return;}
       state.patients=d.patients||[];
-      sort();render();
+      state.total=d.total||0;
+      state.nextCursor=d.next_cursor||null;
+      state.cursors[state.currentPage]=state.nextCursor;
+      updateArrows();render();
     }catch(e){alert('Error jaringan: '+e.message);}
   }
 
+  function resetPaging(){
+    state.cursors=[null];
+    state.currentPage=1;
+  }
+
   sortHeaders.forEach(h=>{
     h.addEventListener('click',()=>{
+      if(state.query) return;
       const key=h.dataset.sort;
       if(state.sortKey===key) state.sortDir = state.sortDir==='asc'?'desc':'asc';
       else { state.sortKey=key; state.sortDir='asc'; }
       sortHeaders.forEach(x=>x.classList.remove('active'));
       h.classList.add('active');
-      sort(); state.currentPage=1; render();
+      resetPaging(); fetchPatients();
     });
   });
 
+  let searchTimer=null;
+  searchInput.addEventListener('input',()=>{
+    clearTimeout(searchTimer);
+    searchTimer=setTimeout(()=>{
+      state.query=searchInput.value.trim();
+      resetPaging(); fetchPatients();
+    },250);
+  });
+
   showRowsSelect.addEventListener('change',()=>{
     state.rowsPerPage=parseInt(showRowsSelect.value,10);
-    state.currentPage=1; render();
+    resetPaging(); fetchPatients();
   });
 
   prevPageBtn.addEventListener('click',()=>{
-    if(state.currentPage>1){ state.currentPage--; render(); }
+    if(state.currentPage>1){ state.currentPage--; fetchPatients(); }
   });
 
   nextPageBtn.addEventListener('click',()=>{
-    const totalPages=Math.ceil(state.patients.length/state.rowsPerPage)||1;
-    if(state.currentPage<totalPages){ state.currentPage++; render(); }
+    if(state.nextCursor){ state.currentPage++; fetchPatients(); }
   });
 
   bodyEl.addEventListener('click',e=>{
@@ -158,6 +178,7 @@
       if(!d.ok){alert(d.msg||'Gagal update');return;}
       alert(d.msg);
       modalEdit.classList.add('hidden');
+      resetPaging();
       await fetchPatients();
     }catch(err){alert('Error jaringan: '+err.message);}
   });
@@ -64,8 +64,8 @@ def test_cascade_classifiers():
     """Test cascade classifiers loaded (for LBPH fallback)"""
     print("\nTest 4: Cascade classifiers...")
     try:
-        from app import detectors
-        count = len(detectors)
+        from app import get_detectors
+        count = len(get_detectors())
         if count > 0:
             print(f"  ✓ {count} cascade classifier(s) loaded")
         else:
@@ -206,6 +206,111 @@ def test_flask_routes():
         print(f"  ✗ Error: {e}")
         return False
 
+def test_patient_directory():
+    """Test in-memory patient directory (write-through cache)"""
+    print("\nTest 11: Patient directory...")
+    try:
+        from app import PatientDirectory
+
+        directory = PatientDirectory()
+        directory.upsert(1111222233334444, "Budi", "2000-01-31", "Jakarta", "2025-01-01T08:00:00")
+        rec = directory.get(1111222233334444)
+        if rec is None or rec["age"] == "N/A":
+            print(f"  ✗ Upsert/get failed: {rec}")
+            return False
+        print(f"  ✓ Upsert + get works (age: {rec['age']})")
+
+        directory.update(1111222233334444, 5555666677778888, "31-01-2000", "Bandung")
+        if directory.get(1111222233334444) is not None or directory.get(5555666677778888)["address"] != "Bandung":
+            print("  ✗ NIK update not applied")
+            return False
+        print("  ✓ NIK update moves the record")
+
+        directory.remove(5555666677778888)
+        if len(directory) != 0:
+            print("  ✗ Remove failed")
+            return False
+        print("  ✓ Remove works")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_patient_search_index():
+    """Test FTS5 search index maintained by triggers"""
+    print("\nTest 12: Patient search index...")
+    try:
+        import sqlite3
+        import app
+
+        conn = sqlite3.connect(":memory:")
+        conn.execute("""
+            CREATE TABLE patients (
+                nik INTEGER PRIMARY KEY, name TEXT NOT NULL, dob TEXT NOT NULL,
+                address TEXT NOT NULL, created_at TEXT NOT NULL
+            )
+        """)
+        app.init_patient_search_index(conn)
+        if not app.FTS_AVAILABLE:
+            print("  ⚠ FTS5 not available in this SQLite build (LIKE fallback)")
+            return True
+
+        def find(text):
+            return [r[0] for r in conn.execute(
+                "SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?", (app.fts_match_query(text),)
+            )]
+
+        conn.execute("INSERT INTO patients VALUES (3578100000000012, 'Siti Aminah', '2000-01-01', 'Jl. Merdeka Surabaya', '2025-01-01')")
+        if find("ami sura") != [3578100000000012]:
+            print("  ✗ Insert trigger did not index row")
+            return False
+        print("  ✓ Insert indexed (prefix match on name + address)")
+
+        conn.execute("UPDATE patients SET address = 'Malang' WHERE nik = 3578100000000012")
+        if find("surabaya") or find("malang") != [3578100000000012]:
+            print("  ✗ Update trigger did not refresh index")
+            return False
+        print("  ✓ Update re-indexed")
+
+        conn.execute("DELETE FROM patients WHERE nik = 3578100000000012")
+        if find("siti"):
+            print("  ✗ Delete trigger did not remove row")
+            return False
+        print("  ✓ Delete removed from index")
+
+        ranges = app.nik_prefix_ranges("357810")
+        if not any(lo <= 3578100000000012 <= hi for lo, hi in ranges):
+            print("  ✗ NIK prefix ranges miss a matching NIK")
+            return False
+        print(f"  ✓ NIK prefix -> {len(ranges)} index ranges")
+
+        if app.search_patients("1" * (app.NIK_MAX_DIGITS + 1), 10) != ([], None):
+            print("  ✗ Over-long NIK query not answered with an empty result")
+            return False
+        print("  ✓ Over-long NIK query -> empty result")
+
+        def walk(q):
+            niks, cursor = [], None
+            while True:
+                records, next_cursor = app.search_patients(q, 1, app.parse_page_cursor(cursor or ""))
+                niks += [r["nik"] for r in records]
+                if not next_cursor:
+                    return niks
+                cursor = next_cursor
+
+        page, _ = app.search_patients("3", app.PATIENTS_PAGE_MAX)
+        sample = page[0]["name"].split()[0] if page else None
+        for q in ["3"] + ([sample] if sample else []):
+            full = [r["nik"] for r in app.search_patients(q, app.PATIENTS_PAGE_MAX)[0]]
+            if walk(q) != full:
+                print(f"  ✗ Keyset search pages differ from one page for {q!r}")
+                return False
+        print("  ✓ Search pages with a keyset cursor (NIK prefix and FTS)")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
 def main():
     print("=" * 60)
     print("BASIC FUNCTIONALITY TESTS")
@@ -221,7 +326,9 @@ def main():
         test_preprocessing_function,
         test_file_naming,
         test_embedding_functions,
-        test_flask_routes
+        test_flask_routes,
+        test_patient_directory,
+        test_patient_search_index
     ]
     
     results = []
@@ -6,6 +6,7 @@ Supports both InsightFace and LBPH engines
 
 import sys
 import os
+import time
 import cv2
 import numpy as np
 
@@ -297,12 +298,1494 @@ def test_api_endpoints():
         else:
             print(f"  ✗ GET /api/patients failed: {response.status_code}")
             return False
-        
+
+        # Retrain only schedules a rebuild: the flash must say so and name the target generation
+        import app as app_module
+        with client.session_transaction() as sess:
+            sess["admin_logged_in"] = True
+        page = client.post('/admin/retrain', follow_redirects=True).get_data(as_text=True)
+        if "Retrain sukses" in page or "Retrain dijadwalkan" not in page or "Generasi:" not in page:
+            print("  ✗ POST /admin/retrain does not report the scheduled rebuild")
+            return False
+        app_module.lbph_wait_idle()
+        page = client.get('/admin').get_data(as_text=True)
+        if "retrain sedang berjalan" in page:
+            print("  ✗ Dashboard still shows the retrain as running after the worker finished")
+            return False
+        print("  ✓ POST /admin/retrain reports the scheduled rebuild; dashboard shows when it is done")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_recent_identity_cache():
+    """Test recent identity cache hit/miss and invalidation"""
+    print("\nTest 10: Recent identity cache...")
+    try:
+        import face_engine
+
+        cache = face_engine.RecentIdentityCache(max_size=2, ttl=60)
+        emb = face_engine.normalize_embedding(np.random.randn(512).astype(np.float32))
+        other = face_engine.normalize_embedding(np.random.randn(512).astype(np.float32))
+        cache.remember(TEST_NIK, [emb])
+
+        hit = cache.lookup(emb, 0.9)
+        if hit is None or hit[0] != TEST_NIK:
+            print(f"  ✗ Expected cache hit for NIK {TEST_NIK}, got {hit}")
+            return False
+        print(f"  ✓ Cache hit (sim: {hit[1]:.3f})")
+
+        if cache.lookup(other, 0.9) is not None:
+            print("  ✗ Unrelated embedding should miss")
+            return False
+        print("  ✓ Unrelated embedding misses")
+
+        cache.invalidate(TEST_NIK)
+        if cache.lookup(emb, 0.9) is not None:
+            print("  ✗ Invalidated NIK still returned")
+            return False
+        stats = cache.stats()
+        print(f"  ✓ Invalidation works (hit rate: {stats['hit_rate']:.2f})")
+
+        saved = (dict(face_engine._recent_caches), face_engine.RECENT_CACHE_MAX_KIOSKS, face_engine.RECENT_CACHE_KIOSKS)
+        face_engine._recent_caches.clear()
+        face_engine.RECENT_CACHE_MAX_KIOSKS, face_engine.RECENT_CACHE_KIOSKS = 3, set()
+        try:
+            kept = face_engine.get_recent_cache("kiosk-0")
+            for i in range(1, 50):
+                face_engine.get_recent_cache(f"kiosk-{i}")
+                face_engine.get_recent_cache("kiosk-0")  # Busy kiosk stays cached
+            bounded = list(face_engine._recent_caches)
+            face_engine.RECENT_CACHE_KIOSKS = {"kiosk-0"}
+            spoofed = face_engine.get_recent_cache("made-up") is face_engine.get_recent_cache("default")
+            allowed = face_engine.get_recent_cache("kiosk-0") is kept
+        finally:
+            face_engine._recent_caches.clear()
+            face_engine._recent_caches.update(saved[0])
+            face_engine.RECENT_CACHE_MAX_KIOSKS, face_engine.RECENT_CACHE_KIOSKS = saved[1], saved[2]
+        if len(bounded) != 3 or "kiosk-0" not in bounded or not spoofed or not allowed:
+            print(f"  ✗ Kiosk caches not bounded: {bounded}, spoofed={spoofed}, allowed={allowed}")
+            return False
+        print("  ✓ Kiosk caches bounded (LRU), unknown ids share the default cache")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_patients_pagination():
+    """Test keyset pagination and ETag on /api/patients"""
+    print("\nTest 11: Patients pagination...")
+    try:
+        from app import app
+
+        client = app.test_client()
+        response = client.get('/api/patients?limit=2')
+        data = response.get_json()
+        if response.status_code != 200 or len(data['patients']) > 2:
+            print(f"  ✗ First page failed: {response.status_code}")
+            return False
+        print(f"  ✓ First page: {len(data['patients'])} of {data['total']} patients")
+
+        etag = response.headers.get('ETag')
+        cached = client.get('/api/patients?limit=2', headers={'If-None-Match': etag})
+        if cached.status_code != 304:
+            print(f"  ✗ Expected 304 for matching ETag, got {cached.status_code}")
+            return False
+        print("  ✓ If-None-Match returns 304")
+
+        seen = [p['nik'] for p in data['patients']]
+        cursor = data['next_cursor']
+        while cursor:
+            page = client.get('/api/patients', query_string={'limit': 2, 'cursor': cursor}).get_json()
+            seen += [p['nik'] for p in page['patients']]
+            cursor = page['next_cursor']
+        if len(seen) != len(set(seen)) or len(seen) != data['total']:
+            print(f"  ✗ Pages overlap or miss rows ({len(seen)} rows, total {data['total']})")
+            return False
+        print(f"  ✓ Walked all pages ({len(seen)} rows, no duplicates)")
+
+        def walk(sort, direction):
+            rows, cursor = [], ''
+            while True:
+                page = client.get('/api/patients', query_string={
+                    'limit': 2, 'sort': sort, 'dir': direction, 'cursor': cursor}).get_json()
+                rows += page['patients']
+                cursor = page['next_cursor']
+                if not cursor:
+                    return rows
+
+        by_name = walk('name', 'asc')
+        by_nik = walk('nik', 'desc')
+        if ([(p['name'].lower(), p['nik']) for p in by_name] != sorted((p['name'].lower(), p['nik']) for p in by_name)
+                or [p['nik'] for p in by_nik] != sorted(seen, reverse=True) or len(by_name) != len(seen)):
+            print("  ✗ Server-side sort not applied across pages")
+            return False
+        if client.get('/api/patients?sort=dob').status_code != 400:
+            print("  ✗ Unsupported sort column accepted")
+            return False
+        print("  ✓ Sort by column applies to the whole table (name asc, NIK desc)")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_lbph_tombstones():
+    """Test LBPH event batching: delete/rename as tombstones, compaction by rebuild"""
+    print("\nTest 12: LBPH tombstones & batching...")
+    try:
+        from app import LBPHState, plan_lbph_batch, LBPH_COMPACT_TOMBSTONES
+
+        state = LBPHState(1, None, (), {})
+        other_nik = TEST_NIK - 1
+        rebuild, adds, tombstones, label_map = plan_lbph_batch(state, [
+            ("add", other_nik, ["a.jpg"]),
+            ("rename", TEST_NIK, other_nik + 2),
+            ("add", other_nik, ["b.jpg"]),
+        ])
+        if rebuild or adds != {other_nik: ["a.jpg", "b.jpg"]}:
+            print("  ✗ Adds for one NIK not coalesced into one update")
+            return False
+        print("  ✓ Adds coalesced into one incremental update")
+
+        renamed = LBPHState(2, None, tombstones, label_map)
+        if renamed.resolve(TEST_NIK) != other_nik + 2:
+            print("  ✗ Renamed label not mapped to new NIK")
+            return False
+        print(f"  ✓ Rename maps label {TEST_NIK} -> {other_nik + 2}")
+
+        _, _, tombstones, label_map = plan_lbph_batch(renamed, [("delete", other_nik + 2)])
+        deleted = LBPHState(3, None, tombstones, label_map)
+        if deleted.resolve(TEST_NIK) is not None or deleted.resolve(other_nik + 2) is not None:
+            print("  ✗ Deleted NIK still resolvable")
+            return False
+        print("  ✓ Delete tombstones both old and new labels")
+
+        if not plan_lbph_batch(deleted, [("add", TEST_NIK, ["c.jpg"])])[0]:
+            print("  ✗ Re-adding a tombstoned label should force a rebuild")
+            return False
+        events = [("delete", TEST_NIK + i) for i in range(LBPH_COMPACT_TOMBSTONES)]
+        if not plan_lbph_batch(state, events)[0]:
+            print("  ✗ Too many tombstones should force a rebuild")
+            return False
+        print("  ✓ Label reuse and tombstone limit trigger full rebuild")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_packed_dataset():
+    """Test packed training-set cache follows add/delete/rename"""
+    print("\nTest 13: Packed dataset...")
+    try:
+        import tempfile
+        import numpy as np
+        import cv2
+        from app import PackedDataset
+
+        with tempfile.TemporaryDirectory() as tmp:
+            data_dir = os.path.join(tmp, "data")
+            os.makedirs(data_dir)
+            rng = np.random.default_rng(0)
+            for nik in (TEST_NIK, TEST_NIK - 1):
+                for i in range(1, 4):
+                    img = (rng.random((200, 200)) * 255).astype(np.uint8)
+                    cv2.imwrite(os.path.join(data_dir, f"{nik}.{i}.jpg"), img)
+
+            pack = PackedDataset(os.path.join(tmp, "pack"), data_dir)
+            pack.sync()
+            faces, labels = pack.snapshot()
+            if faces.shape != (6, 200, 200) or sorted(set(labels.tolist())) != [TEST_NIK - 1, TEST_NIK]:
+                print(f"  ✗ Unexpected pack contents: {faces.shape}")
+                return False
+            print(f"  ✓ Packed {len(faces)} crops into one buffer")
+
+            pack.remove_nik(TEST_NIK - 1)
+            for i in range(1, 4):
+                os.remove(os.path.join(data_dir, f"{TEST_NIK - 1}.{i}.jpg"))
+                os.rename(os.path.join(data_dir, f"{TEST_NIK}.{i}.jpg"),
+                          os.path.join(data_dir, f"{TEST_NIK + 1}.{i}.jpg"))
+            pack.rename_nik(TEST_NIK, TEST_NIK + 1)
+            extra = []
+            for i in range(4, 7):
+                extra.append(os.path.join(data_dir, f"{TEST_NIK + 1}.{i}.jpg"))
+                cv2.imwrite(extra[-1], np.full((200, 200), 30 * i, np.uint8))
+            manifest_mtime = os.stat(pack.manifest_path).st_mtime_ns
+            pack.add_files(extra)
+            if (pack.stats()['journal_lines'] != 3
+                    or os.stat(pack.manifest_path).st_mtime_ns != manifest_mtime):
+                print(f"  ✗ Incremental ops rewrote the manifest: {pack.stats()}")
+                return False
+            journaled = PackedDataset(os.path.join(tmp, "pack"), data_dir)
+            _, labels = journaled.snapshot()  # no sync: manifest + journal replay only
+            if labels.tolist() != [TEST_NIK + 1] * 6:
+                print(f"  ✗ Journal replay wrong: {labels.tolist()}")
+                return False
+            print("  ✓ Add/delete/rename appended to the journal (one line each), replayed on open")
+            for path in extra:
+                os.remove(path)
+
+            reopened = PackedDataset(os.path.join(tmp, "pack"), data_dir)
+            reopened.sync()
+            faces, labels = reopened.snapshot()
+            if labels.tolist() != [TEST_NIK + 1] * 3:
+                print(f"  ✗ Delete/rename not reflected: {labels.tolist()}")
+                return False
+            expected = cv2.imread(os.path.join(data_dir, f"{TEST_NIK + 1}.3.jpg"), cv2.IMREAD_GRAYSCALE)
+            if not any(np.array_equal(f, expected) for f in faces):
+                print("  ✗ Packed crop differs from file on disk")
+                return False
+            if reopened.stats()['journal_lines'] != 0 or os.path.exists(reopened.journal_path):
+                print("  ✗ sync() did not fold the journal into the manifest")
+                return False
+            print("  ✓ Delete/rename persisted and reopened from manifest")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_dataset_signature():
+    """Test Merkle-style dataset signature used to skip redundant retrains"""
+    print("\nTest 14: Dataset signature...")
+    try:
+        from app import DatasetSignature
+
+        files = {f"{TEST_NIK}.{i}.jpg": f"{i:040x}" for i in range(1, 21)}
+        sig = DatasetSignature(files)
+        same = DatasetSignature(dict(reversed(list(files.items()))))
+        if sig.root() != same.root():
+            print("  ✗ Signature depends on insertion order")
+            return False
+        print(f"  ✓ Same files give same root ({sig.root()[:12]}...)")
+
+        changed = sig.copy()
+        changed.set(f"{TEST_NIK}.1.jpg", "f" * 40)
+        dirty = sum(1 for d in changed._digests if d is None)
+        if changed.root() == sig.root() or dirty != 1:
+            print(f"  ✗ Change not detected or too many dirty buckets ({dirty})")
+            return False
+        print("  ✓ Changed file re-hashes only its bucket")
+
+        renamed = sig.copy()
+        renamed.rename_nik(TEST_NIK, TEST_NIK - 1)
+        expected = DatasetSignature({f"{TEST_NIK - 1}.{f.split('.', 1)[1]}": d for f, d in files.items()})
+        if renamed.root() != expected.root() or renamed.root() == sig.root():
+            print("  ✗ Rename not reflected in signature")
+            return False
+        renamed.remove_nik(TEST_NIK - 1)
+        if len(renamed) != 0 or renamed.root() != DatasetSignature().root():
+            print("  ✗ Delete not reflected in signature")
+            return False
+        print("  ✓ Rename/delete tracked without full rehash")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_lbph_matcher():
+    """Test vectorized LBPH matcher matches cv2 LBPH predict"""
+    print("\nTest 15: Vectorized LBPH matcher...")
+    try:
+        if not hasattr(cv2, "face"):
+            print("  ℹ cv2.face not available, skipping comparison")
+            return True
+        from lbph_matcher import LBPHMatcher
+
+        rng = np.random.default_rng(0)
+
+        def fake_face():
+            small = (rng.random((40, 40)) * 255).astype(np.uint8)
+            return cv2.equalizeHist(cv2.resize(small, (200, 200), interpolation=cv2.INTER_CUBIC))
+
+        faces = [fake_face() for _ in range(12)]
+        labels = [100 + (i % 4) for i in range(12)]  # cv2 labels are int32
+        reference = cv2.face.LBPHFaceRecognizer_create(1, 8, 8, 8)
+        reference.train(faces, np.array(labels))
+
+        matcher = LBPHMatcher.from_images(faces[:6], labels[:6]).extended(faces[6:], labels[6:])
+        if not np.allclose(matcher.histograms, LBPHMatcher.from_recognizer(reference).histograms, atol=1e-6):
+            print("  ✗ Histograms differ from OpenCV")
+            return False
+        print(f"  ✓ Histograms identical to OpenCV ({len(matcher)} samples)")
+
+        queries = [cv2.GaussianBlur(f, (3, 3), 0) for f in faces[::3]] + [fake_face()]
+        for query, (label, dist) in zip(queries, matcher.predict_many(queries)):
+            ref_label, ref_dist = reference.predict(query)
+            if label != ref_label or abs(dist - ref_dist) > 1e-4 * max(1.0, ref_dist):
+                print(f"  ✗ Mismatch: ({label}, {dist:.4f}) vs OpenCV ({ref_label}, {ref_dist:.4f})")
+                return False
+        print(f"  ✓ predict_many matches cv2 predict for {len(queries)} frames")
+
+        big = LBPHMatcher(matcher.histograms, [TEST_NIK] * len(matcher))
+        if big.predict(faces[0])[0] != TEST_NIK:
+            print("  ✗ 16-digit NIK label not preserved")
+            return False
+        print("  ✓ 16-digit NIK labels preserved (int64)")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_lbph_model_store():
+    """Test binary LBPH model store: save, append and load"""
+    print("\nTest 16: Binary LBPH model store...")
+    try:
+        import json
+        import tempfile
+        from lbph_matcher import LBPHMatcher, LBPHModelStore
+
+        rng = np.random.default_rng(1)
+        faces = [cv2.equalizeHist((rng.random((200, 200)) * 255).astype(np.uint8)) for _ in range(8)]
+        labels = [TEST_NIK - (i % 2) for i in range(8)]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = LBPHModelStore(os.path.join(tmp, "lbph"))
+            base = LBPHMatcher.from_images(faces[:5], labels[:5])
+            store.save(base)
+            grown = base.extended(faces[5:], labels[5:])
+            store.append(grown, len(base))
+
+            with open(store.header_path) as f:
+                header = json.load(f)
+            if header["count"] != 8 or header["scale"] is None:
+                print(f"  ✗ Unexpected header: count={header['count']} scale={header['scale']}")
+                return False
+            print(f"  ✓ Appended in place, stored as uint16 counts (scale {header['scale']})")
+
+            loaded = LBPHModelStore(store.model_dir).load()
+            if not np.array_equal(loaded.histograms, grown.histograms) or loaded.labels.tolist() != labels:
+                print("  ✗ Reloaded model differs")
+                return False
+            if loaded.predict(faces[6]) != grown.predict(faces[6]):
+                print("  ✗ Reloaded model predicts differently")
+                return False
+            print("  ✓ Reloaded model identical (histograms, int64 labels, predict)")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_lbph_concurrent_predict():
+    """Test shared LBPH matcher gives identical results under concurrent use"""
+    print("\nTest 17: Concurrent LBPH prediction...")
+    try:
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from lbph_matcher import LBPHMatcher
+
+        rng = np.random.default_rng(2)
+        faces = [cv2.equalizeHist((rng.random((200, 200)) * 255).astype(np.uint8)) for _ in range(10)]
+        matcher = LBPHMatcher.from_images(faces, [TEST_NIK - i for i in range(10)])
+        queries = [cv2.GaussianBlur(f, (3, 3), 0) for f in faces]
+        expected = matcher.predict_many(queries)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            if matcher.predict_many(queries, executor=pool) != expected:
+                print("  ✗ Parallel per-frame prediction differs from serial")
+                return False
+            print("  ✓ Per-frame parallel prediction matches serial")
+
+            errors = []
+
+            def request_thread():
+                if matcher.predict_many(queries, executor=pool) != expected:
+                    errors.append("mismatch")
+
+            threads = [threading.Thread(target=request_thread) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        if errors:
+            print(f"  ✗ {len(errors)} concurrent request(s) got different results")
+            return False
+        print(f"  ✓ {len(threads)} concurrent requests share one matcher without locking")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_synthetic_samples():
+    """Test augmentation stays in memory and old synthetic samples are detected"""
+    print("\nTest 18: In-memory augmentation / synthetic purge...")
+    try:
+        import tempfile
+        import app
+        import face_engine
+        import cleanup_orphan_data
+        import sqlite3
+        from augmentation import augment_img
+
+        rng = np.random.default_rng(3)
+        faces = [cv2.equalizeHist(cv2.GaussianBlur((rng.random((200, 200)) * 255).astype(np.uint8), (5, 5), 0))
+                 for _ in range(3)]
+        ids = [TEST_NIK, TEST_NIK, TEST_NIK - 1]
+        extra_faces, extra_ids = app.training_augmentation(faces, ids, {TEST_NIK: 2, TEST_NIK - 1: app.LBPH_MIN_SAMPLES})
+        if len(extra_faces) != 2 or set(extra_ids) != {TEST_NIK}:
+            print(f"  ✗ Unexpected augmentation: {extra_ids}")
+            return False
+        print("  ✓ Sparse NIKs get in-memory augmentation, full NIKs do not")
+
+        legacy_min = cleanup_orphan_data.LEGACY_MIN_SAMPLES
+        with tempfile.TemporaryDirectory() as tmp:
+            for i, face in enumerate(faces[:2], start=1):
+                cv2.imwrite(os.path.join(tmp, f"{TEST_NIK}.{i}.jpg"), face)
+            # Padding lama (ensure_min_samples): file berikutnya sampai legacy_min,
+            # round-robin augment_img dari file asli yang dibaca ulang dari JPEG
+            src = [cv2.imread(os.path.join(tmp, f"{TEST_NIK}.{i}.jpg"), cv2.IMREAD_GRAYSCALE) for i in (1, 2)]
+            for k in range(legacy_min - 2):
+                cv2.imwrite(os.path.join(tmp, f"{TEST_NIK}.{k + 3}.jpg"), augment_img(src[k % 2]))
+            # NIK lain: file asli saja, termasuk satu yang kebetulan mirip augmentasi tapi bukan ekor padding
+            for i in range(1, legacy_min + 1):
+                face = faces[2] if i != 2 else augment_img(faces[2])
+                cv2.imwrite(os.path.join(tmp, f"{TEST_NIK - 1}.{i}.jpg"), face)
+            old_dir = cleanup_orphan_data.DATA_DIR
+            cleanup_orphan_data.DATA_DIR = tmp
+            try:
+                found = sorted(os.path.basename(p) for _, p in cleanup_orphan_data.find_synthetic_files())
+            finally:
+                cleanup_orphan_data.DATA_DIR = old_dir
+        expected = sorted(f"{TEST_NIK}.{i}.jpg" for i in range(3, legacy_min + 1))
+        if found != expected:
+            print(f"  ✗ Synthetic file detection wrong: {found}")
+            return False
+        print("  ✓ Purge finds only the ensure_min_samples padding tail")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "embeddings.db")
+            conn = sqlite3.connect(db_path)
+            conn.execute("CREATE TABLE embeddings (id INTEGER PRIMARY KEY, nik INTEGER, embedding BLOB, quality_score REAL)")
+            base = [face_engine.normalize_embedding(rng.standard_normal(512).astype(np.float32)) for _ in range(7)]
+            # NIK padded lama: 2 asli + 3 salinan ber-noise (round-robin)
+            rows = [(TEST_NIK, base[0]), (TEST_NIK, base[1])]
+            rows += [(TEST_NIK, face_engine.normalize_embedding(base[k % 2] + rng.normal(0, 0.01, 512)).astype(np.float32))
+                     for k in range(3)]
+            # NIK asli 5 embedding, quality 0.5 tidak boleh dianggap sintetis
+            rows += [(TEST_NIK - 1, base[i]) for i in range(2, 7)]
+            conn.executemany("INSERT INTO embeddings (nik, embedding, quality_score) VALUES (?, ?, 0.5)",
+                             [(nik, emb.astype(np.float32).tobytes()) for nik, emb in rows])
+            conn.commit()
+            conn.close()
+            old_path = cleanup_orphan_data.EMBEDDING_DB_PATH
+            cleanup_orphan_data.EMBEDDING_DB_PATH = db_path
+            try:
+                found = sorted(row_id for row_id, _ in cleanup_orphan_data.find_synthetic_embeddings())
+            finally:
+                cleanup_orphan_data.EMBEDDING_DB_PATH = old_path
+        if found != [3, 4, 5]:
+            print(f"  ✗ Synthetic embedding detection wrong: {found}")
+            return False
+        print("  ✓ Purge finds only the round-robin noisy embedding tail")
+
+        emb = face_engine.normalize_embedding(rng.standard_normal(face_engine.EMBEDDING_DIM).astype(np.float32))
+        real = [emb]
+        padded = face_engine._pad_index_embeddings(TEST_NIK, real, 5)
+        if len(real) != 1 or len(padded) != 5 or min(float(np.dot(emb, e)) for e in padded) < 0.95:
+            print("  ✗ Index padding wrong")
+            return False
+        print("  ✓ Embedding index padding is in-memory only")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_fallback_detection():
+    """Test Haar fallback: per-thread cascades, downscaled detection, ROI hint"""
+    print("\nTest 19: Fallback detection pipeline...")
+    try:
+        import threading
+        import app
+        import face_engine
+
+        sample = cv2.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_scan.jpg"))
+        if sample is None:
+            print("  ⚠ temp_scan.jpg not found, skipped")
+            return True
+        frame = np.full((480, 640, 3), 120, np.uint8)
+        frame[100:340, 250:490] = cv2.resize(sample, (240, 240))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        roi, rect = app.detect_largest_face(gray)
+        if rect is None or not (230 <= rect[0] + rect[2] // 2 <= 410 and 130 <= rect[1] + rect[3] // 2 <= 310):
+            print(f"  ✗ Downscaled detection missed the face: {rect}")
+            return False
+        print(f"  ✓ Face found on downscaled frame, rescaled to {rect}")
+
+        from face_tracker import FaceTracker
+        hint = FaceTracker()
+        hint.update(rect, True)
+        _, tracked = app.detect_largest_face(gray, tracker=hint)
+        wrong = FaceTracker()
+        wrong.update((0, 0, 80, 80), True)
+        _, lost = app.detect_largest_face(gray, tracker=wrong)
+        if tracked is None or lost is None or abs(tracked[0] - rect[0]) > 30:
+            print(f"  ✗ ROI hint detection wrong: {tracked}, {lost}")
+            return False
+        print("  ✓ ROI hint finds the face; wrong hint falls back to full frame")
+
+        other = []
+        t = threading.Thread(target=lambda: other.append((app.get_detectors(), face_engine._get_fallback_detector())))
+        t.start()
+        t.join()
+        if other[0][0] is app.get_detectors() or other[0][1] is face_engine._get_fallback_detector():
+            print("  ✗ Cascades shared between threads")
+            return False
+        if app.get_detectors() is not app.get_detectors():
+            print("  ✗ Cascades rebuilt on every call")
+            return False
+        print("  ✓ Cascades cached per thread")
+
+        faces = face_engine._detect_faces_fallback(frame)
+        if not faces or faces[0]['bbox'][2] - faces[0]['bbox'][0] < 150:
+            print(f"  ✗ face_engine fallback did not rescale boxes: {faces}")
+            return False
+        print("  ✓ face_engine fallback boxes in full-frame coordinates")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_face_tracking():
+    """Test per-request face tracking: ROI detection, periodic and lost re-detection"""
+    print("\nTest 20: Face tracking across frames...")
+    try:
+        import app
+        import face_engine
+        from face_tracker import FaceTracker
+
+        sample = cv2.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_scan.jpg"))
+        if sample is None:
+            print("  ⚠ temp_scan.jpg not found, skipped")
+            return True
+        face = cv2.resize(sample, (240, 240))
+        frames = []
+        for i in range(10):
+            frame = np.full((480, 640, 3), 120, np.uint8)
+            x = 150 + i * 8  # wajah bergeser pelan
+            frame[100:340, x:x + 240] = face
+            frames.append(frame)
+
+        tracker = FaceTracker(redetect_every=5)
+        rects = [app.detect_largest_face(cv2.cvtColor(f, cv2.COLOR_BGR2GRAY), tracker=tracker)[1] for f in frames]
+        if any(r is None for r in rects) or tracker.full_detections != 2 or tracker.roi_detections != 8:
+            print(f"  ✗ Unexpected tracking: full={tracker.full_detections}, roi={tracker.roi_detections}")
+            return False
+        if abs((rects[-1][0] - rects[0][0]) - 72) > 20:
+            print(f"  ✗ Tracked boxes do not follow the face: {rects[0]} -> {rects[-1]}")
+            return False
+        print(f"  ✓ 2 full-frame + 8 ROI detections, box follows the face")
+
+        blank = np.full((480, 640, 3), 120, np.uint8)
+        roi, rect = app.detect_largest_face(cv2.cvtColor(blank, cv2.COLOR_BGR2GRAY), tracker=tracker)
+        if rect is not None or tracker.box is not None or tracker.search_region(blank.shape) is not None:
+            print("  ✗ Lost track not reset")
+            return False
+        app.detect_largest_face(cv2.cvtColor(frames[0], cv2.COLOR_BGR2GRAY), tracker=tracker)
+        if tracker.box is None:
+            print("  ✗ Track not re-acquired with full-frame detection")
+            return False
+        print("  ✓ Lost track falls back to full-frame detection")
+
+        tracker = FaceTracker(redetect_every=0)
+        boxes = [face_engine.detect_largest_face(f, tracker=tracker) for f in frames[:4]]
+        if any(b is None for b in boxes) or tracker.full_detections != 1 or tracker.roi_detections != 3:
+            print(f"  ✗ face_engine tracking: full={tracker.full_detections}, roi={tracker.roi_detections}")
+            return False
+        print("  ✓ face_engine.detect_largest_face tracks inside the ROI")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_pose_prefilter():
+    """Test head-pose estimate from 5 keypoints and its quality term"""
+    print("\nTest 21: Head-pose pre-filter...")
+    try:
+        import face_engine
+
+        frontal = [[30, 40], [70, 40], [50, 60], [35, 80], [65, 80]]
+        turned = [[30, 40], [70, 40], [65, 60], [45, 80], [70, 80]]
+        angle = np.radians(40)
+        rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        tilted = (np.array(frontal, dtype=float) @ rot.T).tolist()
+
+        yaw, roll = face_engine.estimate_pose(frontal)
+        if abs(yaw) > 1 or abs(roll) > 1:
+            print(f"  ✗ Frontal face pose wrong: yaw={yaw:.1f}, roll={roll:.1f}")
+            return False
+        yaw_t, _ = face_engine.estimate_pose(turned)
+        yaw_r, roll_r = face_engine.estimate_pose(tilted)
+        if yaw_t < face_engine.POSE_MAX_YAW or abs(roll_r - 40) > 1 or abs(yaw_r) > 1:
+            print(f"  ✗ Turned/tilted pose wrong: yaw={yaw_t:.1f}, roll={roll_r:.1f}, yaw_r={yaw_r:.1f}")
+            return False
+        if face_engine._pose_within_limits((yaw_t, 0)) or face_engine._pose_within_limits((0, roll_r)):
+            print("  ✗ Pose limits not enforced")
+            return False
+        print(f"  ✓ Frontal (0°), turned (yaw {yaw_t:.0f}°) and tilted (roll {roll_r:.0f}°) faces estimated")
+
+        img = np.full((200, 200, 3), 128, np.uint8)
+        base = {'bbox': [40, 40, 160, 160], 'det_score': 0.9}
+        q_frontal = face_engine.calculate_quality_score(dict(base, landmarks=frontal), img)
+        q_turned = face_engine.calculate_quality_score(dict(base, landmarks=turned), img)
+        if not q_frontal > q_turned:
+            print(f"  ✗ Pose not in quality score: {q_frontal:.2f} vs {q_turned:.2f}")
+            return False
+        print(f"  ✓ Quality score includes pose ({q_frontal:.2f} frontal vs {q_turned:.2f} turned)")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_enrollment_selection():
+    """Test best-K enrollment selection embeds only the chosen frames"""
+    print("\nTest 22: Quality-selected enrollment...")
+    try:
+        import face_engine
+
+        rng = np.random.default_rng(4)
+        base = [face_engine.normalize_embedding(rng.standard_normal(face_engine.EMBEDDING_DIM)) for _ in range(3)]
+        candidates = []
+        for i in range(12):
+            yaw = [-20.0, 0.0, 20.0][i % 3]
+            candidates.append({
+                'frame': None,
+                'face': {'pose': (yaw, 0.0), 'id': i},
+                'quality': 0.9 - i * 0.02,
+                'vec': base[i % 3] if i < 6 else face_engine.normalize_embedding(rng.standard_normal(face_engine.EMBEDDING_DIM)),
+            })
+        by_id = {c['face']['id']: c for c in candidates}
+        embedded = []
+
+        def fake_embed(frame, face):
+            embedded.append(face['id'])
+            return by_id[face['id']]['vec']
+
+        picked = face_engine.select_enrollment_frames(candidates, 4, embed_fn=fake_embed)
+        ids = [c['face']['id'] for c in picked]
+        if len(picked) != 4 or ids[0] != 0 or sorted(ids[:3]) != [0, 1, 2]:
+            print(f"  ✗ Unexpected picks: {ids}")
+            return False
+        print(f"  ✓ Best frame first, then pose spread: picks {ids}")
+        if any(3 <= i < 6 for i in ids):
+            print("  ✗ Near-duplicate embedding kept")
+            return False
+        if len(embedded) >= len(candidates):
+            print("  ✗ Every frame was embedded")
+            return False
+        print(f"  ✓ Duplicates dropped; {len(embedded)}/{len(candidates)} frames embedded")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_gallery_consolidation():
+    """Test per-NIK gallery cap keeps a diverse subset and a mean template"""
+    print("\nTest 23: Gallery consolidation...")
+    try:
+        import tempfile
+        import sqlite3
+        import face_engine
+
+        rng = np.random.default_rng(5)
+        centers = [face_engine.normalize_embedding(rng.standard_normal(face_engine.EMBEDDING_DIM)) for _ in range(3)]
+        with tempfile.TemporaryDirectory() as tmp:
+            old_path, old_gallery = face_engine.EMBEDDING_DB_PATH, face_engine._gallery
+            old_total = face_engine._embedding_total
+            face_engine.EMBEDDING_DB_PATH = os.path.join(tmp, "embeddings.db")
+            face_engine._gallery = face_engine.Gallery()
+            try:
+                face_engine.init_embedding_db()
+                for c in centers:
+                    for _ in range(8):
+                        noisy = face_engine.normalize_embedding(c + rng.normal(0, 0.01, c.shape))
+                        face_engine.save_embedding(TEST_NIK, noisy, 0.8)
+                face_engine.load_all_embeddings()
+
+                dry = face_engine.consolidate_gallery(max_per_nik=3, keep_mean=True, dry_run=True)
+                if dry['scan_cost_after'] != 4 or len(face_engine._gallery.snapshot().get(TEST_NIK)) != 24:
+                    print(f"  ✗ Dry run changed the gallery or wrong report: {dry}")
+                    return False
+                report = face_engine.consolidate_gallery(max_per_nik=3, keep_mean=True)
+                kept = face_engine._gallery.snapshot().get(TEST_NIK)
+                covered = {int(np.argmax([float(np.dot(e, c)) for c in centers])) for e in kept[:3]}
+                if len(kept) != 4 or covered != {0, 1, 2}:
+                    print(f"  ✗ Kept subset not diverse: {len(kept)} kept, clusters {covered}")
+                    return False
+                print(f"  ✓ 24 -> 3 embeddings covering all 3 clusters + mean template "
+                      f"(scan cost -{report['scan_cost_reduction'] * 100:.0f}%)")
+
+                face_engine.load_all_embeddings()
+                if len(face_engine._gallery.snapshot().get(TEST_NIK)) != 4:
+                    print("  ✗ Template not reloaded from database")
+                    return False
+                face_engine.delete_embeddings_for_nik(TEST_NIK)
+                conn = sqlite3.connect(face_engine.EMBEDDING_DB_PATH)
+                left = conn.execute("SELECT COUNT(*) FROM embedding_templates").fetchone()[0]
+                conn.close()
+                if left != 0:
+                    print("  ✗ Template left behind after delete")
+                    return False
+                print("  ✓ Template persisted, reloaded and deleted with the NIK")
+            finally:
+                face_engine.EMBEDDING_DB_PATH, face_engine._gallery = old_path, old_gallery
+                face_engine._embedding_total = old_total
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_centroid_prefilter():
+    """Test two-stage centroid search matches the exact gallery scan"""
+    print("\nTest 24: Centroid prefilter + exact re-rank...")
+    try:
+        import face_engine
+
+        rng = np.random.default_rng(6)
+        centers = {}
+        db = {}
+        for i in range(200):
+            nik = TEST_NIK - i
+            centers[nik] = face_engine.normalize_embedding(rng.standard_normal(face_engine.EMBEDDING_DIM))
+            db[nik] = [face_engine.normalize_embedding(centers[nik] + rng.normal(0, 0.04, face_engine.EMBEDDING_DIM)).astype(np.float32)
+                       for _ in range(int(rng.integers(3, 12)))]
+        old_gallery, old_loaded = face_engine._gallery, face_engine._embeddings_loaded
+        face_engine._gallery, face_engine._embeddings_loaded = face_engine.Gallery(db), True
+        try:
+            niks = list(centers)
+            mismatches = 0
+            for nik in niks[:30]:
+                q = face_engine.normalize_embedding(centers[nik] + rng.normal(0, 0.04, face_engine.EMBEDDING_DIM)).astype(np.float32)
+                exact = face_engine.find_matching_identity(q, 0.3, prefilter=False)
+                fast = face_engine.find_matching_identity(q, 0.3, prefilter=True)
+                naive = max(float(np.dot(q, e)) for e in db[nik])
+                if exact != fast or exact[0][0] != nik or abs(exact[0][1] - naive) > 1e-5:
+                    mismatches += 1
+            index = face_engine.get_gallery_index()
+            n_cand = len(index.candidates(q, face_engine.CENTROID_TOP_M, face_engine.CENTROID_MARGIN))
+        finally:
+            face_engine._gallery, face_engine._embeddings_loaded = old_gallery, old_loaded
+        if mismatches:
+            print(f"  ✗ {mismatches}/30 queries differ from the exact scan")
+            return False
+        print("  ✓ 30/30 queries identical to the exact scan")
+        if n_cand >= len(niks):
+            print("  ✗ Prefilter did not reduce candidates")
+            return False
+        print(f"  ✓ Exact re-rank over {n_cand}/{len(niks)} identities")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_embedding_fusion():
+    """Test multi-frame fusion runs one gallery search and falls back to voting"""
+    print("\nTest 25: Multi-frame embedding fusion...")
+    try:
+        import face_engine
+
+        rng = np.random.default_rng(7)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(5)}
+        db = {nik: [face_engine.normalize_embedding(c + rng.normal(0, 0.03, dim)).astype(np.float32) for _ in range(3)]
+              for nik, c in people.items()}
+
+        def noisy(c):
+            return face_engine.normalize_embedding(c + rng.normal(0, 0.03, dim)).astype(np.float32)
+
+        target = TEST_NIK - 2
+        outlier = face_engine.normalize_embedding(rng.standard_normal(dim)).astype(np.float32)
+        agreeing = [(noisy(people[target]), 0.8) for _ in range(9)] + [(outlier, 0.9)]
+        split = [(noisy(people[TEST_NIK]), 0.8) for _ in range(2)] + [(noisy(people[TEST_NIK - 1]), 0.8) for _ in range(2)] \
+            + [(face_engine.normalize_embedding(rng.standard_normal(dim)).astype(np.float32), 0.8) for _ in range(2)]
+
+        searches = []
+        orig_iter, orig_matches = face_engine._iter_frame_embeddings, face_engine._gallery_matches
+        old_gallery, old_loaded, old_size = face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE
+        face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE = face_engine.Gallery(db), True, 0
+
+        def counting_matches(*args, **kwargs):
+            searches.append(1)
+            return orig_matches(*args, **kwargs)
+
+        face_engine._gallery_matches = counting_matches
+        try:
+            results, embedded = {}, {}
+
+            def counting_iter(samples, name):
+                embedded[name] = 0
+                for item in samples:
+                    embedded[name] += 1  # Detection + ArcFace cost of one frame
+                    yield item
+
+            for name, samples, mode in (("fusion", agreeing, "fusion"), ("vote", agreeing, "vote"),
+                                        ("split", split, "fusion"), ("default", agreeing, None)):
+                face_engine._iter_frame_embeddings = lambda frames, stats, samples=samples, name=name: counting_iter(samples, name)
+                searches.clear()
+                results[name] = (face_engine.recognize_face_multi_frame([None] * len(samples), mode=mode), len(searches))
+        finally:
+            face_engine._iter_frame_embeddings, face_engine._gallery_matches = orig_iter, orig_matches
+            face_engine._gallery, face_engine._embeddings_loaded = old_gallery, old_loaded
+            face_engine.RECENT_CACHE_SIZE = old_size
+
+        fused, n_fused = results["fusion"]
+        voted, n_voted = results["vote"]
+        if fused is None or fused['nik'] != target or fused['mode'] != 'fusion' or n_fused != 1 or fused['vote_count'] != 9:
+            print(f"  ✗ Fusion result wrong: {fused}, {n_fused} searches")
+            return False
+        print(f"  ✓ Fusion: 1 gallery search (voting used {n_voted}), outlier rejected, sim {fused['similarity']:.3f}")
+        if voted is None or voted['nik'] != target:
+            print(f"  ✗ Voting result differs: {voted}")
+            return False
+        split_result, n_split = results["split"]
+        if n_split < 2 or (split_result is not None and split_result['mode'] != 'vote'):
+            print(f"  ✗ Disagreeing frames did not fall back to voting: {split_result}")
+            return False
+        print("  ✓ Disagreeing frames fall back to voting")
+        default, _ = results["default"]
+        if default is None or default['mode'] != 'vote' or embedded["default"] >= embedded["fusion"]:
+            print(f"  ✗ Default mode embeds every frame: {embedded}")
+            return False
+        print(f"  ✓ Default mode is early-stopped voting ({embedded['default']} frames embedded, fusion {embedded['fusion']})")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_sprt_early_stop():
+    """Test SPRT early decision settles clear matches and non-matches early"""
+    print("\nTest 26: SPRT early-stop policy...")
+    try:
+        import face_engine
+
+        rng = np.random.default_rng(8)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(20)}
+
+        def noisy(c):
+            return face_engine.normalize_embedding(c + rng.normal(0, 0.03, dim)).astype(np.float32)
+
+        db = {nik: [noisy(c) for _ in range(4)] for nik, c in people.items()}
+        target = TEST_NIK - 3
+        stranger = face_engine.normalize_embedding(rng.standard_normal(dim))
+        genuine = [(noisy(people[target]), 0.8) for _ in range(20)]
+        impostor = [(noisy(stranger), 0.8) for _ in range(20)]
+
+        orig_iter = face_engine._iter_frame_embeddings
+        old_gallery, old_loaded, old_size = face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE
+        face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE = face_engine.Gallery(db), True, 0
+        runs = {}
+        try:
+            dist = face_engine.estimate_score_distributions()
+            for policy in ("sprt", "heuristic"):
+                for name, samples in (("genuine", genuine), ("impostor", impostor)):
+                    consumed = []
+
+                    def frames_iter(frames, stats, samples=samples, consumed=consumed):
+                        for item in samples:
+                            consumed.append(1)
+                            yield item
+
+                    face_engine._iter_frame_embeddings = frames_iter
+                    result = face_engine.recognize_face_multi_frame(
+                        [None] * 20, mode="vote", early_stop=face_engine.get_early_stop_policy(policy))
+                    runs[(policy, name)] = (result, len(consumed))
+            stats = face_engine.get_early_stop_stats()
+
+            # Exact scan (no centroid prefilter): the policy still sees only the best few identities
+            seen = []
+
+            class Recording(face_engine.SPRTEarlyStop):
+                def observe(self, scores, votes, processed):
+                    seen.append(len(scores))
+                    return super().observe(scores, votes, processed)
+
+            old_prefilter, face_engine.CENTROID_PREFILTER = face_engine.CENTROID_PREFILTER, False
+            try:
+                face_engine._iter_frame_embeddings = lambda frames, stats: iter(genuine)
+                face_engine.recognize_face_multi_frame([None] * 20, mode="vote", early_stop=Recording())
+            finally:
+                face_engine.CENTROID_PREFILTER = old_prefilter
+        finally:
+            face_engine._iter_frame_embeddings = orig_iter
+            face_engine._gallery, face_engine._embeddings_loaded = old_gallery, old_loaded
+            face_engine.RECENT_CACHE_SIZE = old_size
+
+        if not dist['genuine_mean'] > dist['impostor_mean']:
+            print(f"  ✗ Score distributions not separated: {dist}")
+            return False
+        print(f"  ✓ Gallery distributions: genuine {dist['genuine_mean']:.2f}, impostor {dist['impostor_mean']:.2f}")
+        result, used = runs[("sprt", "genuine")]
+        if result is None or result['nik'] != target or used > runs[("heuristic", "genuine")][1]:
+            print(f"  ✗ SPRT genuine: {result}, {used} frames")
+            return False
+        print(f"  ✓ Genuine accepted after {used} frames (heuristic: {runs[('heuristic', 'genuine')][1]})")
+        result, used = runs[("sprt", "impostor")]
+        if result is not None or used >= 20 or runs[("heuristic", "impostor")][1] != 20:
+            print(f"  ✗ SPRT impostor: {result}, {used} frames")
+            return False
+        print(f"  ✓ Non-match rejected after {used} frames (heuristic: all 20)")
+        if stats.get("sprt", {}).get("avg_frames", 0) <= 0:
+            print("  ✗ Average frames per decision not reported")
+            return False
+        print(f"  ✓ Avg frames per decision reported (sprt: {stats['sprt']['avg_frames']})")
+        if not seen or max(seen) > face_engine.VOTE_CANDIDATES:
+            print(f"  ✗ Policy fed the whole gallery: {seen}")
+            return False
+        print(f"  ✓ Policy sees at most {face_engine.VOTE_CANDIDATES} of {len(people)} identities per frame")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_gallery_snapshots():
+    """Test copy-on-write gallery snapshots under concurrent readers and writers"""
+    print("\nTest 27: Gallery snapshots (lock-free reads)...")
+    try:
+        import threading
+        from gallery import Gallery
+
+        rng = np.random.default_rng(8)
+        dim = 32
+
+        def unit():
+            v = rng.standard_normal(dim).astype(np.float32)
+            return v / np.linalg.norm(v)
+
+        gallery = Gallery({TEST_NIK - i: [unit()] for i in range(20)})
+        before = gallery.snapshot()
+        before_total = before.total_embeddings
+        try:
+            before.get(TEST_NIK)[0][0] = 0.0
+            print("  ✗ Snapshot embeddings are writable")
+            return False
+        except ValueError:
+            pass
+
+        writes = [unit() for _ in range(200)]
+        errors = []
+        stop = threading.Event()
+
+        def writer():
+            try:
+                for i, emb in enumerate(writes):
+                    gallery.add(TEST_NIK - (i % 40), [emb])
+                    if i % 50 == 49:
+                        gallery.remove(TEST_NIK - 39)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                stop.set()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    snap = gallery.snapshot()
+                    n = sum(len(embs) for _, embs in snap.items())  # Would raise if mutated mid-iteration
+                    scores = snap.index.exact_scores(writes[0])
+                    if n != snap.total_embeddings or len(scores) != len(snap):
+                        errors.append(AssertionError("inconsistent snapshot"))
+                        return
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for _ in range(3)] + [threading.Thread(target=writer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            print(f"  ✗ Concurrent access failed: {errors[0]}")
+            return False
+        print(f"  ✓ 3 readers + 1 writer, {gallery.snapshot().version} versions published, no errors")
+        if before.version != 0 or before.total_embeddings != before_total or len(before) != 20:
+            print("  ✗ Old snapshot changed after writes")
+            return False
+        print("  ✓ Snapshot held by a reader is unchanged by later writes")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_gallery_tombstones():
+    """Test incremental gallery mutation with tombstones, NIK remap and compaction"""
+    print("\nTest 28: Gallery tombstones + compaction...")
+    try:
+        from gallery import Gallery
+
+        rng = np.random.default_rng(9)
+        dim = 32
+
+        def unit():
+            v = rng.standard_normal(dim).astype(np.float32)
+            return v / np.linalg.norm(v)
+
+        db = {TEST_NIK - i: [unit() for _ in range(4)] for i in range(50)}
+        gallery = Gallery(db, compact_ratio=0.5)
+        store = gallery._store
+        q = unit()
+
+        def naive():
+            return sorted((nik, max(float(np.dot(q, e)) for e in embs)) for nik, embs in db.items())
+
+        def scores(snap):
+            return sorted(snap.index.exact_scores(q))
+
+        gallery.add(TEST_NIK, [unit()])
+        db[TEST_NIK] = list(db[TEST_NIK]) + list(gallery.snapshot().get(TEST_NIK)[-1:])
+        before_delete = gallery.snapshot()
+        gallery.remove(TEST_NIK - 1)
+        del db[TEST_NIK - 1]
+        gallery.rename(TEST_NIK - 2, TEST_NIK + 1)
+        db[TEST_NIK + 1] = db.pop(TEST_NIK - 2)
+        snap = gallery.snapshot()
+        if gallery._store is not store or gallery.stats()['tombstones'] != 8:
+            print(f"  ✗ Mutations rebuilt the store: {gallery.stats()}")
+            return False
+        if TEST_NIK - 1 in snap or TEST_NIK - 2 in snap or TEST_NIK + 1 not in snap or TEST_NIK - 1 not in before_delete:
+            print("  ✗ Tombstones / NIK remap not visible per snapshot")
+            return False
+        got = [(n, round(s, 5)) for n, s in scores(snap)]
+        if got != [(n, round(s, 5)) for n, s in naive()]:
+            print("  ✗ Vectorized scan differs from naive scan after mutations")
+            return False
+        print(f"  ✓ Add / delete / rename in place ({gallery.stats()['tombstones']} tombstones), scan matches naive")
+
+        for i in range(3, 30):
+            gallery.remove(TEST_NIK - i)
+            del db[TEST_NIK - i]
+        if gallery._compactor is not None:
+            gallery._compactor.join(timeout=10)
+        stats = gallery.stats()
+        snap = gallery.snapshot()
+        if stats['compactions'] < 1 or stats['tombstone_ratio'] > 0.5:
+            print(f"  ✗ Compaction not triggered: {stats}")
+            return False
+        got = [(n, round(s, 5)) for n, s in scores(snap)]
+        if got != [(n, round(s, 5)) for n, s in naive()] or len(snap) != len(db):
+            print("  ✗ Compacted gallery differs")
+            return False
+        print(f"  ✓ Background compaction at tombstone ratio > 0.5 ({stats['rows']} rows left, scan unchanged)")
         return True
     except Exception as e:
         print(f"  ✗ Error: {e}")
         return False
 
+def test_gallery_tiers():
+    """Test hot/cold gallery tiers driven by last-seen time and RAM budget"""
+    print("\nTest 29: Hot / cold gallery tiers...")
+    try:
+        import tempfile
+        import sqlite3
+        from datetime import datetime, timedelta
+        import face_engine
+
+        rng = np.random.default_rng(10)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(3)}
+
+        def noisy(c):
+            return face_engine.normalize_embedding(c + rng.normal(0, 0.02, dim)).astype(np.float32)
+
+        saved = (face_engine.EMBEDDING_DB_PATH, face_engine._gallery, face_engine._cold_segment,
+                 face_engine._embedding_total, face_engine._embeddings_loaded, face_engine.GALLERY_HOT_BUDGET_MB,
+                 face_engine.GALLERY_COLD_DIR, face_engine.RECENT_CACHE_SIZE, face_engine._iter_frame_embeddings)
+        saved_pending = dict(face_engine._last_seen_pending)
+        face_engine._last_seen_pending.clear()  # Earlier tests' recognitions belong to the real database
+        with tempfile.TemporaryDirectory() as tmp:
+            face_engine.EMBEDDING_DB_PATH = os.path.join(tmp, "embeddings.db")
+            face_engine.GALLERY_COLD_DIR = tmp
+            face_engine._gallery, face_engine._cold_segment = face_engine.Gallery(), None
+            face_engine.RECENT_CACHE_SIZE = 0
+            try:
+                face_engine.init_embedding_db()
+                for nik, c in people.items():
+                    for _ in range(4):
+                        face_engine.save_embedding(nik, noisy(c), 0.8)
+                conn = sqlite3.connect(face_engine.EMBEDDING_DB_PATH)
+                conn.execute("UPDATE embeddings SET created_at = ? WHERE nik != ?",
+                             ((datetime.now() - timedelta(days=800)).isoformat(), TEST_NIK))
+                conn.commit()
+                conn.close()
+
+                face_engine.load_all_embeddings()
+                tiers = face_engine.get_tier_stats()
+                if tiers['hot_niks'] != 1 or tiers['cold_niks'] != 2 or TEST_NIK not in face_engine._gallery.snapshot():
+                    print(f"  ✗ Wrong tier split: {tiers}")
+                    return False
+                target = TEST_NIK - 1
+                matches = face_engine.find_matching_identity(noisy(people[target]), 0.5)
+                tiers = face_engine.get_tier_stats()
+                if not matches or matches[0][0] != target or tiers['cold_hits'] != 1:
+                    print(f"  ✗ Cold tier not searched on a hot miss: {matches}, {tiers}")
+                    return False
+                face_engine.find_matching_identity(noisy(people[TEST_NIK]), 0.5)
+                if face_engine.get_tier_stats()['cold_searches'] != 1:
+                    print("  ✗ Cold tier scanned although the hot tier matched")
+                    return False
+                print("  ✓ Stale identities loaded cold, scanned only on a hot miss")
+
+                pruned = TEST_NIK - 2
+                report = face_engine.consolidate_nik(pruned, max_per_nik=2, keep_mean=False)
+                hot_rows = face_engine._gallery.snapshot().get(pruned)
+                conn = sqlite3.connect(face_engine.EMBEDDING_DB_PATH)
+                db_rows = conn.execute("SELECT COUNT(*) FROM embeddings WHERE nik = ?", (pruned,)).fetchone()[0]
+                conn.close()
+                if (report['removed'] != 2 or db_rows != 2 or pruned in face_engine._cold_segment
+                        or hot_rows is None or len(hot_rows) != len(face_engine._read_identity_embeddings(pruned)[0])):
+                    print(f"  ✗ Consolidated cold identity left stale rows: {report}")
+                    return False
+                print("  ✓ Consolidating a cold identity moves only its pruned set into RAM")
+
+                frames = [(noisy(people[target]), 0.8) for _ in range(5)]
+                face_engine._iter_frame_embeddings = lambda frames_, stats: iter(frames)
+                result = face_engine.recognize_face_multi_frame([None] * 5, mode="fusion")
+                if (result is None or result['nik'] != target or target not in face_engine._gallery.snapshot()
+                        or target in face_engine._cold_segment):
+                    print(f"  ✗ Recognized cold identity not promoted: {result}")
+                    return False
+                print("  ✓ Recognized cold identity promoted to RAM")
+
+                def last_seen_rows():
+                    conn = sqlite3.connect(face_engine.EMBEDDING_DB_PATH)
+                    try:
+                        return conn.execute("SELECT COUNT(*) FROM identity_last_seen WHERE nik = ?", (target,)).fetchone()[0]
+                    finally:
+                        conn.close()
+
+                if last_seen_rows() != 0 or target not in face_engine._last_seen_pending:
+                    print("  ✗ Last seen written to SQLite on the request thread")
+                    return False
+                print("  ✓ Last seen kept in memory by the request, not written synchronously")
+
+                # Room for one identity (4 rows): the most recently seen one stays hot
+                face_engine.GALLERY_HOT_BUDGET_MB = 5 * dim * 4 / (1024 * 1024) / face_engine.GALLERY_HOT_FILL
+                face_engine.load_all_embeddings()
+                hot = face_engine._gallery.snapshot().niks()
+                matches = face_engine.find_matching_identity(noisy(people[TEST_NIK]), 0.5)
+                if hot != [target] or not matches or matches[0][0] != TEST_NIK:
+                    print(f"  ✗ RAM budget not applied: hot={hot}, {matches}")
+                    return False
+                if last_seen_rows() != 1 or target in face_engine._last_seen_pending:
+                    print("  ✗ Pending last-seen times not flushed before the reload")
+                    return False
+                print(f"  ✓ RAM budget keeps the most recently seen identity hot ({face_engine.get_tier_stats()['hot_mb']} MB)")
+            finally:
+                if face_engine._cold_segment is not None:
+                    face_engine._cold_segment.close()
+                (face_engine.EMBEDDING_DB_PATH, face_engine._gallery, face_engine._cold_segment,
+                 face_engine._embedding_total, face_engine._embeddings_loaded, face_engine.GALLERY_HOT_BUDGET_MB,
+                 face_engine.GALLERY_COLD_DIR, face_engine.RECENT_CACHE_SIZE, face_engine._iter_frame_embeddings) = saved
+                face_engine._last_seen_pending.clear()
+                face_engine._last_seen_pending.update(saved_pending)
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_site_partitions():
+    """Test site-partitioned gallery search (local site first, fan-out on a miss)"""
+    print("\nTest 30: Site-partitioned gallery...")
+    try:
+        import tempfile
+        import sqlite3
+        from datetime import datetime
+        import face_engine
+
+        rng = np.random.default_rng(11)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(4)}
+        home = {TEST_NIK: "klinik-a", TEST_NIK - 1: "klinik-a", TEST_NIK - 2: "klinik-b"}
+
+        def noisy(c):
+            return face_engine.normalize_embedding(c + rng.normal(0, 0.02, dim)).astype(np.float32)
+
+        saved = (face_engine.EMBEDDING_DB_PATH, face_engine._gallery, face_engine._cold_segment,
+                 face_engine._embedding_total, face_engine._embeddings_loaded, face_engine._site_stats)
+        with tempfile.TemporaryDirectory() as tmp:
+            face_engine.EMBEDDING_DB_PATH = os.path.join(tmp, "embeddings.db")
+            face_engine._gallery, face_engine._cold_segment, face_engine._site_stats = face_engine.Gallery(), None, {}
+            try:
+                # Database from before sites existed: no site column
+                conn = sqlite3.connect(face_engine.EMBEDDING_DB_PATH)
+                conn.execute("""CREATE TABLE embeddings (id INTEGER PRIMARY KEY AUTOINCREMENT, nik INTEGER NOT NULL,
+                                embedding BLOB NOT NULL, created_at TEXT NOT NULL, quality_score REAL DEFAULT 0.0)""")
+                legacy = TEST_NIK - 3
+                conn.execute("INSERT INTO embeddings (nik, embedding, created_at, quality_score) VALUES (?, ?, ?, ?)",
+                             (legacy, noisy(people[legacy]).tobytes(), datetime.now().isoformat(), 0.8))
+                conn.commit()
+                conn.close()
+                face_engine.init_embedding_db()
+                for nik, site in home.items():
+                    for _ in range(3):
+                        face_engine.save_embedding(nik, noisy(people[nik]), 0.8, site=site)
+                face_engine.load_all_embeddings()
+                snapshot = face_engine._gallery.snapshot()
+                if (snapshot.site_of(legacy) != face_engine.DEFAULT_SITE
+                        or snapshot.site_of(TEST_NIK - 2) != "klinik-b"):
+                    print(f"  ✗ Wrong sites after load: {[(n, snapshot.site_of(n)) for n in snapshot.niks()]}")
+                    return False
+                print("  ✓ Site recorded at enrollment, old databases migrated to the default site")
+
+                matches = face_engine.find_matching_identity(noisy(people[TEST_NIK]), 0.5, site="klinik-a")
+                stats = face_engine.get_site_stats()["klinik-a"]
+                if not matches or matches[0][0] != TEST_NIK or stats['local_hits'] != 1 or stats['fanout_hits'] != 0:
+                    print(f"  ✗ Local hit not served by the local partition: {matches}, {stats}")
+                    return False
+                matches = face_engine.find_matching_identity(noisy(people[TEST_NIK - 2]), 0.5, site="klinik-a")
+                stats = face_engine.get_site_stats()["klinik-a"]
+                if not matches or matches[0][0] != TEST_NIK - 2 or stats['fanout_hits'] != 1:
+                    print(f"  ✗ Miss did not fan out to other sites: {matches}, {stats}")
+                    return False
+                query = noisy(people[TEST_NIK - 1])
+                whole = face_engine.find_matching_identity(query, 0.5, prefilter=False)
+                fanout = face_engine.find_matching_identity(query, 0.5, prefilter=False, site="klinik-b")
+                if not whole or [n for n, _ in whole] != [n for n, _ in fanout] or whole[0][1] != fanout[0][1]:
+                    print(f"  ✗ Fan-out result differs from a whole-gallery search: {whole} vs {fanout}")
+                    return False
+                print(f"  ✓ Local partition first, fan-out on a miss (klinik-a local hit rate {stats['local_hit_rate']:.2f})")
+
+                face_engine._gallery.add(TEST_NIK - 2, [noisy(people[TEST_NIK - 2])], "klinik-a")
+                sizes = face_engine.get_site_stats()
+                if (face_engine._gallery.snapshot().site_of(TEST_NIK - 2) != "klinik-a"
+                        or len(face_engine._gallery.snapshot().get(TEST_NIK - 2)) != 4
+                        or sizes["klinik-a"]['niks'] != 3 or sizes.get("klinik-b", {}).get('niks', 0) != 0):
+                    print(f"  ✗ Re-enrollment at another site did not move the identity: {sizes}")
+                    return False
+                if 'sites' not in face_engine.get_engine_status():
+                    print("  ✗ Site stats missing from engine status")
+                    return False
+                print("  ✓ Re-enrollment moves the identity; partition sizes in engine status")
+            finally:
+                (face_engine.EMBEDDING_DB_PATH, face_engine._gallery, face_engine._cold_segment,
+                 face_engine._embedding_total, face_engine._embeddings_loaded, face_engine._site_stats) = saved
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_sharded_search():
+    """Test gallery search scattered over shard worker processes"""
+    print("\nTest 31: Sharded gallery search...")
+    try:
+        import face_engine
+        from gallery import shard_of
+
+        rng = np.random.default_rng(12)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(40)}
+
+        def noisy(c):
+            return face_engine.normalize_embedding(c + rng.normal(0, 0.02, dim)).astype(np.float32)
+
+        db = {nik: [noisy(c) for _ in range(3)] for nik, c in people.items()}
+        sites = {nik: ("klinik-a" if i % 2 else "klinik-b") for i, nik in enumerate(people)}
+        saved = (face_engine._gallery, face_engine._cold_segment, face_engine._embeddings_loaded,
+                 face_engine._shard_pool, face_engine.GALLERY_SHARDS, face_engine.GALLERY_SHARD_MIN_ROWS)
+        import threading
+        threaded = threading.active_count() > 1
+        pool = face_engine.ShardPool(3, dim, capacity=8)  # Tiny segments: every shard has to grow
+        face_engine._gallery, face_engine._cold_segment = face_engine.Gallery(db, sites=sites), None
+        face_engine._embeddings_loaded, face_engine._shard_pool = True, None
+        face_engine.GALLERY_SHARD_MIN_ROWS = 0
+        try:
+            face_engine.GALLERY_SHARDS = 3
+            face_engine.find_matching_identity(noisy(people[TEST_NIK]), 0.5)
+            if face_engine._shard_pool is not None:
+                print("  ✗ Shard pool started lazily from a request")
+                return False
+            if threaded and pool.start_method == "fork":
+                print("  ✗ Shard workers forked from a multithreaded process")
+                return False
+            print(f"  ✓ No lazy start from a request; pool from a threaded process uses {pool.start_method}")
+            face_engine._shard_pool = pool
+            def both(query, threshold=-1.0, **kwargs):
+                face_engine.GALLERY_SHARDS = 0
+                local = face_engine.find_matching_identity(query, threshold, prefilter=False, **kwargs)
+                face_engine.GALLERY_SHARDS = 3
+                return local, face_engine.find_matching_identity(query, threshold, **kwargs)
+
+            for nik in list(people)[:5]:
+                local, sharded = both(noisy(people[nik]), top_k=8)
+                if ([n for n, _ in local] != [n for n, _ in sharded]
+                        or max(abs(a[1] - b[1]) for a, b in zip(local, sharded)) > 1e-5):
+                    print(f"  ✗ Sharded top-k differs from the in-process scan: {local[:3]} vs {sharded[:3]}")
+                    return False
+            stats = pool.stats()
+            if sum(stats['identities']) != 40 or min(stats['identities']) == 0:
+                print(f"  ✗ Rows not spread over the shards: {stats}")
+                return False
+            print(f"  ✓ K-way merge of per-shard top-k equals the exact scan (identities per shard {stats['identities']})")
+
+            new_nik = TEST_NIK - 100
+            face = face_engine.normalize_embedding(rng.standard_normal(dim))
+            face_engine._gallery.add(new_nik, [noisy(face) for _ in range(40)], "klinik-a")  # Outgrows its segment
+            face_engine._sync_shards()
+            before = pool.stats()['queries']
+            matches = face_engine.find_matching_identity(noisy(face), 0.5)
+            if (not matches or matches[0][0] != new_nik or pool.stats()['queries'] == before or pool.stats()['grows'] != 1
+                    or pool.stats()['identities'][shard_of(new_nik, 3)] != stats['identities'][shard_of(new_nik, 3)] + 1):
+                print(f"  ✗ Enrollment not routed to its shard: {matches}")
+                return False
+            old = face_engine._gallery.snapshot()
+            face_engine._gallery.remove(new_nik)
+            gone = face_engine.find_matching_identity(noisy(face), 0.5)
+            still = face_engine._gallery_matches(noisy(face), 0.5, snapshot=old)
+            if gone or not still or still[0][0] != new_nik:
+                print(f"  ✗ Tombstones not mirrored per version: {gone}, {still}")
+                return False
+            print("  ✓ Enrollment routed to its shard (segment grown); deletes respect snapshot versions")
+
+            target = next(nik for nik in people if sites[nik] == "klinik-b")
+            local, sharded = both(noisy(people[target]), 0.5, site="klinik-a", top_k=3)
+            if [n for n, _ in local] != [n for n, _ in sharded] or not sharded or sharded[0][0] != target:
+                print(f"  ✗ Site fan-out differs with shards: {local} vs {sharded}")
+                return False
+            face_engine._gallery.compact()
+            matches = face_engine.find_matching_identity(noisy(people[target]), 0.5)
+            if not matches or matches[0][0] != target or pool.stats()['rebuilds'] != 1:
+                print(f"  ✗ Shards not rebuilt after compaction: {matches}, {pool.stats()}")
+                return False
+            if face_engine.get_engine_status()['shards']['shards'] != 3:
+                print("  ✗ Shard stats missing from engine status")
+                return False
+            print("  ✓ Site partitions, compaction rebuild and engine status with shards")
+
+            # Concurrent callers while enrollments grow a segment and a compaction replaces the store
+            errors, queries = [], [(noisy(people[nik]), nik) for nik in list(people)[:8]]
+
+            def caller(i):
+                try:
+                    for j in range(10):
+                        query, nik = queries[(i + j) % len(queries)]
+                        snap = face_engine._gallery.snapshot()
+                        found = pool.search(snap, query, 0.5, top_k=3)
+                        if found is None and snap._store is not face_engine._gallery.snapshot()._store:
+                            continue  # Snapshot of the store the compaction replaced: caller searches in-process
+                        exact = sorted((m for m in snap.index.exact_scores(query) if m[1] >= 0.5), key=lambda m: -m[1])
+                        if found is None or [n for n, _ in found] != [n for n, _ in exact[:3]]:
+                            errors.append((nik, found))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=caller, args=(i,)) for i in range(6)]
+            for t in threads:
+                t.start()
+            for k in range(3):
+                face_engine._gallery.add(TEST_NIK - 200 - k, [noisy(rng.standard_normal(dim)) for _ in range(30)])
+                face_engine._sync_shards()
+            face_engine._gallery.remove(TEST_NIK - 200)
+            face_engine._gallery.compact()
+            for t in threads:
+                t.join()
+            stats = pool.stats()
+            if errors or not stats['healthy'] or stats['in_flight'] != 0 or pool._retired:
+                print(f"  ✗ Concurrent sharded search wrong: {errors[:2]}, {stats}")
+                return False
+            print(f"  ✓ {len(threads)} concurrent callers exact across segment growth and rebuild "
+                  f"({stats['channels']} pipes per shard)")
+        finally:
+            pool.close()
+            (face_engine._gallery, face_engine._cold_segment, face_engine._embeddings_loaded,
+             face_engine._shard_pool, face_engine.GALLERY_SHARDS, face_engine.GALLERY_SHARD_MIN_ROWS) = saved
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_sprt_low_genuine():
+    """Test SPRT never rejects a query that holds votes above the threshold"""
+    print("\nTest 32: SPRT with a low-scoring genuine query...")
+    try:
+        import face_engine
+
+        rng = np.random.default_rng(32)
+        dim = face_engine.EMBEDDING_DIM
+        people = {TEST_NIK - i: face_engine.normalize_embedding(rng.standard_normal(dim)) for i in range(10)}
+
+        def at_similarity(c, sim):
+            # Unit vector with cosine `sim` to c (c is unit-norm)
+            other = rng.standard_normal(dim)
+            other = face_engine.normalize_embedding(other - np.dot(other, c) * c)
+            return (sim * c + np.sqrt(1 - sim * sim) * other).astype(np.float32)
+
+        # Same-session enrollment: gallery rows of one NIK agree at ~0.95
+        db = {nik: [face_engine.normalize_embedding(c + rng.normal(0, 0.01, dim)).astype(np.float32) for _ in range(4)]
+              for nik, c in people.items()}
+        target = TEST_NIK - 2
+        samples = [(at_similarity(people[target], 0.45), 0.8) for _ in range(10)]
+
+        orig_iter = face_engine._iter_frame_embeddings
+        old_gallery, old_loaded, old_size = face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE
+        old_scores = list(face_engine._accepted_scores)
+        face_engine._gallery, face_engine._embeddings_loaded, face_engine.RECENT_CACHE_SIZE = face_engine.Gallery(db), True, 0
+        face_engine._accepted_scores.clear()
+        try:
+            dist = face_engine.estimate_score_distributions()
+            face_engine._iter_frame_embeddings = lambda frames, stats: iter(samples)
+            # Narrow, high genuine fit: every 0.45 frame pushes the best-score LLR towards reject
+            narrow = {'genuine_mean': 0.8, 'genuine_std': 0.03, 'impostor_mean': 0.3, 'impostor_std': 0.1}
+            result = face_engine.recognize_face_multi_frame(
+                [None] * 10, threshold=0.4, mode="vote", early_stop=face_engine.SPRTEarlyStop(narrow))
+            recorded = len(face_engine._accepted_scores)
+        finally:
+            face_engine._iter_frame_embeddings = orig_iter
+            face_engine._gallery, face_engine._embeddings_loaded = old_gallery, old_loaded
+            face_engine.RECENT_CACHE_SIZE = old_size
+            face_engine._accepted_scores.clear()
+            face_engine._accepted_scores.extend(old_scores)
+
+        if dist['genuine_std'] < face_engine.SPRT_GENUINE_STD_MIN:
+            print(f"  ✗ Genuine std not floored: {dist}")
+            return False
+        print(f"  ✓ Gallery genuine fit {dist['genuine_mean']:.2f} +- {dist['genuine_std']:.2f} (floored)")
+        if result is None or result['nik'] != target:
+            print(f"  ✗ Genuine query at ~0.45 per frame rejected: {result}")
+            return False
+        print(f"  ✓ Recognized via vote resolution (sim {result['similarity']:.2f})")
+        if recorded != result['vote_count']:
+            print(f"  ✗ Accepted per-frame scores not recorded: {recorded}")
+            return False
+        print("  ✓ Accepted per-frame scores feed the genuine distribution")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+
+def test_photo_count_external_changes():
+    """Test the dashboard photo counter follows files changed outside the app"""
+    print("\nTest 33: Photo counter with external file changes...")
+    path = None
+    try:
+        import app
+
+        before = app.photo_count()
+        # Written by another process (e.g. restore / cleanup_orphan_data.py), not via adjust_photo_count
+        path = os.path.join(app.DATA_DIR, f"{TEST_NIK}_counter_test.jpg")
+        time.sleep(0.01)
+        cv2.imwrite(path, np.zeros((8, 8), dtype=np.uint8))
+        added = app.photo_count()
+        time.sleep(0.01)
+        os.remove(path)
+        path = None
+        removed = app.photo_count()
+
+        if added != before + 1:
+            print(f"  ✗ External write not counted: {before} -> {added}")
+            return False
+        print(f"  ✓ External write counted ({before} -> {added})")
+        if removed != before:
+            print(f"  ✗ External delete not counted: {added} -> {removed}")
+            return False
+        print(f"  ✓ External delete counted ({added} -> {removed})")
+        return True
+    except Exception as e:
+        print(f"  ✗ Error: {e}")
+        return False
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
 def main():
     print("=" * 60)
     print("FACE RECOGNITION WORKFLOW TESTS")
@@ -318,6 +1801,30 @@ def main():
         test_file_naming_format,
         test_model_training_loading,
         test_api_endpoints,
+        test_recent_identity_cache,
+        test_patients_pagination,
+        test_lbph_tombstones,
+        test_packed_dataset,
+        test_dataset_signature,
+        test_lbph_matcher,
+        test_lbph_model_store,
+        test_lbph_concurrent_predict,
+        test_synthetic_samples,
+        test_fallback_detection,
+        test_face_tracking,
+        test_pose_prefilter,
+        test_enrollment_selection,
+        test_gallery_consolidation,
+        test_centroid_prefilter,
+        test_embedding_fusion,
+        test_sprt_early_stop,
+        test_gallery_snapshots,
+        test_gallery_tombstones,
+        test_gallery_tiers,
+        test_site_partitions,
+        test_sharded_search,
+        test_sprt_low_genuine,
+        test_photo_count_external_changes,
     ]
     
     results = []